@@ -1,23 +1,20 @@
 import { Worker } from 'worker_threads';
+import { spawn } from 'child_process';
 import path from 'path';
 import fs from 'fs';
 import KpiData from '../models/KpiData.js';
+import KpiBucket from '../models/KpiBucket.js';
+import IngestBatch from '../models/IngestBatch.js';
+import { submitPipelineJob } from '../lib/pipelineService.js';
 import { pipelineStatus, getIo, setPipelineStatus } from '../index.js';
 import { createNotification } from './notificationController.js';
+import { refreshSufficientStatistics } from './statisticsController.js';
 
 
 async function checkDocumentExists(doc) {
   try {
-    const existingDoc = await KpiData.findOne({
-      source_line: doc.source_line,
-      date_c: doc.date_c,
-      mois: doc.mois,
-      date_num: doc.date_num,
-      semaine: doc.semaine,
-      poste: doc.poste,
-      heure: doc.heure,
-      imputation_method: doc.imputation_method
-    });
+    // _id = empreinte des champs d'unicité, calculée par le pipeline Python
+    const existingDoc = await KpiData.exists({ _id: doc._id });
     
     return existingDoc !== null;
   } catch (error) {
@@ -48,29 +45,25 @@ async function insertUniqueDocuments(documents) {
   return { inserted: 0, duplicates };
 }
 
-async function insertUniqueDocumentsEfficient(documents) {
+async function insertUniqueDocumentsEfficient(documents, replace = false, model = KpiData) {
   if (documents.length === 0) return { inserted: 0, duplicates: 0 };
 
   const bulkOps = [];
   const seenKeys = new Set();
 
   for (const doc of documents) {
-    const uniqueKey = `${doc.source_line}-${doc.date_c}-${doc.mois}-${doc.date_num}-${doc.semaine}-${doc.poste}-${doc.heure}-${doc.imputation_method}`;
-    
-    if (!seenKeys.has(uniqueKey)) {
-      seenKeys.add(uniqueKey);
-      bulkOps.push({
+    if (!seenKeys.has(doc._id)) {
+      seenKeys.add(doc._id);
+      // En mode delta, seules les lignes nouvelles ou modifiées sont reçues : on les remplace
+      bulkOps.push(replace ? {
+        replaceOne: {
+          filter: { _id: doc._id },
+          replacement: doc,
+          upsert: true
+        }
+      } : {
         updateOne: {
-          filter: {
-            source_line: doc.source_line,
-            date_c: doc.date_c,
-            mois: doc.mois,
-            date_num: doc.date_num,
-            semaine: doc.semaine,
-            poste: doc.poste,
-            heure: doc.heure,
-            imputation_method: doc.imputation_method
-          },
+          filter: { _id: doc._id },
           update: { $setOnInsert: doc },
           upsert: true
         }
@@ -79,10 +72,12 @@ async function insertUniqueDocumentsEfficient(documents) {
   }
 
   try {
-    const result = await KpiData.bulkWrite(bulkOps, { ordered: false });
+    const result = await model.bulkWrite(bulkOps, { ordered: false });
+    const existing = documents.length - result.upsertedCount;
     return {
       inserted: result.upsertedCount,
-      duplicates: documents.length - result.upsertedCount
+      duplicates: replace ? 0 : existing,
+      replaced: replace ? existing : 0
     };
   } catch (error) {
     console.error('Bulk write error:', error);
@@ -90,14 +85,15 @@ async function insertUniqueDocumentsEfficient(documents) {
   }
 }
 
-async function processInBatches(documents, batchSize = 1000) {
-  const results = { inserted: 0, duplicates: 0 };
+async function processInBatches(documents, batchSize = 1000, replace = false, model = KpiData) {
+  const results = { inserted: 0, duplicates: 0, replaced: 0 };
   
   for (let i = 0; i < documents.length; i += batchSize) {
     const batch = documents.slice(i, i + batchSize);
-    const batchResult = await insertUniqueDocumentsEfficient(batch);
+    const batchResult = await insertUniqueDocumentsEfficient(batch, replace, model);
     results.inserted += batchResult.inserted;
     results.duplicates += batchResult.duplicates;
+    results.replaced += batchResult.replaced;
     
     console.log(`Batch ${i/batchSize + 1} traité: ${batchResult.inserted} inserts, ${batchResult.duplicates} doublons`);
   }
@@ -105,23 +101,132 @@ async function processInBatches(documents, batchSize = 1000) {
   return results;
 }
 
-export const runPipelineInMemory = (req, res) => {
-  if (pipelineStatus.status === 'running') {
-    return res.status(409).json({ error: "Un processus de fusion est déjà en cours." });
+// Enregistre le lot d'import (une fois par exécution) avec le bilan d'insertion
+async function saveIngestBatch(ingestBatch, summary) {
+  if (!ingestBatch) return null;
+  try {
+    await IngestBatch.replaceOne({ _id: ingestBatch._id }, { ...ingestBatch, summary }, { upsert: true });
+  } catch (error) {
+    console.error('Erreur lors de l\'enregistrement du lot d\'import:', error);
+  }
+  return ingestBatch._id;
+}
+
+// Mode d'écriture du pipeline Python : 'stdout' (insertion par Node) ou 'mongodb' (écriture directe dans kpidatas).
+// La disposition 'bucket' impose l'écriture directe : le pipeline y réconcilie les lignes avec les buckets existants.
+function getPipelineSinkConfig() {
+  if (process.env.PIPELINE_SINK !== 'mongodb' && process.env.PIPELINE_LAYOUT !== 'bucket') {
+    return { type: 'stdout' };
+  }
+
+  const sink = { type: 'mongodb' };
+  if (process.env.PIPELINE_SINK_BATCH_SIZE) {
+    sink.batch_size = parseInt(process.env.PIPELINE_SINK_BATCH_SIZE, 10);
+  }
+  if (process.env.PIPELINE_SINK_WRITE_CONCERN) {
+    const w = process.env.PIPELINE_SINK_WRITE_CONCERN;
+    sink.write_concern = { w: /^\d+$/.test(w) ? parseInt(w, 10) : w };
+  }
+  return sink;
+}
+
+// Alignement des deux classeurs : par position (défaut) ou par clés Date c + Heure
+function getPipelineAlignmentConfig() {
+  if (process.env.PIPELINE_ALIGNMENT !== 'cles') {
+    return { mode: 'position' };
   }
 
+  const alignement = { mode: 'cles', par_poste: process.env.PIPELINE_ALIGNMENT_BY_POSTE === 'true' };
+  if (process.env.PIPELINE_ALIGNMENT_TOLERANCE) {
+    alignement.tolerance = process.env.PIPELINE_ALIGNMENT_TOLERANCE;
+  }
+  return alignement;
+}
+
+// Regroupe les fichiers reçus par ligne : champs file_<ligne>_<1|2>
+function groupFilesByLine(files) {
   const filesByLine = {};
-  req.files.forEach(file => {
+  files.forEach(file => {
     const key = file.fieldname.split('_')[1];
     if (!filesByLine[key]) {
       filesByLine[key] = {};
     }
     const fileIndex = file.fieldname.split('_')[2];
     filesByLine[key][`file${fileIndex}`] = {
-      buffer: file.buffer.toString('base64'),
+      path: file.path,
       originalname: file.originalname
     };
   });
+  return filesByLine;
+}
+
+// Validation rapide d'une paire de classeurs (en-têtes uniquement) par le script Python
+function runValidation(payload) {
+  if (process.env.PIPELINE_SERVICE === 'true') {
+    return submitPipelineJob(payload).then(result => result.verdict);
+  }
+
+  return new Promise((resolve, reject) => {
+    const scriptPath = ['src/utils/full_pipeline_memory.py', 'utils/full_pipeline_memory.py'].find(p => fs.existsSync(p));
+    if (!scriptPath) {
+      return reject(new Error('Fichier de script Python introuvable sur le serveur.'));
+    }
+
+    const pythonProcess = spawn('python', ['-X', 'utf8', scriptPath]);
+    let scriptOutput = '';
+    let scriptError = '';
+    pythonProcess.stdout.on('data', (data) => { scriptOutput += data.toString(); });
+    pythonProcess.stderr.on('data', (data) => { scriptError += data.toString(); });
+    pythonProcess.on('error', reject);
+    pythonProcess.on('close', (code) => {
+      if (code !== 0) {
+        return reject(new Error(scriptError || 'Le script Python a échoué.'));
+      }
+      try {
+        resolve(JSON.parse(scriptOutput.trim().split('\n').pop()));
+      } catch (e) {
+        reject(e);
+      }
+    });
+
+    pythonProcess.stdin.write(JSON.stringify(payload));
+    pythonProcess.stdin.end();
+  });
+}
+
+// Vérifie les paires de classeurs avant de lancer le traitement complet
+export const validatePipelineFiles = async (req, res) => {
+  const filesByLine = groupFilesByLine(req.files || []);
+
+  try {
+    const verdicts = await Promise.all(Object.keys(filesByLine).map(line => {
+      const lineFiles = filesByLine[line];
+      if (!lineFiles.file1 || !lineFiles.file2) {
+        return { valid: false, line, errors: [{ code: 'paire_incomplete', message: 'Paire de fichiers incomplète.' }], warnings: [] };
+      }
+      return runValidation({
+        line,
+        validate_only: true,
+        file1_path: lineFiles.file1.path,
+        file2_path: lineFiles.file2.path
+      });
+    }));
+
+    return res.status(200).json({ valid: verdicts.every(v => v.valid), results: verdicts });
+  } catch (error) {
+    console.error('Erreur lors de la validation des fichiers:', error);
+    return res.status(500).json({ error: 'Erreur lors de la validation des fichiers.', details: error.message });
+  } finally {
+    (req.files || []).forEach(file => fs.promises.unlink(file.path).catch(() => {}));
+  }
+};
+
+export const runPipelineInMemory = (req, res) => {
+  if (pipelineStatus.status === 'running') {
+    return res.status(409).json({ error: "Un processus de fusion est déjà en cours." });
+  }
+
+  const filesByLine = groupFilesByLine(req.files);
 
   const linesProcessed = Object.keys(filesByLine).join(', ');
   const startMessage = `Le processus de fusion des fichiers de la ligne ${linesProcessed} a commencé.`;
@@ -145,28 +250,51 @@ export const runPipelineInMemory = (req, res) => {
         return resolve({ line, status: 'skipped', message: 'Paire de fichiers incomplète.' });
       }
 
-      const worker = new Worker('./src/workers/pipelineWorker.js', {
-        workerData: {
-          line: line,
-          file1_b64: lineFiles.file1.buffer,
-          file2_b64: lineFiles.file2.buffer,
-          originalname1: lineFiles.file1.originalname,
-          originalname2: lineFiles.file2.originalname
-        }
-      });
+      const jobData = {
+        line: line,
+        file1_path: lineFiles.file1.path,
+        file2_path: lineFiles.file2.path,
+        originalname1: lineFiles.file1.originalname,
+        originalname2: lineFiles.file2.originalname,
+        sink: getPipelineSinkConfig(),
+        delta: process.env.PIPELINE_DELTA === 'true',
+        alignement: getPipelineAlignmentConfig(),
+        // Méthodes d'imputation à produire (toutes si non renseigné), ex: PIPELINE_METHODS=4fill,mean
+        methods: process.env.PIPELINE_METHODS ? process.env.PIPELINE_METHODS.split(',').map(m => m.trim()).filter(Boolean) : null,
+        // 'compact' : un document par ligne horaire, valeurs imputées en surcharge (ValueSchema) ;
+        // 'bucket' : un document par jour, méthode et lot d'import, variables en tableaux (collection kpibuckets)
+        layout: process.env.PIPELINE_LAYOUT || null
+      };
 
-      worker.on('message', (message) => {
-        if (message.status === 'success') {
-          processInBatches(message.documents, 500)
-            .then(result => {
-              console.log(`SUCCÈS Ligne ${line}: ${result.inserted} documents insérés, ${result.duplicates} doublons ignorés.`);
-              resolve({ line, status: 'success', inserted: result.inserted, duplicates: result.duplicates });
+      const handleMessage = (message) => {
+        if (message.status === 'success' && message.summary) {
+          const { inserted, duplicates, replaced, batch_id } = message.summary;
+          console.log(`SUCCÈS Ligne ${line}: ${inserted} documents insérés, ${replaced} remplacés, ${duplicates} doublons ignorés.`);
+          resolve({ line, status: 'success', inserted, duplicates, replaced, batch_id });
+        } else if (message.status === 'success') {
+          processInBatches(message.documents, 500, process.env.PIPELINE_DELTA === 'true')
+            .then(async result => {
+              console.log(`SUCCÈS Ligne ${line}: ${result.inserted} documents insérés, ${result.replaced} remplacés, ${result.duplicates} doublons ignorés.`);
+              const batchId = await saveIngestBatch(message.ingestBatch, result);
+              resolve({ line, status: 'success', inserted: result.inserted, duplicates: result.duplicates, replaced: result.replaced, batch_id: batchId });
             })
             .catch(dbError => reject({ line, status: 'error', message: 'Erreur lors de l\'insertion en base de données.', details: dbError.message }));
         } else if (message.status === 'error') {
             reject({ line, status: 'error', message: message.message, details: message.details });
         }
-      });
+      };
+
+      // Mode service : le traitement est confié au processus Python persistant
+      if (process.env.PIPELINE_SERVICE === 'true') {
+        submitPipelineJob(jobData)
+          .then(result => handleMessage({ status: 'success', ...result }))
+          .catch(error => handleMessage({ status: 'error', message: 'Le service pipeline Python a échoué.', details: error.message }));
+        return;
+      }
+
+      const worker = new Worker('./src/workers/pipelineWorker.js', { workerData: jobData });
+
+      worker.on('message', handleMessage);
 
       worker.on('error', (error) => {
         reject({ line, status: 'error', message: 'Erreur inattendue du worker.', details: error.message });
@@ -180,7 +308,12 @@ export const runPipelineInMemory = (req, res) => {
     });
   });
 
+  const removeUploadedFiles = () => {
+    req.files.forEach(file => fs.promises.unlink(file.path).catch(() => {}));
+  };
+
   Promise.all(promises)
+    .finally(removeUploadedFiles)
     .then(results => {
       console.log("Pipeline terminé avec succès sur le serveur.");
       const finalStatus = { status: 'finished', results, error: null };
@@ -188,6 +321,9 @@ export const runPipelineInMemory = (req, res) => {
       setPipelineStatus(finalStatus);
       getIo().emit('pipeline-status-update', finalStatus);
 
+      // Les nouveaux lots sont appliqués aux statistiques suffisantes (lecture des seuls documents du lot)
+      results.filter(r => r.status === 'success').forEach(r => refreshSufficientStatistics(r.line));
+
       const successMessage = `La fusion des fichiers de la ligne ${linesProcessed} est terminée avec succès.`;
       createNotification({
         message: successMessage,
@@ -224,4 +360,26 @@ export const cancelPipeline = (req, res) => {
   }
   
   return res.status(400).json({ error: 'Aucun pipeline en cours d\'exécution' });
-};
\ No newline at end of file
+};
+
+// Annule un import : suppression indexée des documents du lot, le lot est conservé comme trace
+export const rollbackIngestBatch = async (req, res) => {
+  const { batchId } = req.params;
+  try {
+    const batch = await IngestBatch.findById(batchId);
+    if (!batch) {
+      return res.status(404).json({ error: 'Lot d\'import introuvable.' });
+    }
+
+    const rows = await KpiData.deleteMany({ batch_id: batchId });
+    const buckets = await KpiBucket.deleteMany({ batch_id: batchId });
+    const deletedCount = rows.deletedCount + buckets.deletedCount;
+    await IngestBatch.updateOne({ _id: batchId }, { $set: { status: 'rolled_back', deleted_documents: deletedCount } });
+    refreshSufficientStatistics(batch.source_line);
+
+    return res.status(200).json({ message: 'Lot d\'import annulé avec succès', batch_id: batchId, deleted: deletedCount });
+  } catch (error) {
+    console.error('Erreur lors de l\'annulation du lot d\'import:', error);
+    return res.status(500).json({ error: 'Erreur lors de l\'annulation du lot d\'import.' });
+  }
+};
@@ -1,4 +1,5 @@
 import path from 'path';
+import { spawn } from 'child_process';
 import { fileURLToPath } from 'url';
 import { Worker } from 'worker_threads';
 import { StatisticsResult, StatisticsVariable, StatisticsRelation } from '../models/StatisticsResult.js';
@@ -54,8 +55,33 @@ export const getStatistics = async (req, res) => {
   }
 };
 
+// Statistiques suffisantes (collection statistics_sufficient) : application des nouveaux lots
+// d'import, en tâche de fond après un import ou une annulation
+export const refreshSufficientStatistics = (line) => {
+  const scriptPath = path.resolve(__dirname, '../utils/statistics_analyzer.py');
+  const pythonProcess = spawn('python', ['-X', 'utf8', scriptPath, '--update-stats', line], {
+    cwd: path.resolve(__dirname, '..')
+  });
+
+  let stdoutOutput = '';
+  pythonProcess.stdout.on('data', (data) => { stdoutOutput += data.toString(); });
+  pythonProcess.on('error', (err) => {
+    console.error('Impossible de lancer la mise à jour des statistiques suffisantes:', err.message);
+  });
+  pythonProcess.on('close', (code) => {
+    const lastLine = stdoutOutput.trim().split('\n').pop();
+    if (code === 0) {
+      console.log(`[Statistiques suffisantes ${line}] ${lastLine}`);
+    } else {
+      console.error(`[Statistiques suffisantes ${line}] Échec (code ${code}): ${lastLine}`);
+    }
+  });
+};
+
 export const generateStatisticsFromMongoDB = async (req, res) => {
     const { line } = req.params;
+    // scope=variables : variables quantitatives recalculées depuis les statistiques suffisantes
+    const scope = req.query.scope === 'variables' ? 'variables' : 'full';
     const io = getIo();
 
     if (analysisStatus === 'running') {
@@ -73,7 +99,7 @@ export const generateStatisticsFromMongoDB = async (req, res) => {
     });
 
     const worker = new Worker(path.resolve(__dirname, '../workers/analysisWorker.js'), {
-        workerData: { line }
+        workerData: { line, scope }
     });
 
     worker.on('message', (result) => {
@@ -172,4 +198,43 @@ export const getRelationData = async (req, res) => {
     console.error('Erreur dans getRelationData:', error);
     res.status(500).json({ error: 'Erreur serveur lors de la recherche de la relation.' });
   }
-};
\ No newline at end of file
+};
+
+
+// Graphique PNG d'une seule relation, rendu sur demande par statistics_analyzer.py (--chart)
+// et servi depuis son cache (clé : version des données + relation)
+export const getRelationChart = (req, res) => {
+  const { line, var1, var2 } = req.params;
+  const kind = req.query.kind || 'regression';
+  const method = req.query.method || '4fill';
+
+  const scriptPath = path.resolve(__dirname, '../utils/statistics_analyzer.py');
+  const pythonProcess = spawn('python', ['-X', 'utf8', scriptPath, '--chart', line, var1, var2, kind, method], {
+    cwd: path.resolve(__dirname, '..')
+  });
+
+  let stdoutOutput = '';
+  let stderrOutput = '';
+  pythonProcess.stdout.on('data', (data) => { stdoutOutput += data.toString(); });
+  pythonProcess.stderr.on('data', (data) => { stderrOutput += data.toString(); });
+
+  pythonProcess.on('error', (err) => {
+    console.error('Impossible de lancer le rendu du graphique:', err);
+    res.status(500).json({ error: 'Impossible de lancer le script Python.' });
+  });
+
+  pythonProcess.on('close', (code) => {
+    let result;
+    try {
+      result = JSON.parse(stdoutOutput.trim().split('\n').pop());
+    } catch (e) {
+      console.error('Réponse invalide du rendu de graphique:', stderrOutput || stdoutOutput);
+      return res.status(500).json({ error: 'Réponse invalide du script de rendu.' });
+    }
+    if (code !== 0 || result.error) {
+      return res.status(404).json({ error: result.error || `Le rendu a échoué (code: ${code})` });
+    }
+    res.set('X-Chart-Cache', result.cached ? 'hit' : 'miss');
+    res.sendFile(result.chart);
+  });
+};
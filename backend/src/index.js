@@ -2,6 +2,7 @@ import express from 'express';
 import cors from 'cors';
 import dotenv from 'dotenv';
 import { connectDB } from './lib/db.js';
+import { dropLegacyUniqueIndex } from './models/KpiData.js';
 import http from 'http'; 
 import { Server } from 'socket.io'; 
 import path from 'path';
@@ -127,6 +128,7 @@ const startServer = async () => {
   try {
     await connectDB();
     console.log("Connecté avec succès à Azure MongoDB.");
+    await dropLegacyUniqueIndex().catch(error => console.error("Échec de la suppression de l'index unique hérité:", error));
     server.listen(PORT, () => {
       console.log(`Serveur démarré sur http://localhost:${PORT}`);
     });
@@ -0,0 +1,123 @@
+import { spawn } from 'child_process';
+import readline from 'readline';
+import fs from 'fs';
+
+// Service Python persistant : les imports (pandas, numpy, openpyxl) et les plans compilés
+// restent chargés entre deux imports de fichiers.
+let serviceProcess = null;
+let nextJobId = 1;
+const pendingJobs = new Map();
+
+// Délai maximal d'un traitement : au-delà, le job est rejeté même si le service ne répond pas
+const getJobTimeoutMs = () => parseInt(process.env.PIPELINE_JOB_TIMEOUT_MS, 10) || 30 * 60 * 1000;
+
+const getScriptPath = () => {
+  const path1 = 'src/utils/full_pipeline_memory.py';
+  const path2 = 'utils/full_pipeline_memory.py';
+  if (fs.existsSync(path1)) return path1;
+  if (fs.existsSync(path2)) return path2;
+  return null;
+};
+
+const rejectPendingJobs = (message) => {
+  for (const { reject, timer } of pendingJobs.values()) {
+    clearTimeout(timer);
+    reject(new Error(message));
+  }
+  pendingJobs.clear();
+};
+
+const readJobOutput = async (outputPath) => {
+  const documents = [];
+  const lines = readline.createInterface({ input: fs.createReadStream(outputPath, { encoding: 'utf8' }) });
+  for await (const docLine of lines) {
+    if (docLine.trim()) {
+      documents.push(JSON.parse(docLine));
+    }
+  }
+  await fs.promises.unlink(outputPath).catch(() => {});
+  return documents;
+};
+
+const handleResponse = (response) => {
+  const job = pendingJobs.get(response.job_id);
+  if (!job) {
+    // Réponse tardive d'un job expiré : son fichier de sortie n'a plus de lecteur
+    if (response.output) fs.promises.unlink(response.output).catch(() => {});
+    return;
+  }
+  pendingJobs.delete(response.job_id);
+  clearTimeout(job.timer);
+
+  if (response.status !== 'success') {
+    job.reject(new Error(response.message || 'Le script Python a échoué.'));
+  } else if (response.summary) {
+    job.resolve({ summary: response.summary });
+  } else if (response.verdict) {
+    job.resolve({ verdict: response.verdict });
+  } else {
+    readJobOutput(response.output)
+      .then(documents => job.resolve({ documents, ingestBatch: response.ingest_batch }))
+      .catch(job.reject);
+  }
+};
+
+const startService = () => {
+  const scriptPath = getScriptPath();
+  if (!scriptPath) {
+    throw new Error('Fichier de script Python introuvable sur le serveur.');
+  }
+
+  const workers = process.env.PIPELINE_SERVICE_WORKERS || '3';
+  console.log(`[Service pipeline] Démarrage avec ${workers} workers : ${scriptPath}`);
+  const child = spawn('python', ['-X', 'utf8', scriptPath, '--service', '--workers', workers]);
+
+  readline.createInterface({ input: child.stdout }).on('line', (responseLine) => {
+    try {
+      handleResponse(JSON.parse(responseLine));
+    } catch (e) {
+      console.error('[Service pipeline] Réponse invalide:', e.message);
+    }
+  });
+  child.stderr.on('data', (data) => { process.stderr.write(data); });
+
+  // Écriture vers un service arrêté (EPIPE) : sans gestionnaire, l'erreur ferait tomber Node
+  child.stdin.on('error', (err) => {
+    console.error('[Service pipeline] Écriture impossible vers le processus Python:', err.message);
+    if (serviceProcess === child) serviceProcess = null;
+    rejectPendingJobs('Le service pipeline Python ne reçoit plus de traitements.');
+    child.kill();
+  });
+  child.on('error', (err) => {
+    console.error('[Service pipeline] Impossible de lancer le processus Python:', err.message);
+  });
+  child.on('exit', (code) => {
+    console.error(`[Service pipeline] Arrêt du processus Python (code ${code}).`);
+    if (serviceProcess === child) serviceProcess = null;
+    rejectPendingJobs('Le service pipeline Python s\'est arrêté.');
+  });
+
+  return child;
+};
+
+// Soumet un traitement au service ; résout { documents, ingestBatch } ou { summary } (mode sink MongoDB)
+export const submitPipelineJob = (payload) => {
+  return new Promise((resolve, reject) => {
+    try {
+      if (!serviceProcess) {
+        serviceProcess = startService();
+      }
+    } catch (e) {
+      return reject(e);
+    }
+
+    const jobId = nextJobId++;
+    const timeoutMs = getJobTimeoutMs();
+    const timer = setTimeout(() => {
+      if (!pendingJobs.delete(jobId)) return;
+      reject(new Error(`Le service pipeline Python n'a pas répondu en ${Math.round(timeoutMs / 1000)} s.`));
+    }, timeoutMs);
+    pendingJobs.set(jobId, { resolve, reject, timer });
+    serviceProcess.stdin.write(JSON.stringify({ ...payload, job_id: jobId }) + '\n');
+  });
+};
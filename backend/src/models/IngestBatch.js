@@ -0,0 +1,33 @@
+import mongoose from 'mongoose';
+
+// Lot d'import : un enregistrement par exécution du pipeline (fichiers sources, empreintes,
+// durées et nombres de lignes par étape). Les documents kpidatas ne portent que son batch_id.
+const IngestBatchSchema = new mongoose.Schema({
+  _id: { type: String, required: true },
+  source_line: { type: String, required: true, enum: ['D', 'E', 'F'] },
+  original_filenames: {
+    file1: String,
+    file2: String
+  },
+  content_hashes: {
+    file1: String,
+    file2: String
+  },
+  imputation_methods: [String],
+  layout: String,
+  delta: Boolean,
+  status: { type: String, default: 'completed' },
+  started_at: Date,
+  finished_at: Date,
+  timings: Object,
+  rows: Object,
+  summary: Object
+}, {
+  strict: false,
+  timestamps: true,
+  collection: 'ingest_batches'
+});
+
+const IngestBatch = mongoose.model('IngestBatch', IngestBatchSchema);
+
+export default IngestBatch;
@@ -0,0 +1,44 @@
+import mongoose from 'mongoose';
+
+// Disposition 'bucket' : un document par ligne, jour, méthode d'imputation et lot d'import. Chaque
+// variable (sous `values`, mêmes chemins imbriqués que kpidatas) est un tableau aligné sur hour_index.
+// Les heures d'un même jour importées en plusieurs fois sont réparties entre les buckets de chaque lot
+// (une heure n'est stockée qu'une fois) : l'annulation d'un lot reste un deleteMany sur batch_id.
+const KpiBucketSchema = new mongoose.Schema({
+  source_line: { type: String, required: true, enum: ['D', 'E', 'F'] },
+  batch_id: { type: String },
+  layout: { type: String, default: 'bucket' },
+  imputation_method: { type: String, required: true },
+  day: { type: String },
+  hour_index: [Number],
+  values: { type: mongoose.Schema.Types.Mixed }
+}, {
+  strict: false,
+  timestamps: true
+});
+
+// Lecture d'une ligne et d'une méthode, dans l'ordre chronologique des jours
+KpiBucketSchema.index(
+  { 
+    source_line: 1, 
+    imputation_method: 1,
+    day: 1 
+  }, 
+  { 
+    background: true 
+  }
+);
+
+// Annulation ou réimport d'un lot : suppression indexée par batch_id
+KpiBucketSchema.index(
+  { 
+    batch_id: 1 
+  }, 
+  { 
+    background: true 
+  }
+);
+
+const KpiBucket = mongoose.model('KpiBucket', KpiBucketSchema);
+
+export default KpiBucket;
@@ -17,10 +17,8 @@ const KpiDataSchema = new mongoose.Schema({
 
   source_line: { type: String, required: true, enum: ['D', 'E', 'F'] },
   import_date: { type: Date, default: Date.now },
-  original_filenames: {
-    file1: String,
-    file2: String
-  },
+  // Lot d'import (ingest_batches) : fichiers sources, empreintes et durées du traitement
+  batch_id: { type: String },
   
   // Champs pour l'identification unique
   date_c: { type: Date, required: true },
@@ -37,23 +35,65 @@ const KpiDataSchema = new mongoose.Schema({
 });
 
 
+// L'unicité (source_line, date_c, mois, date_num, semaine, poste, heure, imputation_method)
+// est portée par _id, empreinte de ces champs calculée par full_pipeline_memory.py.
+// Cet index sert uniquement les lectures par ligne et méthode d'imputation.
 KpiDataSchema.index(
   { 
     source_line: 1, 
-    date_c: 1, 
-    mois: 1, 
-    date_num: 1, 
-    semaine: 1, 
-    poste: 1, 
-    heure: 1,
     imputation_method: 1 
   }, 
   { 
-    unique: true,
+    background: true 
+  }
+);
+
+// Lecture des documents compacts (layout 'compact' : un document par ligne horaire,
+// valeurs imputées sous forme de ValueSchema)
+KpiDataSchema.index(
+  { 
+    source_line: 1, 
+    layout: 1 
+  }, 
+  { 
+    background: true 
+  }
+);
+
+// Recherche des empreintes de lignes brutes déjà importées (mode delta)
+KpiDataSchema.index(
+  { 
+    source_line: 1, 
+    row_fingerprint: 1 
+  }, 
+  { 
+    background: true 
+  }
+);
+
+// Annulation ou réimport d'un lot : suppression indexée par batch_id
+KpiDataSchema.index(
+  { 
+    batch_id: 1 
+  }, 
+  { 
     background: true 
   }
 );
 
 const KpiData = mongoose.model('KpiData', KpiDataSchema);
 
+// Ancien index unique sur les 8 champs d'unicité (avant le _id déterministe) : toujours présent
+// sur une base existante, il rejetterait les upserts par _id. Supprimé au démarrage du serveur ;
+// les doublons hérités (_id aléatoire) sont retirés par `full_pipeline_memory.py --migrate-ids`.
+export const dropLegacyUniqueIndex = async () => {
+  const indexes = await KpiData.collection.indexes().catch(() => []);
+  for (const index of indexes) {
+    if (index.unique && index.key.date_c && index.key.heure && index.key.imputation_method) {
+      await KpiData.collection.dropIndex(index.name);
+      console.log(`Index unique hérité supprimé de kpidatas : ${index.name}`);
+    }
+  }
+};
+
 export default KpiData;
\ No newline at end of file
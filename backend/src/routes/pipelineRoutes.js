@@ -2,15 +2,19 @@
 
 import express from 'express';
 import multer from 'multer';
-import { runPipelineInMemory,getPipelineStatus,cancelPipeline} from '../controllers/pipelineController.js';
+import os from 'os';
+import { runPipelineInMemory,getPipelineStatus,cancelPipeline,rollbackIngestBatch,validatePipelineFiles} from '../controllers/pipelineController.js';
 
 const router = express.Router();
 
-// Configuration de Multer pour garder les fichiers en mémoire (RAM)
-const storage = multer.memoryStorage();
+// Configuration de Multer : fichiers écrits dans le répertoire temporaire, le pipeline Python
+// les lit directement sur disque (supprimés à la fin du traitement)
+const storage = multer.diskStorage({ destination: os.tmpdir() });
 const upload = multer({ storage: storage });
 
 router.post('/run-in-memory', upload.any(), runPipelineInMemory);
+router.post('/validate', upload.any(), validatePipelineFiles);
 router.get('/status', getPipelineStatus); 
 router.post('/cancel', cancelPipeline);
+router.delete('/batches/:batchId', rollbackIngestBatch);
 export default router;
\ No newline at end of file
@@ -3,6 +3,7 @@ import {
   getStatistics, 
   getVariableNames, 
   getRelationData, 
+  getRelationChart,
   generateStatisticsFromMongoDB
 } from '../controllers/statisticsController.js';
 
@@ -11,6 +12,7 @@ const router = express.Router();
 router.get('/:line', getStatistics);
 router.get('/variable-names/:line', getVariableNames);
 router.get('/relations/:line/:var1/:var2', getRelationData);
+router.get('/charts/:line/:var1/:var2', getRelationChart);
 router.post('/generate/:line', generateStatisticsFromMongoDB);
 
 export default router;
\ No newline at end of file
@@ -0,0 +1,44 @@
+import os
+from pathlib import Path
+
+# Taille bornée des caches disque (données nettoyées en Parquet et plans de fusion de
+# full_pipeline_memory.py, graphiques rendus de statistics_analyzer.py) : au-delà de
+# PIPELINE_CACHE_MAX_MB par répertoire, les entrées les moins récemment utilisées sont supprimées
+TAILLE_MAX_CACHE_MO = float(os.getenv('PIPELINE_CACHE_MAX_MB', '1024'))
+
+def marquer_utilise(fichier):
+    """Met à jour la date de modification d'une entrée relue depuis le cache :
+    l'éviction (limiter_cache) retire d'abord les entrées les moins récemment utilisées"""
+    try:
+        os.utime(fichier)
+    except OSError:
+        pass
+
+def limiter_cache(repertoire, motif, garder=None, taille_max_mo=TAILLE_MAX_CACHE_MO):
+    """Supprime les fichiers `motif` de `repertoire` par date de modification croissante jusqu'à
+    ce que leur taille totale ne dépasse plus taille_max_mo (0 : pas de limite). L'entrée
+    `garder` (celle qui vient d'être écrite) n'est jamais supprimée. Retourne le nombre de
+    fichiers supprimés"""
+    if taille_max_mo <= 0:
+        return 0
+    entrees = []
+    for fichier in Path(repertoire).glob(motif):
+        try:
+            etat = fichier.stat()
+        except FileNotFoundError:
+            # Supprimé entre-temps par un autre processus
+            continue
+        entrees.append((etat.st_mtime, etat.st_size, fichier))
+
+    total = sum(taille for _, taille, _ in entrees)
+    limite = taille_max_mo * 1024 * 1024
+    supprimes = 0
+    for _, taille, fichier in sorted(entrees):
+        if total <= limite:
+            break
+        if garder is not None and fichier == Path(garder):
+            continue
+        fichier.unlink(missing_ok=True)
+        total -= taille
+        supprimes += 1
+    return supprimes
@@ -4,10 +4,21 @@ import sys
 import json
 import re
 import base64
+import hashlib
+import tempfile
+import time
+import tracemalloc
+import cProfile
+from contextlib import contextmanager
+import uuid
+from datetime import datetime, timezone
 import io
 import warnings
 from pathlib import Path
 import logging
+import os
+import openpyxl
+from cache_disque import limiter_cache, marquer_utilise
 
 # Configuration des logs
 logging.basicConfig(
@@ -45,11 +56,105 @@ exclude_cols = [
     ('107 D', 'Unnamed: 5_level_1', 'Heure'),
 ]
 
+# Méthodes d'imputation produites par le pipeline
+METHODES_IMPUTATION = ['mean', 'mode', 'median', 'ffill', '4fill']
+# Variante sans imputation (valeurs nettoyées), utilisée par la disposition compacte
+METHODE_ORIGINALE = 'original'
+
+# Méthode 4fill - seulement 4 colonnes spécifiques avec ffill
+COLONNES_4FILL = [
+    ('PRODUIT FINI TSP', 'Détermination', '%P2O5  TOT PF'),
+    ('ACIDE PHOSPHORIQUE', 'Picage AR29', '%P2O5 AR29'),
+    ('ACIDE PHOSPHORIQUE', 'Picage AR29', 'Densité AR29'),
+    ('PHOSPHATE BROYE', 'Phosphate brute broyé', '%P2O5 TOT broyé')
+]
+
+# Nombre de lignes Excel converties à la fois lors du chargement en streaming
+TAILLE_BLOC_LIGNES = 2000
+
+# Valeurs textuelles considérées comme manquantes (mêmes valeurs par défaut que pd.read_excel)
+VALEURS_NA_EXCEL = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+}
+
 # Fonctions utilitaires
 def debug_print(message):
     """Print debug messages to stderr instead of stdout"""
     print(message, file=sys.stderr)
 
+# Instrumentation : mesures par étape (temps, CPU, mémoire tracée, lignes), activées par
+# payload.metrics ou PIPELINE_METRICS ('stderr' ou 'mongodb'). None si inactives.
+MESURES = None
+NOM_COLLECTION_METRIQUES = 'ingest_metrics'
+
+@contextmanager
+def mesurer_etape(nom, lignes_entree=None, cumul=None):
+    """
+    Mesure une étape : temps écoulé, temps CPU, pic de mémoire tracée (tracemalloc, étapes
+    imbriquées comprises) et lignes en entrée/sortie (`rows_out` à renseigner par l'appelant
+    dans l'enregistrement retourné). Avec `cumul`, les mesures s'ajoutent à cet enregistrement.
+    Sans mesures actives, ne fait rien.
+    """
+    if MESURES is None:
+        yield {}
+        return
+
+    if cumul is None:
+        enregistrement = {'stage': nom, 'rows_in': lignes_entree, 'rows_out': None,
+                          'wall_s': 0.0, 'cpu_s': 0.0, 'peak_traced_mb': 0.0}
+        MESURES['stages'].append(enregistrement)
+    else:
+        enregistrement = cumul
+
+    # Le pic de l'étape englobante est conservé avant la remise à zéro pour cette étape
+    pics = MESURES['pics']
+    if pics:
+        pics[-1] = max(pics[-1], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    pics.append(0)
+    debut_mur = time.perf_counter()
+    debut_cpu = time.process_time()
+    try:
+        yield enregistrement
+    finally:
+        enregistrement['wall_s'] = round(enregistrement['wall_s'] + time.perf_counter() - debut_mur, 4)
+        enregistrement['cpu_s'] = round(enregistrement['cpu_s'] + time.process_time() - debut_cpu, 4)
+        pic = max(tracemalloc.get_traced_memory()[1], pics.pop())
+        if pics:
+            pics[-1] = max(pics[-1], pic)
+        enregistrement['peak_traced_mb'] = max(enregistrement['peak_traced_mb'], round(pic / 2**20, 2))
+
+def etape_cumulee(nom, lignes_entree=None):
+    """
+    Enregistrement d'une étape mesurée en plusieurs fois (mesurer_etape(nom, cumul=...)),
+    None sans mesures actives.
+    """
+    if MESURES is None:
+        return None
+    cumul = {'stage': nom, 'rows_in': lignes_entree, 'rows_out': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_traced_mb': 0.0}
+    MESURES['stages'].append(cumul)
+    return cumul
+
+def iterer_mesure(nom, lots, lignes_entree=None):
+    """
+    Parcourt un générateur de lots de documents en ne mesurant que leur production
+    (sérialisation), pas leur écriture par l'appelant.
+    """
+    if MESURES is None:
+        yield from lots
+        return
+
+    cumul = etape_cumulee(nom, lignes_entree)
+    iterateur = iter(lots)
+    while True:
+        with mesurer_etape(nom, cumul=cumul):
+            documents = next(iterateur, None)
+        if documents is None:
+            return
+        cumul['rows_out'] += len(documents)
+        yield documents
+
 def nettoyer_nom_colonne(col):
     if isinstance(col, tuple):
         col = '_'.join(str(c) for c in col if c)
@@ -120,20 +225,215 @@ def nettoyage_personnalise(val):
 
     return val
 
-# Fonctions de traitement
-def traiter_fusion(ligne, file1_content, file2_content):
+def nettoyage_bloc_vectorise(df_bloc):
     """
-    Fonction pour charger, fusionner et exporter les fichiers pour une ligne donnée.
+    Applique les règles de nettoyage_personnalise puis pd.to_numeric sur un bloc
+    de colonnes objet en une seule passe. Seules les cellules texte passent par les
+    expressions régulières, les autres valeurs sont converties directement.
+    Retourne un tableau float64 de même forme que le bloc.
     """
-    debug_print(f"\n{'='*20} Début du traitement pour la Ligne {ligne} {'='*20}")
+    n_lignes, n_cols = df_bloc.shape
+    plat = pd.Series(df_bloc.to_numpy(dtype=object).ravel(order='F'), dtype=object)
 
-    # ---  Chargement des fichiers ---
-    debug_print(f"Chargement des fichiers pour la ligne {ligne}...")
-    df = pd.read_excel(io.BytesIO(file1_content), header=[0, 1, 2])
-    df1 = pd.read_excel(io.BytesIO(file2_content), header=[0, 1])
-    df = df.iloc[:, 1:]
-    df1 = df1.iloc[:, 1:]
+    # L'accesseur .str n'est disponible que si le bloc contient du texte
+    if pd.api.types.infer_dtype(plat, skipna=True) in ('string', 'mixed', 'mixed-integer'):
+        textes = plat.str.strip()
+        est_texte = textes.notna()
+        textes = (
+            textes[est_texte]
+            .str.rstrip('/')
+            .str.replace(r'^(\d+)\./(\d+)$', r'\1.\2', regex=True)
+            .str.replace(r'\.\.+', '.', regex=True)
+            .str.replace(r'(?<!^)[\+\-]', '', regex=True)
+            .str.replace(',', '.', regex=False)
+        )
+        # Les marqueurs '**', '--', 'NaN', 'NULL'... deviennent NaN via errors='coerce'
+        plat[est_texte] = textes
+
+    valeurs = pd.to_numeric(plat, errors='coerce').to_numpy(dtype='float64')
+    return valeurs.reshape((n_lignes, n_cols), order='F')
+
+# Chargement des classeurs en streaming
+def convertir_cellule(cell):
+    """
+    Convertit une cellule openpyxl comme le fait pd.read_excel.
+    """
+    if cell.value is None:
+        return ""
+    if cell.data_type == 'e':
+        return np.nan
+    if cell.data_type == 'n':
+        val = int(cell.value)
+        if val == cell.value:
+            return val
+        return float(cell.value)
+    return cell.value
 
+def lire_entetes(lignes, nb_niveaux):
+    """
+    Lit les lignes d'en-tête une seule fois et construit les tuples du MultiIndex
+    (remplissage des cellules fusionnées, noms 'Unnamed: i_level_j', doublons suffixés).
+    """
+    entetes = []
+    for _ in range(nb_niveaux):
+        row = [convertir_cellule(cell) for cell in next(lignes, ())]
+        while row and row[-1] == "":
+            row.pop()
+        entetes.append(row)
+
+    largeur = max((len(row) for row in entetes), default=0)
+    if largeur == 0:
+        raise ValueError("En-têtes introuvables dans le classeur")
+
+    control_row = [True] * largeur
+    niveaux = []
+    for level, row in enumerate(entetes):
+        row = row + [""] * (largeur - len(row))
+        last = row[0]
+        for i in range(1, largeur):
+            if not control_row[i]:
+                last = row[i]
+            if row[i] == "" or row[i] is None:
+                row[i] = last
+            else:
+                control_row[i] = False
+                last = row[i]
+        niveaux.append([
+            f"Unnamed: {i}_level_{level}" if c == "" else c
+            for i, c in enumerate(row)
+        ])
+
+    colonnes = []
+    counts = {}
+    for col in zip(*niveaux):
+        cur_count = counts.get(col, 0)
+        while cur_count > 0:
+            counts[col] = cur_count + 1
+            col = (*col[:-1], f"{col[-1]}.{cur_count}")
+            cur_count = counts.get(col, 0)
+        colonnes.append(col)
+        counts[col] = cur_count + 1
+    return colonnes
+
+def typer_colonne(values):
+    """
+    Convertit une colonne brute (objets) en numérique si possible, sinon infère son type.
+    """
+    serie = pd.Series(values, dtype='object')
+    serie = serie.mask(serie.isin(VALEURS_NA_EXCEL), np.nan)
+    try:
+        return pd.to_numeric(serie)
+    except (ValueError, TypeError):
+        return serie.infer_objects()
+
+def bloc_vers_dataframe(bloc, colonnes):
+    """
+    Construit le DataFrame d'un bloc de lignes, colonne par colonne.
+    """
+    largeur = len(colonnes)
+    data = np.full((len(bloc), largeur), "", dtype=object)
+    for i, row in enumerate(bloc):
+        row = row[:largeur]
+        data[i, :len(row)] = row
+    df_bloc = pd.DataFrame(
+        {j: typer_colonne(data[:, j]) for j in range(largeur)}
+    )
+    df_bloc.columns = pd.MultiIndex.from_tuples(colonnes)
+    return df_bloc
+
+@contextmanager
+def ouvrir_classeur(file_content):
+    """
+    Ouvre un classeur en lecture seule depuis son contenu (bytes) ou son chemin sur disque.
+    Un chemin est ouvert en binaire et passé à openpyxl comme flux : les fichiers déposés par
+    multer n'ont pas d'extension, et openpyxl refuse un nom de fichier sans .xlsx/.xlsm.
+    """
+    source = io.BytesIO(file_content) if isinstance(file_content, (bytes, bytearray)) else open(file_content, 'rb')
+    try:
+        wb = openpyxl.load_workbook(source, read_only=True, data_only=True, keep_links=False)
+        try:
+            yield wb
+        finally:
+            wb.close()
+    finally:
+        source.close()
+
+def iterer_blocs_excel(file_content, nb_niveaux, taille_bloc=TAILLE_BLOC_LIGNES):
+    """
+    Parcourt la première feuille d'un classeur en mode read-only et produit les données
+    par blocs de `taille_bloc` lignes. Les lignes vides en fin de feuille sont ignorées.
+    `file_content` est le contenu du classeur (bytes) ou son chemin sur disque ; un chemin
+    est lu directement dans le fichier, sans copie en mémoire.
+    """
+    with ouvrir_classeur(file_content) as wb:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        lignes = ws.iter_rows()
+        colonnes = lire_entetes(lignes, nb_niveaux)
+
+        bloc = []
+        lignes_vides = 0
+        nb_blocs = 0
+        for cells in lignes:
+            row = [convertir_cellule(cell) for cell in cells]
+            while row and row[-1] == "":
+                row.pop()
+            if not row:
+                lignes_vides += 1
+                continue
+            # Les lignes vides intermédiaires sont conservées, seules celles de fin sont supprimées
+            bloc.extend([[]] * lignes_vides)
+            lignes_vides = 0
+            bloc.append(row)
+            if len(bloc) >= taille_bloc:
+                yield bloc_vers_dataframe(bloc, colonnes)
+                nb_blocs += 1
+                bloc = []
+        if bloc or nb_blocs == 0:
+            yield bloc_vers_dataframe(bloc, colonnes)
+
+def charger_excel_streaming(file_content, nb_niveaux, taille_bloc=TAILLE_BLOC_LIGNES):
+    """
+    Charge un classeur avec un en-tête sur `nb_niveaux` lignes sans passer par pd.read_excel.
+    Seul un bloc de lignes brutes (cellules openpyxl) est en mémoire à la fois : chaque bloc est
+    typé dès sa lecture et n'en sont gardées que les colonnes typées, assemblées colonne par
+    colonne à la fin (surcoût transitoire d'une colonne, au lieu d'une copie du tableau entier).
+    """
+    colonnes = None
+    morceaux = []
+    for bloc in iterer_blocs_excel(file_content, nb_niveaux, taille_bloc):
+        if colonnes is None:
+            colonnes = bloc.columns
+            morceaux = [[] for _ in range(bloc.shape[1])]
+        # Copie par colonne : le bloc (tableaux 2D par type) est libéré avant la lecture du suivant
+        for j in range(bloc.shape[1]):
+            morceaux[j].append(pd.Series(bloc.iloc[:, j].to_numpy(copy=True)))
+        del bloc
+
+    if len(morceaux) == 0 or len(morceaux[0]) == 1:
+        df = pd.DataFrame({j: pieces[0] for j, pieces in enumerate(morceaux)}, copy=False)
+        df.columns = colonnes
+        return df
+
+    donnees = {}
+    for j in range(len(morceaux)):
+        pieces, morceaux[j] = morceaux[j], None
+        serie = pd.concat(pieces, ignore_index=True)
+        del pieces
+        # Un type peut différer d'un bloc à l'autre (ex: bloc entièrement vide) : on le réinfère
+        if serie.dtype == 'object':
+            serie = typer_colonne(serie.to_numpy())
+        donnees[j] = serie
+    df = pd.DataFrame(donnees, copy=False)
+    df.columns = colonnes
+    return df
+
+def resoudre_plan_fusion(ligne, colonnes_df1):
+    """
+    Résout les en-têtes du fichier PI pour une ligne : positions des colonnes à ajouter
+    et nouveaux noms à trois niveaux ('Valeurs', description, nom). Le résultat ne dépend
+    que des en-têtes et de la ligne (voir charger_plan_fusion).
+    """
     # ---  Modèle de base pour le mappage des en-têtes ---
     header_mapping_template = {
         'Production TSP balance T/H': 'J_107DEF_107DWI407_B',
@@ -221,19 +521,213 @@ def traiter_fusion(ligne, file1_content, file2_content):
     ]
     
     colonnes_deja_vues_df1 = [col[1] for col in colonnes_identiques_df1]
-    colonnes_a_ajouter = [col for col in df1.columns if col not in colonnes_deja_vues_df1]
+    positions_a_ajouter = [j for j, col in enumerate(colonnes_df1) if col not in colonnes_deja_vues_df1]
     new_cols = []
     
-    for col in colonnes_a_ajouter:
-        level_2_name = col[1].strip()
+    for j in positions_a_ajouter:
+        level_2_name = colonnes_df1[j][1].strip()
         level_1_name = header_mapping_dynamique.get(level_2_name, 'Description Manquante')
         new_cols.append(('Valeurs', level_1_name, level_2_name))
-    
-    df1_filtered = df1[colonnes_a_ajouter].copy()
-    df1_filtered.columns = pd.MultiIndex.from_tuples(new_cols)
+
+    return {
+        'positions': positions_a_ajouter,
+        'colonnes': new_cols,
+        'exclues': [str(col) for col in colonnes_deja_vues_df1],
+    }
+
+# Cache sur disque des plans de fusion, indexé par l'empreinte de la disposition des en-têtes
+# (taille bornée par PIPELINE_CACHE_MAX_MB, voir cache_disque.py)
+REPERTOIRE_CACHE_PLANS = Path(os.getenv('PIPELINE_CACHE_DIR', tempfile.gettempdir())) / 'kpi_plans_fusion'
+
+# À incrémenter quand resoudre_plan_fusion (ou le format du plan) change de résultat
+VERSION_PLAN_FUSION = 1
+
+def empreinte_disposition(ligne, colonnes_df, colonnes_df1):
+    """
+    Empreinte de la disposition des deux classeurs : version du plan, en-têtes LIMS et PI
+    et lettre de la ligne.
+    """
+    forme = json.dumps(
+        [VERSION_PLAN_FUSION, ligne,
+         [list(map(repr, col)) for col in colonnes_df], [list(map(repr, col)) for col in colonnes_df1]],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(forme.encode('utf-8')).hexdigest()
+
+def charger_plan_fusion(ligne, colonnes_df, colonnes_df1):
+    """
+    Retourne le plan de fusion depuis le cache (mémoire puis disque) si la disposition a
+    déjà été vue, sinon le résout et l'enregistre.
+    """
+    empreinte = empreinte_disposition(ligne, colonnes_df, colonnes_df1)
+    fichier = REPERTOIRE_CACHE_PLANS / f'{empreinte}.json'
+
+    def construire():
+        try:
+            with open(fichier, encoding='utf-8') as f:
+                plan = json.load(f)
+            marquer_utilise(fichier)
+            debug_print(f"Plan de fusion {empreinte[:12]} chargé depuis le cache.")
+            return {**plan, 'colonnes': [tuple(col) for col in plan['colonnes']]}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            debug_print(f"Cache du plan de fusion illisible ({fichier}): {str(e)}")
+
+        plan = resoudre_plan_fusion(ligne, colonnes_df1)
+        # Écriture atomique (fichier temporaire propre au processus puis os.replace) : les
+        # workers du service et du manifeste partagent ce répertoire
+        temporaire = fichier.with_suffix(f'.{os.getpid()}.tmp')
+        try:
+            REPERTOIRE_CACHE_PLANS.mkdir(parents=True, exist_ok=True)
+            with open(temporaire, 'w', encoding='utf-8') as f:
+                json.dump(plan, f, ensure_ascii=False)
+            os.replace(temporaire, fichier)
+            limiter_cache(REPERTOIRE_CACHE_PLANS, '*.json', garder=fichier)
+        except Exception as e:
+            debug_print(f"Impossible d'écrire le cache du plan de fusion: {str(e)}")
+            temporaire.unlink(missing_ok=True)
+        return plan
+
+    return plan_en_cache('fusion', empreinte, construire)
+
+# Alignement des deux classeurs par clé temporelle (Date c + Heure) au lieu de la position
+TOLERANCE_ALIGNEMENT = '30min'
+
+def position_colonne(colonnes, noms):
+    """
+    Position de la première colonne dont le dernier niveau (sans espaces) est dans `noms`.
+    """
+    for j, col in enumerate(colonnes):
+        if str(col[-1]).strip() in noms:
+            return j
+    return None
+
+def heures_depuis_colonne(serie):
+    """
+    Convertit une colonne Heure ('01:00', 1, 0.0416 (fraction de jour Excel), time(1, 0)...)
+    en nombre d'heures décimal. Les valeurs illisibles deviennent NaN.
+    """
+    nombres = pd.to_numeric(serie, errors='coerce')
+    # Fraction de jour Excel (0 <= x < 1) hors valeur entière 0
+    fractions = (nombres > 0) & (nombres < 1)
+    nombres = nombres.where(~fractions, nombres * 24)
+
+    textes = serie.where(nombres.isna()).astype(str)
+    extraits = textes.str.extract(r'^\s*(\d{1,2})\s*(?:[:hH]\s*(\d{1,2}))?')
+    depuis_texte = pd.to_numeric(extraits[0], errors='coerce') + pd.to_numeric(extraits[1], errors='coerce').fillna(0) / 60
+
+    heures = nombres.fillna(depuis_texte)
+    return heures.where((heures >= 0) & (heures < 24))
+
+def cles_temporelles(df, noms_date, noms_heure=('Heure',)):
+    """
+    Clé d'alignement de chaque ligne : jour de Date c + Heure si l'heure est lisible,
+    sinon l'horodatage complet de Date c. NaT si la date est absente ou illisible.
+    """
+    j_date = position_colonne(df.columns, noms_date)
+    if j_date is None:
+        raise ValueError(f"Colonne de date introuvable pour l'alignement ({', '.join(noms_date)})")
+    dates = pd.to_datetime(df.iloc[:, j_date], errors='coerce')
+
+    j_heure = position_colonne(df.columns, noms_heure)
+    if j_heure is None:
+        return dates.reset_index(drop=True)
+    heures = heures_depuis_colonne(df.iloc[:, j_heure])
+    cles = dates.dt.normalize() + pd.to_timedelta(heures, unit='h')
+    return cles.fillna(dates).reset_index(drop=True)
+
+def aligner_par_cles(df, df1, df1_filtered, options):
+    """
+    Aligne les lignes PI (df1_filtered) sur les lignes LIMS (df) par merge_asof sur la clé
+    temporelle, avec tolérance, éventuellement par Poste. Les clés sont triées une seule
+    fois (O(n log n)), aucun tri si elles le sont déjà. Seule la première ligne PI d'une clé
+    en double est appariée.
+    Retourne (df1 aligné sur df, rapport des lignes non appariées).
+    """
+    tolerance = pd.Timedelta(options.get('tolerance', TOLERANCE_ALIGNEMENT))
+    gauche = pd.DataFrame({'cle': cles_temporelles(df, ('Date c',)), 'position_gauche': np.arange(len(df))})
+    droite = pd.DataFrame({'cle': cles_temporelles(df1, ('Date c', 'Date pi')), 'position_droite': np.arange(len(df1))})
+
+    par = None
+    if options.get('par_poste'):
+        par = 'poste'
+        for cadre, source in ((gauche, df), (droite, df1)):
+            j_poste = position_colonne(source.columns, ('Poste',))
+            postes = source.iloc[:, j_poste] if j_poste is not None else pd.Series(None, index=source.index)
+            cadre['poste'] = postes.astype(str).str.strip().str.upper().to_numpy()
+
+    gauche_valide = gauche.dropna(subset=['cle'])
+    droite_valide = droite.dropna(subset=['cle'])
+    # merge_asof ne retiendrait qu'une ligne PI par clé, sans le signaler : les doublons
+    # sont écartés explicitement, la première ligne du classeur est conservée
+    doublons_droite = droite_valide.duplicated(subset=['cle'] + ([par] if par else []))
+    if doublons_droite.any():
+        debug_print(f"Alignement par clés: {int(doublons_droite.sum())} lignes PI en double sur la clé ignorées.")
+        droite_valide = droite_valide[~doublons_droite]
+    if not gauche_valide['cle'].is_monotonic_increasing:
+        gauche_valide = gauche_valide.sort_values('cle', kind='mergesort')
+    if not droite_valide['cle'].is_monotonic_increasing:
+        droite_valide = droite_valide.sort_values('cle', kind='mergesort')
+
+    appariement = pd.merge_asof(
+        gauche_valide, droite_valide, on='cle', by=par,
+        direction='nearest', tolerance=tolerance
+    )
+    positions = np.full(len(df), -1, dtype='int64')
+    apparies = appariement['position_droite'].notna().to_numpy()
+    positions[appariement['position_gauche'].to_numpy()[apparies]] = appariement['position_droite'].to_numpy()[apparies].astype('int64')
+
+    # Les lignes sans correspondance reçoivent des valeurs PI vides
+    df1_aligne = df1_filtered.reset_index(drop=True).reindex(positions).reset_index(drop=True)
+
+    non_apparies_gauche = appariement.loc[~apparies, 'cle']
+    utilisees = np.zeros(len(df1), dtype=bool)
+    utilisees[positions[positions >= 0]] = True
+    non_utilisees = droite_valide.loc[~utilisees[droite_valide['position_droite'].to_numpy()], 'cle']
+    rapport = {
+        'lignes_lims_sans_cle': int(gauche['cle'].isna().sum()),
+        'lignes_pi_sans_cle': int(droite['cle'].isna().sum()),
+        'lignes_lims_non_appariees': int(len(non_apparies_gauche)),
+        'lignes_pi_non_utilisees': int(len(non_utilisees)),
+        'lignes_pi_doublons': int(doublons_droite.sum()),
+        'exemples_lims_non_appariees': [str(c) for c in non_apparies_gauche.head(5)],
+        'exemples_pi_non_utilisees': [str(c) for c in non_utilisees.head(5)],
+    }
+    return df1_aligne, rapport
+
+# Fonctions de traitement
+def traiter_fusion(ligne, file1_content, file2_content, alignement=None):
+    """
+    Fonction pour charger, fusionner et exporter les fichiers pour une ligne donnée.
+    Par défaut les deux fichiers sont alignés par position ; avec alignement={'mode': 'cles'}
+    ils sont joints sur Date c + Heure (voir aligner_par_cles).
+    """
+    debug_print(f"\n{'='*20} Début du traitement pour la Ligne {ligne} {'='*20}")
+
+    # ---  Chargement des fichiers ---
+    debug_print(f"Chargement des fichiers pour la ligne {ligne}...")
+    with mesurer_etape('fusion.lecture_lims') as mesure:
+        df = charger_excel_streaming(file1_content, 3)
+        mesure['rows_out'] = len(df)
+    with mesurer_etape('fusion.lecture_pi') as mesure:
+        df1 = charger_excel_streaming(file2_content, 2)
+        mesure['rows_out'] = len(df1)
+    df = df.iloc[:, 1:]
+    df1 = df1.iloc[:, 1:]
+
+    plan = charger_plan_fusion(ligne, df.columns, df1.columns)
+
+    df1_filtered = df1.iloc[:, plan['positions']].copy()
+    df1_filtered.columns = pd.MultiIndex.from_tuples(plan['colonnes'])
     df = df.reset_index(drop=True)
-    df1_filtered = df1_filtered.reset_index(drop=True)
-    df1_filtered = df1_filtered.iloc[:df.shape[0]]
+    alignement = alignement or {}
+    if alignement.get('mode') == 'cles':
+        df1_filtered, rapport = aligner_par_cles(df, df1, df1_filtered, alignement)
+        debug_print(f"Alignement par clés pour la ligne {ligne}: {json.dumps(rapport, ensure_ascii=False)}")
+    else:
+        df1_filtered = df1_filtered.reset_index(drop=True)
+        df1_filtered = df1_filtered.iloc[:df.shape[0]]
     df_fusion = pd.concat([df, df1_filtered], axis=1)
     df_fusion = df_fusion.iloc[1:]
     df_fusion.reset_index(drop=True, inplace=True)
@@ -241,6 +735,9 @@ def traiter_fusion(ligne, file1_content, file2_content):
     debug_print(f"Fusion terminée pour la ligne {ligne}. Shape: {df_fusion.shape}")
     return df_fusion
 
+# Première colonne de mesures du classeur LIMS : le nettoyage commence à cette colonne
+COLONNE_ANCRE = ('ACIDE PHOSPHORIQUE', 'Picage AR29', '%P2O5 AR29')
+
 def nettoyage_donnees(df_fusion):
     """
     Fonction pour nettoyer les données fusionnées.
@@ -250,7 +747,7 @@ def nettoyage_donnees(df_fusion):
     # Trouver la colonne de départ
     start_index = None
     for i in range(len(df_fusion.columns)):
-        if df_fusion.columns[i] == ('ACIDE PHOSPHORIQUE', 'Picage AR29', '%P2O5 AR29'):
+        if df_fusion.columns[i] == COLONNE_ANCRE:
             start_index = i
             break
     
@@ -260,21 +757,23 @@ def nettoyage_donnees(df_fusion):
     colonnes = df_fusion.columns[start_index:-1]
     df_clean = df_fusion.copy()
     
-    # Nettoyage des colonnes
+    # Nettoyage des colonnes objet, traitées ensemble comme un seul bloc
     changes = {}
-    for col in colonnes:
-        if df_clean[col].dtype == 'object':
-            original_nan = df_clean[col].isna().sum()
-            df_clean[col] = df_clean[col].apply(nettoyage_personnalise)
-            df_clean[col] = pd.to_numeric(df_clean[col], errors='coerce')
-            new_nan = df_clean[col].isna().sum()
-            
-            if new_nan > original_nan:
+    colonnes_objet = [col for col in colonnes if df_clean[col].dtype == 'object']
+    if colonnes_objet:
+        original_na = df_clean[colonnes_objet].isna().to_numpy()
+        valeurs = nettoyage_bloc_vectorise(df_clean[colonnes_objet])
+        ajoutes = np.isnan(valeurs) & ~original_na
+        nb_ajoutes = ajoutes.sum(axis=0)
+
+        for j, col in enumerate(colonnes_objet):
+            df_clean[col] = valeurs[:, j]
+            if nb_ajoutes[j] > 0:
                 # Convertir les index en liste Python standard
-                nan_indices = df_clean[col][df_clean[col].isna() & df_fusion[col].notna()].index.tolist()
+                nan_indices = df_clean.index[np.flatnonzero(ajoutes[:, j])[:5]].tolist()
                 changes[str(col)] = {
-                    'added_nan': int(new_nan - original_nan),
-                    'examples': nan_indices[:5] if nan_indices else []
+                    'added_nan': int(nb_ajoutes[j]),
+                    'examples': nan_indices
                 }
     
     # Supprimer les lignes vides
@@ -286,116 +785,170 @@ def nettoyage_donnees(df_fusion):
     debug_print(f"Nettoyage terminé. Lignes supprimées: {removed_rows}")
     return df_nettoye
 
-def apply_formulas(df, ligne):
+# Moteur de formules des colonnes dérivées
+# Colonnes sources : nom court -> nom de niveau 2 ('107D' est remplacé par la ligne courante)
+ENTREES_FORMULES = {
+    'debit_acp_1': 'Débit ACP 1 M3/H',
+    'debit_acp_2': 'Débit ACP 2 M3/H',
+    'densite_bouillie': 'Densité bouillie',
+    'bouillie_m3_1': 'Débit bouillie M3/H 1',
+    'bouillie_m3_2': 'Débit bouillie M3/H 2',
+    'bouillie_th_1': 'Débit bouillie T/H 1',
+    'bouillie_th_2': 'Débit bouillie T/H 2',
+    'recyclage': 'Recyclage T/H',
+    'prod_tsp': 'Production TSP balance T/H',
+    'p2o5_ar29': '%P2O5 AR29',
+    'densite_ar29': 'Densité AR29',
+    'debit_pp': 'DébIT PP Kg/H',
+    'debit_fioul': 'Débit fioul Kg/H',
+    'se_pf': '%P2O5 SE PF',
+}
+
+def ffill_non_nul(valeurs):
     """
-    Applique les formules mathématiques pour calculer les nouvelles colonnes.
+    Remplace les 0 par NaN puis propage la dernière valeur connue le long des lignes
+    (dernier axe du tableau).
     """
-    debug_print("Calcul des colonnes dérivées sur les données remplies...")
-
-    # Créer un mappage simple pour trouver les colonnes par leur nom de niveau 2
-    col_map = {c[2].strip(): c for c in df.columns}
-
-    # Fonction sécurisée pour récupérer une colonne
-    def get_col(name):
-        # Remplace le placeholder 'D' par la ligne actuelle pour les names dynamiques
-        name_dyn = name.replace('107D', f'107{ligne}')
-        for key, col_tuple in col_map.items():
-            if key == name_dyn:
-                return df[col_tuple]
-        # If the base column is not found, check for a calculated column (by level 2 name)
-        if name in col_map:
-             return df[col_map[name]]
-        debug_print(f"AVERTISSEMENT: Colonne '{name}' introuvable.")
-        return pd.Series(np.nan, index=df.index) # Return a Series of NaN if the column does not exist
-
-    # --- Application des formules ---
-    try:
-        df[('Valeurs', 'somme Débit1+Débit2', 'Débit ACP M3/H')] = get_col('Débit ACP 1 M3/H') + get_col('Débit ACP 2 M3/H')
-        debug_print("Formula 'Débit ACP M3/H' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'Débit ACP M3/H': {e}")
-    
-    try:
-        df[('Valeurs', 'Densité bouillie*(Débit bouillie M3/H 1+Débit bouillie M3/H 2)/1000', 'Débit bouillie T/H')] = get_col('Densité bouillie')*(get_col('Débit bouillie M3/H 1')+get_col('Débit bouillie M3/H 2'))/1000
-        debug_print("Formula 'Débit bouillie T/H' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'Débit bouillie T/H': {e}")
-
-    try:
-        df[('Valeurs', 'Débit bouillie T/H 1 +Débit bouillie T/H 2', 'debit bouillie T/H')] = get_col('Débit bouillie T/H 1') + get_col('Débit bouillie T/H 2')
-        debug_print("Formula 'debit bouillie T/H' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'debit bouillie T/H': {e}")
-
-    try:
-        df[('Valeurs', '(Recyclage T/H)/(debit bouillie T/H)', 'Ratio Solide/Liquide')] = get_col('Recyclage T/H') / get_col('debit bouillie T/H')
-        debug_print("Formula 'Ratio Solide/Liquide' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'Ratio Solide/Liquide': {e}")
-
-    try:
-        df[('Valeurs', '(Recyclage T/H )/(Production TSP balance)', 'Ratio recyclage /TSP')] = get_col('Recyclage T/H') / get_col('Production TSP balance T/H')
-        debug_print("Formula 'Ratio recyclage /TSP' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'Ratio recyclage /TSP': {e}")
+    valeurs = np.where(valeurs == 0, np.nan, valeurs)
+    positions = np.arange(valeurs.shape[-1])
+    indices = np.where(np.isnan(valeurs), 0, positions)
+    np.maximum.accumulate(indices, axis=-1, out=indices)
+    return np.take_along_axis(valeurs, indices, axis=-1)
 
-    try:
-        condition = (get_col("Débit ACP 1 M3/H") + get_col("Débit ACP 2 M3/H")) * get_col("%P2O5 AR29") * get_col("Densité AR29") / (get_col("DébIT PP Kg/H") * 30 * 1000) < 0.5
-        valeur = (get_col("Débit ACP 1 M3/H") + get_col("Débit ACP 2 M3/H")) * get_col("%P2O5 AR29") * get_col("Densité AR29") / (get_col("DébIT PP Kg/H") * 30 * 1000)
-        df[('Valeurs', '0 si ((Débit ACP 1+Débit ACP 2)*(%P2O5 AR29)*(Densité AR29))/(Débit PP*30*1000) <0,5 et ((Débit ACP 1+Débit ACP 2)*(%P2O5 AR29)*(Densité AR29))/(Débit PP*30*1000) sinon', 'Rapport acidulation Kg/M3')] = np.where(condition, 0, valeur)
-        debug_print("Formula 'Rapport acidulation Kg/M3' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'Rapport acidulation Kg/M3': {e}")
-
-    try:
-        condition = get_col('DébIT PP Kg/H') / get_col('Production TSP balance T/H') > 10
-        valeur = get_col('DébIT PP Kg/H') / get_col('Production TSP balance T/H')
-        df[('Valeurs', 'vide si (Débit PP)/(Production TSP balance) >10 et (Débit PP)/(Production TSP balance) sinon', 'CSP PP Kg/T')] = np.where(condition, np.nan, valeur)
-        debug_print("Formula 'CSP PP Kg/T' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'CSP PP Kg/T': {e}")
+# Les formules sont des fonctions NumPy de l'environnement `e` (nom court -> tableau) :
+# entrées, puis sous-expressions déjà calculées.
 
-    try:
-        df[('Valeurs', '((Débit ACP 1+Débit ACP 2)*Densité AR29*%P₂O₅ AR29)/(Production TSP balance*100000)', 'CSP ACP Kg/T')] = ((get_col('Débit ACP 1 M3/H') + get_col('Débit ACP 2 M3/H')) * get_col('Densité AR29') * get_col('%P2O5 AR29')) / (get_col('Production TSP balance T/H') * 100000)
-        debug_print("Formula 'CSP ACP Kg/T' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'CSP ACP Kg/T': {e}")
+# Sous-expressions communes, évaluées une seule fois dans l'ordre de déclaration
+INTERMEDIAIRES_FORMULES = [
+    ('debit_acp', lambda e: e['debit_acp_1'] + e['debit_acp_2']),
+    ('debit_bouillie', lambda e: e['bouillie_th_1'] + e['bouillie_th_2']),
+    ('flux_p2o5', lambda e: e['debit_acp'] * e['p2o5_ar29'] * e['densite_ar29']),
+    ('rapport_acidulation', lambda e: e['flux_p2o5'] / (e['debit_pp'] * 30 * 1000)),
+    ('csp_pp', lambda e: e['debit_pp'] / e['prod_tsp']),
+    ('csp_fioul', lambda e: e['debit_fioul'] / e['prod_tsp']),
+    ('prod_tsp_acp', lambda e: e['flux_p2o5'] / 38500),
+    ('se_suivi_civ', lambda e: ffill_non_nul(e['se_pf'])),
+]
 
-    try:
-        debit_acp_total = get_col('Débit ACP 1 M3/H') + get_col('Débit ACP 2 M3/H')
-        valeur = (debit_acp_total * get_col('%P2O5 AR29') * get_col('Densité AR29')) / 38500
-        condition = valeur == 0
-        df[('Valeurs', 'vide si (Débit ACP*%P2O5*Densité AR29)/(38500)=0 et (Débit ACP*%P2O5*Densité AR29)/(38500) sinon', 'Prod TSP/ACP M3/H')] = np.where(condition, np.nan, valeur)
-        debug_print("Formula 'Prod TSP/ACP M3/H' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'Prod TSP/ACP M3/H': {e}")
+# Colonnes dérivées : (colonne produite, formule)
+FORMULES_DERIVEES = [
+    (('Valeurs', 'somme Débit1+Débit2', 'Débit ACP M3/H'),
+     lambda e: e['debit_acp']),
+    (('Valeurs', 'Densité bouillie*(Débit bouillie M3/H 1+Débit bouillie M3/H 2)/1000', 'Débit bouillie T/H'),
+     lambda e: e['densite_bouillie'] * (e['bouillie_m3_1'] + e['bouillie_m3_2']) / 1000),
+    (('Valeurs', 'Débit bouillie T/H 1 +Débit bouillie T/H 2', 'debit bouillie T/H'),
+     lambda e: e['debit_bouillie']),
+    (('Valeurs', '(Recyclage T/H)/(debit bouillie T/H)', 'Ratio Solide/Liquide'),
+     lambda e: e['recyclage'] / e['debit_bouillie']),
+    (('Valeurs', '(Recyclage T/H )/(Production TSP balance)', 'Ratio recyclage /TSP'),
+     lambda e: e['recyclage'] / e['prod_tsp']),
+    (('Valeurs', '0 si ((Débit ACP 1+Débit ACP 2)*(%P2O5 AR29)*(Densité AR29))/(Débit PP*30*1000) <0,5 et ((Débit ACP 1+Débit ACP 2)*(%P2O5 AR29)*(Densité AR29))/(Débit PP*30*1000) sinon', 'Rapport acidulation Kg/M3'),
+     lambda e: np.where(e['rapport_acidulation'] < 0.5, 0, e['rapport_acidulation'])),
+    (('Valeurs', 'vide si (Débit PP)/(Production TSP balance) >10 et (Débit PP)/(Production TSP balance) sinon', 'CSP PP Kg/T'),
+     lambda e: np.where(e['csp_pp'] > 10, np.nan, e['csp_pp'])),
+    (('Valeurs', '((Débit ACP 1+Débit ACP 2)*Densité AR29*%P₂O₅ AR29)/(Production TSP balance*100000)', 'CSP ACP Kg/T'),
+     lambda e: e['flux_p2o5'] / (e['prod_tsp'] * 100000)),
+    (('Valeurs', 'vide si (Débit ACP*%P2O5*Densité AR29)/(38500)=0 et (Débit ACP*%P2O5*Densité AR29)/(38500) sinon', 'Prod TSP/ACP M3/H'),
+     lambda e: np.where(e['prod_tsp_acp'] == 0, np.nan, e['prod_tsp_acp'])),
+    (('Valeurs', 'vide si  Débit fioul/Production TSP balance>100 et Débit fioul/Production TSP balance sinon', 'CSP Fioul Kg/T'),
+     lambda e: np.where(e['csp_fioul'] > 100, np.nan, e['csp_fioul'])),
+    (('Valeurs', '%P2O5 SE PF si on a une valeur et la valeur précédant si %P2O5 SE PF =0', 'SE suivi CIV %'),
+     lambda e: e['se_suivi_civ']),
+    (('Valeurs', '"CIV" si SE suivi CIV> =41,5 et "SP" sinon', 'Qualité'),
+     lambda e: np.where(e['se_suivi_civ'] >= 41.5, "CIV", "SP")),
+]
 
-    try:
-        condition = get_col('Débit fioul Kg/H') / get_col('Production TSP balance T/H') > 100
-        valeur = get_col('Débit fioul Kg/H') / get_col('Production TSP balance T/H')
-        df[('Valeurs', 'vide si  Débit fioul/Production TSP balance>100 et Débit fioul/Production TSP balance sinon', 'CSP Fioul Kg/T')] = np.where(condition, np.nan, valeur)
-        debug_print("Formula 'CSP Fioul Kg/T' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'CSP Fioul Kg/T': {e}")
+def compiler_formules(colonnes, ligne):
+    """
+    Résout une seule fois, pour une ligne, les colonnes sources utilisées par le registre
+    de formules. Le plan obtenu est réutilisable pour toutes les méthodes d'imputation.
+    """
+    # Créer un mappage simple pour trouver les colonnes par leur nom de niveau 2
+    col_map = {str(c[2]).strip(): c for c in colonnes}
+    entrees = {}
+    for nom, niveau_2 in ENTREES_FORMULES.items():
+        col = col_map.get(niveau_2.replace('107D', f'107{ligne}'))
+        if col is None:
+            debug_print(f"AVERTISSEMENT: Colonne '{niveau_2}' introuvable.")
+        else:
+            entrees[nom] = col
+    return {'ligne': ligne, 'entrees': entrees}
 
-    try:
-        # Replace 0 with NaN then forward fill
-        se_pf_col = get_col('%P2O5 SE PF').replace(0, np.nan).ffill()
-        df[('Valeurs', '%P2O5 SE PF si on a une valeur et la valeur précédant si %P2O5 SE PF =0', 'SE suivi CIV %')] = se_pf_col
-        debug_print("Formula 'SE suivi CIV %' applied.")
-    except Exception as e: debug_print(f"Erreur formule 'SE suivi CIV %': {e}")
+def evaluer_formules(plan, entrees, forme):
+    """
+    Évalue toutes les colonnes dérivées en une passe vectorisée. `entrees` associe chaque
+    nom court du plan à un tableau de forme `forme` (méthodes x lignes).
+    """
+    env = {}
+    for nom in ENTREES_FORMULES:
+        env[nom] = entrees[nom] if nom in entrees else np.full(forme, np.nan)
 
-    try:
-        condition = get_col('SE suivi CIV %') >= 41.5
-        df[('Valeurs', '"CIV" si SE suivi CIV> =41,5 et "SP" sinon', 'Qualité')] = np.where(condition, "CIV", "SP")
-        debug_print("Formula 'Qualité' applied.")
-        col_name = ('Valeurs', '"CIV" si SE suivi CIV>=41,5 et "SP" sinon', 'Qualité')
-        values = df[col_name].unique()
-        debug_print(f"Qualité values: {values}")
+    resultats = {}
+    with np.errstate(all='ignore'):
+        for nom, formule in INTERMEDIAIRES_FORMULES:
+            try:
+                env[nom] = formule(env)
+            except Exception as e:
+                debug_print(f"Erreur sous-expression '{nom}': {e}")
+                env[nom] = np.full(forme, np.nan)
 
+        for col, formule in FORMULES_DERIVEES:
+            try:
+                resultats[col] = np.broadcast_to(formule(env), forme)
+                debug_print(f"Formula '{col[2]}' applied.")
+            except Exception as e:
+                debug_print(f"Erreur formule '{col[2]}': {e}")
+    return resultats
 
-    except Exception as e: 
-        debug_print(f"Erreur formule 'Qualité': {e}")
+def apply_formulas(df, ligne):
+    """
+    Applique les formules mathématiques pour calculer les nouvelles colonnes.
+    """
+    debug_print("Calcul des colonnes dérivées sur les données remplies...")
+    plan = compiler_formules(df.columns, ligne)
+    entrees = {
+        nom: pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64')[None, :]
+        for nom, col in plan['entrees'].items()
+    }
+    for col, valeurs in evaluer_formules(plan, entrees, (1, len(df))).items():
+        df[col] = valeurs[0]
 
     debug_print(f"Shape after applying formulas: {df.shape}")
     return df
 
-def remplissage_donnees(df_nettoye, ligne):
+def mode_colonnes(valeurs):
     """
-    Fonction pour appliquer les différentes méthodes de remplissage.
+    Calcule le mode de chaque colonne d'un tableau float (NaN ignorés). En cas d'égalité,
+    la plus petite valeur est retenue, comme Series.mode()[0].
+    """
+    modes = np.full(valeurs.shape[1], np.nan)
+    tri = np.sort(valeurs, axis=0)  # les NaN sont placés en fin de colonne
+    nb_valides = (~np.isnan(valeurs)).sum(axis=0)
+    for j in range(valeurs.shape[1]):
+        col = tri[:nb_valides[j], j]
+        if col.size:
+            debuts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+            effectifs = np.diff(np.r_[debuts, col.size])
+            modes[j] = col[debuts[np.argmax(effectifs)]]
+    return modes
+
+def indices_ffill_bfill(manquants):
+    """
+    Donne, pour chaque cellule, la ligne dont la valeur est reprise par ffill().bfill().
+    """
+    lignes = np.arange(manquants.shape[0])[:, None]
+    indices = np.where(manquants, -1, lignes)
+    np.maximum.accumulate(indices, axis=0, out=indices)
+    # bfill : les cellules sans valeur précédente prennent la première valeur de la colonne
+    premieres = np.argmax(~manquants, axis=0)
+    return np.where(indices < 0, premieres[None, :], indices)
+
+def preparer_imputation(df_nettoye, ligne, methodes=METHODES_IMPUTATION):
+    """
+    Extrait une seule fois les colonnes à imputer dans un tableau float contigu et calcule
+    en une passe les statistiques de remplissage (moyenne, médiane, mode) des `methodes`
+    demandées.
     """
-    debug_print("Début du remplissage des données...")
-    
     # Forcer le type des colonnes
     for col in df_nettoye.columns:
         if col in exclude_cols:
@@ -410,64 +963,145 @@ def remplissage_donnees(df_nettoye, ligne):
     cols_to_impute = [c for c in df_nettoye.columns if c[0] in ['ACIDE PHOSPHORIQUE', 'PHOSPHATE BROYE', 'TSP', 'PRODUIT FINI TSP'] or (c[0] == 'Valeurs' and f'J_107DEF_107{ligne}' in str(c[1]))]
 
     # Nettoyage des valeurs négatives
-    for col in cols_to_impute:
-        if col in df_nettoye.columns:
-            df_nettoye[col] = df_nettoye[col].apply(lambda x: x if pd.notna(x) and x >= 0 else pd.NA)
-
-    # Création des copies pour chaque méthode d'imputation
-    df_mean = df_nettoye.copy()
-    df_mode = df_nettoye.copy()
-    df_median = df_nettoye.copy()
-    df_ffill = df_nettoye.copy()
-    df_4fill = df_nettoye.copy()
-
-    # Application des méthodes d'imputation
-    debug_print("Application des méthodes d'imputation...")
-    for col in cols_to_impute:
-        if col in df_nettoye.columns:
-            # Moyenne
-            df_mean[col] = df_mean[col].fillna(df_mean[col].mean())
-            # Médiane
-            df_median[col] = df_median[col].fillna(df_median[col].median())
-            # Mode
-            mode_val = df_mode[col].mode()
-            if not mode_val.empty:
-                df_mode[col] = df_mode[col].fillna(mode_val[0])
-
-    # Ffill/Bfill sans exclusion
-    cols_for_ffill = [c for c in cols_to_impute if c in df_ffill.columns]
-    df_ffill[cols_for_ffill] = df_ffill[cols_for_ffill].ffill().bfill()
-
-    # Méthode 4fill - seulement 4 colonnes spécifiques avec ffill
-    specific_cols_4fill = [
-        ('PRODUIT FINI TSP', 'Détermination', '%P2O5  TOT PF'),
-        ('ACIDE PHOSPHORIQUE', 'Picage AR29', '%P2O5 AR29'),
-        ('ACIDE PHOSPHORIQUE', 'Picage AR29', 'Densité AR29'),
-        ('PHOSPHATE BROYE', 'Phosphate brute broyé', '%P2O5 TOT broyé')
-    ]
-    
-    debug_print("Application de la méthode 4fill sur les colonnes spécifiques...")
-    for col in specific_cols_4fill:
-        if col in df_4fill.columns:
-            df_4fill[col] = df_4fill[col].ffill().bfill()
-    
+    valeurs = df_nettoye[cols_to_impute].to_numpy(dtype='float64', copy=True)
+    valeurs[valeurs < 0] = np.nan
+    manquants = np.isnan(valeurs)
+    for j, col in enumerate(cols_to_impute):
+        df_nettoye[col] = valeurs[:, j]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        statistiques = {
+            'mean': lambda: np.nanmean(valeurs, axis=0),
+            'median': lambda: np.nanmedian(valeurs, axis=0),
+            'mode': lambda: mode_colonnes(valeurs),
+        }
+        remplissages = {methode: calcul() for methode, calcul in statistiques.items() if methode in methodes}
 
-    debug_print("Application des formules après l'imputation...")
-    df_mean = apply_formulas(df_mean, ligne)
-    df_mode = apply_formulas(df_mode, ligne)
-    df_median = apply_formulas(df_median, ligne)
-    df_ffill = apply_formulas(df_ffill, ligne)
-    df_4fill = apply_formulas(df_4fill, ligne)
-    
-    debug_print("Remplissage terminé.")
     return {
-        'mean': df_mean,
-        'mode': df_mode,
-        'median': df_median,
-        'ffill': df_ffill,
-        '4fill': df_4fill
+        'base': df_nettoye,
+        'colonnes': cols_to_impute,
+        'valeurs': valeurs,
+        'manquants': manquants,
+        'remplissages': remplissages,
+        'positions_4fill': [cols_to_impute.index(c) for c in COLONNES_4FILL if c in cols_to_impute],
     }
 
+def colonnes_imputees(imputation, methode, restreindre_a=None):
+    """
+    Retourne {position: valeurs remplies} pour les seules colonnes modifiées par la méthode
+    (éventuellement limitées aux positions `restreindre_a`).
+    Les autres colonnes restent celles du bloc partagé.
+    """
+    if methode == METHODE_ORIGINALE:
+        return {}
+    valeurs = imputation['valeurs']
+    manquants = imputation['manquants']
+    if methode == '4fill':
+        positions = imputation['positions_4fill']
+    else:
+        positions = np.flatnonzero(manquants.any(axis=0)).tolist()
+    if restreindre_a is not None:
+        positions = [j for j in positions if j in restreindre_a]
+    if not positions:
+        return {}
+
+    if methode in imputation['remplissages']:
+        remplissage = imputation['remplissages'][methode]
+        return {
+            j: np.where(manquants[:, j], remplissage[j], valeurs[:, j])
+            for j in positions
+        }
+
+    # ffill/bfill : toutes les colonnes à imputer ; 4fill : seulement les 4 colonnes spécifiques
+    indices = indices_ffill_bfill(manquants[:, positions])
+    remplies = np.take_along_axis(valeurs[:, positions], indices, axis=0)
+    return {j: remplies[:, k] for k, j in enumerate(positions)}
+
+def formules_toutes_methodes(imputation, ligne, methodes):
+    """
+    Compile le plan de formules une fois et l'évalue pour toutes les méthodes d'imputation
+    en même temps, sur des tableaux (méthodes x lignes).
+    """
+    base = imputation['base']
+    plan = plan_en_cache('formules', (ligne, tuple(base.columns)), lambda: compiler_formules(base.columns, ligne))
+    position_de = {col: j for j, col in enumerate(imputation['colonnes'])}
+    positions = {position_de[col] for col in plan['entrees'].values() if col in position_de}
+    remplies = [colonnes_imputees(imputation, methode, positions) for methode in methodes]
+
+    forme = (len(methodes), len(base))
+    entrees = {}
+    for nom, col in plan['entrees'].items():
+        originale = pd.to_numeric(base[col], errors='coerce').to_numpy(dtype='float64')
+        j = position_de.get(col)
+        if any(j in r for r in remplies):
+            entrees[nom] = np.stack([r.get(j, originale) for r in remplies])
+        else:
+            # Colonne identique pour toutes les méthodes : simple vue diffusée
+            entrees[nom] = np.broadcast_to(originale, forme)
+    return evaluer_formules(plan, entrees, forme)
+
+def materialiser_variante(imputation, methode, derivees=None, rang=0, lignes=None):
+    """
+    Construit le DataFrame d'une méthode d'imputation à partir du bloc partagé, en y
+    ajoutant les colonnes dérivées déjà calculées pour cette méthode (ligne `rang`).
+    Si `lignes` (positions) est fourni, seules ces lignes sont matérialisées.
+    """
+    if lignes is None:
+        df_methode = imputation['base'].copy(deep=False)
+        selection = slice(None)
+    else:
+        df_methode = imputation['base'].iloc[lignes].copy()
+        selection = lignes
+    colonnes = imputation['colonnes']
+    for j, valeurs in colonnes_imputees(imputation, methode).items():
+        df_methode[colonnes[j]] = valeurs[selection]
+    for col, valeurs in (derivees or {}).items():
+        df_methode[col] = valeurs[rang][selection]
+    return df_methode
+
+def methodes_demandees(methodes=None):
+    """
+    Valide la liste de méthodes d'imputation demandée (toutes par défaut) et la retourne
+    dans l'ordre de METHODES_IMPUTATION.
+    """
+    if not methodes:
+        return list(METHODES_IMPUTATION)
+    inconnues = [m for m in methodes if m not in METHODES_IMPUTATION]
+    if inconnues:
+        raise ValueError(f"Méthodes d'imputation inconnues: {', '.join(map(str, inconnues))}")
+    return [m for m in METHODES_IMPUTATION if m in methodes]
+
+def remplissage_donnees(df_nettoye, ligne, lignes=None, methodes=None, avec_original=False):
+    """
+    Fonction pour appliquer les différentes méthodes de remplissage.
+    Les variantes sont produites une à une (générateur) à partir d'un bloc partagé,
+    sans copie complète du DataFrame par méthode.
+    Les statistiques portent toujours sur toute la fenêtre ; `lignes` limite seulement
+    les lignes matérialisées (mode delta). Seules les `methodes` demandées (toutes par
+    défaut) sont calculées ; avec_original ajoute en tête la variante non imputée.
+    """
+    methodes = methodes_demandees(methodes)
+    debug_print("Début du remplissage des données...")
+    with mesurer_etape('imputation.preparation', len(df_nettoye)):
+        imputation = preparer_imputation(df_nettoye, ligne, methodes)
+    if avec_original:
+        methodes = [METHODE_ORIGINALE] + methodes
+
+    debug_print("Application des formules après l'imputation...")
+    with mesurer_etape('formules', len(df_nettoye)) as mesure:
+        derivees = formules_toutes_methodes(imputation, ligne, methodes)
+        mesure['rows_out'] = len(df_nettoye) * len(methodes)
+
+    debug_print("Application des méthodes d'imputation...")
+    for rang, methode in enumerate(methodes):
+        with mesurer_etape(f'imputation.{methode}', len(df_nettoye)) as mesure:
+            variante = materialiser_variante(imputation, methode, derivees, rang, lignes)
+            mesure['rows_out'] = len(variante)
+        yield methode, variante
+
+    debug_print("Remplissage terminé.")
+
 def validate_number(value):
     """
     Valide et corrige les nombres problématiques pour la sérialisation JSON.
@@ -527,85 +1161,1494 @@ def convert_numbers(obj):
         return obj
 
 
-def main():
+# Plans compilés conservés d'un traitement à l'autre (utile en mode service)
+PLANS_EN_CACHE = {}
+TAILLE_MAX_CACHE_PLANS = 64
+
+def plan_en_cache(nom, cle, construire):
+    """
+    Retourne le plan `nom` associé à `cle`, en le construisant au premier appel.
+    """
+    cle_complete = (nom, cle)
+    if cle_complete not in PLANS_EN_CACHE:
+        if len(PLANS_EN_CACHE) >= TAILLE_MAX_CACHE_PLANS:
+            PLANS_EN_CACHE.pop(next(iter(PLANS_EN_CACHE)))
+        PLANS_EN_CACHE[cle_complete] = construire()
+    return PLANS_EN_CACHE[cle_complete]
+
+# Construction colonne par colonne des documents MongoDB
+# Champs d'identification unique et valeur par défaut quand la donnée est absente (None)
+CHAMPS_IDENTIFICATION = {
+    'date_c': None,
+    'mois': 0,
+    'date_num': 0,
+    'semaine': 0,
+    'poste': 'Inconnu',
+    'heure': 'Inconnu',
+}
+
+# Nombre de documents assemblés et écrits à la fois
+TAILLE_LOT_DOCUMENTS = 1000
+
+# Champs qui identifient une ligne KPI de façon unique ; leur empreinte sert de _id
+CLES_UNICITE = ('source_line', 'date_c', 'mois', 'date_num', 'semaine', 'poste', 'heure', 'imputation_method')
+
+def identifiant_document(valeurs_cle):
+    """
+    Calcule un _id stable à partir des valeurs de CLES_UNICITE : 12 premiers octets du SHA-256
+    d'une forme canonique, en hexadécimal (24 caractères, donc convertible en ObjectId).
+    Les flottants entiers sont ramenés à des entiers pour que 3.0 et 3 donnent le même _id.
+    """
+    canoniques = [
+        int(v) if isinstance(v, float) and v.is_integer() else v
+        for v in valeurs_cle
+    ]
+    forme = json.dumps(canoniques, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(forme.encode('utf-8')).hexdigest()[:24]
+
+def role_identification(col):
+    """
+    Retourne le champ d'identification porté par une colonne (ou None).
+    """
+    nom = str(col[-1])
+    if 'Date c' in nom:
+        return 'date_c'
+    elif 'Mois' in nom:
+        return 'mois'
+    elif 'Date ' in nom:
+        return 'date_num'
+    elif 'Semaine' in nom:
+        return 'semaine'
+    elif 'Poste' in nom:
+        return 'poste'
+    elif 'Heure' in nom:
+        return 'heure'
+    return None
+
+def plan_documents(colonnes):
+    """
+    Précalcule une seule fois, pour toutes les colonnes, le chemin imbriqué des valeurs
+    (mêmes règles que create_nested_document) et la colonne de chaque champ d'identification.
+    """
+    groupes = {}
+    for j, col in enumerate(colonnes):
+        parent = tuple(str(level).strip() for level in col[:-1] if "Unnamed" not in str(level))
+        groupe = groupes.setdefault(parent, {'cles': [], 'positions': []})
+        final_key = str(col[-1]).strip()
+        if "Unnamed" not in final_key:
+            groupe['cles'].append(final_key)
+            groupe['positions'].append(j)
+
+    # En cas de doublon, la dernière colonne portant un rôle l'emporte
+    identification = {}
+    for j, col in enumerate(colonnes):
+        role = role_identification(col)
+        if role is not None:
+            identification[role] = j
+
+    return {'groupes': list(groupes.items()), 'identification': identification}
+
+def valeurs_serialisables(serie, valider=True):
+    """
+    Équivalent vectorisé de convert_to_serializable(validate_number(v)) sur une colonne
+    (ou de convert_to_serializable(v) seul si valider=False). Retourne une liste Python.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        formatees = serie.dt.strftime('%Y-%m-%d %H:%M:%S')
+        return formatees.astype(object).where(formatees.notna(), None).tolist()
+
+    est_nombre = pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie)
+    if est_nombre and (valider or pd.api.types.is_float_dtype(serie)):
+        valeurs = serie.to_numpy(dtype='float64')
+        with np.errstate(invalid='ignore'):
+            absolues = np.abs(valeurs)
+            extremes = (absolues > 1e20) | ((absolues < 1e-20) & (valeurs != 0))
+        resultat = np.where(extremes, 0.0, valeurs).astype(object)
+        resultat[np.isnan(valeurs)] = None
+        return resultat.tolist()
+    if est_nombre:
+        return serie.tolist()
+
+    if valider:
+        return [convert_to_serializable(validate_number(v)) for v in serie.tolist()]
+    return [convert_to_serializable(v) for v in serie.tolist()]
+
+def identification_lot(lot, plan):
+    """
+    Champs d'identification d'un lot de lignes : valeur brute, défaut uniquement si la
+    cellule vaut None. Retourne {champ: liste de valeurs}.
+    """
+    n = len(lot)
+    identification = {}
+    for champ, defaut in CHAMPS_IDENTIFICATION.items():
+        j = plan['identification'].get(champ)
+        if j is None:
+            identification[champ] = [defaut] * n
+            continue
+        brutes = lot.iloc[:, j]
+        valeurs = valeurs_serialisables(brutes, valider=False)
+        if defaut is not None and brutes.dtype == 'object':
+            valeurs = [defaut if v is None else s for v, s in zip(brutes.tolist(), valeurs)]
+        identification[champ] = valeurs
+    return identification
+
+def imbriquer_ligne(groupes, i):
+    """
+    Construit le dictionnaire imbriqué de la ligne i à partir des groupes
+    (chemin parent, clés, valeurs par ligne) préparés pour un lot.
+    """
+    nested_doc_data = {}
+    for parent, cles, lignes in groupes:
+        current_dict = nested_doc_data
+        for level in parent:
+            current_dict = current_dict.setdefault(level, {})
+        current_dict.update(zip(cles, lignes[i]))
+    return nested_doc_data
+
+def construire_documents(df_method, plan, ligne, method, batch_id,
+                         empreintes=None, taille_lot=TAILLE_LOT_DOCUMENTS):
+    """
+    Produit les documents MongoDB par lots, à partir de listes de valeurs nettoyées
+    colonne par colonne (au lieu d'un iterrows + parcours de dictionnaire par cellule).
+    L'index de df_method donne original_row_index ; `empreintes` (alignées sur les lignes)
+    renseigne row_fingerprint. Les noms de fichiers sont portés par le lot d'import (batch_id).
+    """
+    for debut in range(0, len(df_method), taille_lot):
+        lot = df_method.iloc[debut:debut + taille_lot]
+        n = len(lot)
+        index_lignes = lot.index.tolist()
+        empreintes_lot = list(empreintes[debut:debut + taille_lot]) if empreintes is not None else [None] * n
+
+        # Valeurs imbriquées : une liste de tuples (une entrée par ligne) par groupe de clés
+        groupes = []
+        for parent, groupe in plan['groupes']:
+            colonnes = [valeurs_serialisables(lot.iloc[:, j]) for j in groupe['positions']]
+            groupes.append((parent, groupe['cles'], list(zip(*colonnes)) if colonnes else [()] * n))
+
+        identification = identification_lot(lot, plan)
+
+        documents = []
+        for i in range(n):
+            valeurs_identification = {champ: valeurs[i] for champ, valeurs in identification.items()}
+            final_doc = {
+                '_id': identifiant_document((ligne, *valeurs_identification.values(), method)),
+                'source_line': ligne,
+                'batch_id': batch_id,
+                'imputation_method': method,
+                'original_row_index': index_lignes[i],
+                'row_fingerprint': empreintes_lot[i],
+                **valeurs_identification,
+                **imbriquer_ligne(groupes, i)
+            }
+            documents.append(final_doc)
+        yield documents
+
+# Disposition compacte : un document par ligne, valeurs imputées en surcharge
+LAYOUT_COMPACT = 'compact'
+
+def fusionner_variantes(originales, par_methode):
+    """
+    Combine les valeurs d'une colonne (listes alignées) : une cellule reste une valeur simple
+    si toutes les méthodes donnent la valeur d'origine, sinon elle devient
+    {'original_value': ..., 'imputed_values': {méthode: valeur}} avec les seules méthodes
+    qui diffèrent (même forme que ValueSchema dans models/KpiData.js).
+    """
+    if all(valeurs == originales for valeurs in par_methode.values()):
+        return originales
+    cellules = []
+    for i, originale in enumerate(originales):
+        surcharges = {m: valeurs[i] for m, valeurs in par_methode.items() if valeurs[i] != originale}
+        cellules.append({'original_value': originale, 'imputed_values': surcharges} if surcharges else originale)
+    return cellules
+
+def construire_documents_compacts(df_original, variantes, plan, ligne, batch_id,
+                                  empreintes=None, taille_lot=TAILLE_LOT_DOCUMENTS):
+    """
+    Produit un seul document par ligne pour toutes les méthodes de `variantes`
+    ({méthode: DataFrame aligné sur df_original}). df_original contient les valeurs
+    nettoyées avant imputation (et les colonnes dérivées calculées sur ces valeurs).
+    """
+    methodes = list(variantes)
+
+    for debut in range(0, len(df_original), taille_lot):
+        lot = df_original.iloc[debut:debut + taille_lot]
+        lots_methodes = {m: df.iloc[debut:debut + taille_lot] for m, df in variantes.items()}
+        n = len(lot)
+        index_lignes = lot.index.tolist()
+        empreintes_lot = list(empreintes[debut:debut + taille_lot]) if empreintes is not None else [None] * n
+
+        groupes = []
+        for parent, groupe in plan['groupes']:
+            colonnes = [
+                fusionner_variantes(
+                    valeurs_serialisables(lot.iloc[:, j]),
+                    {m: valeurs_serialisables(lot_m.iloc[:, j]) for m, lot_m in lots_methodes.items()}
+                )
+                for j in groupe['positions']
+            ]
+            groupes.append((parent, groupe['cles'], list(zip(*colonnes)) if colonnes else [()] * n))
+
+        identification = identification_lot(lot, plan)
+
+        documents = []
+        for i in range(n):
+            valeurs_identification = {champ: valeurs[i] for champ, valeurs in identification.items()}
+            final_doc = {
+                '_id': identifiant_document((ligne, *valeurs_identification.values(), LAYOUT_COMPACT)),
+                'source_line': ligne,
+                'batch_id': batch_id,
+                'layout': LAYOUT_COMPACT,
+                'imputation_methods': methodes,
+                'original_row_index': index_lignes[i],
+                'row_fingerprint': empreintes_lot[i],
+                **valeurs_identification,
+                **imbriquer_ligne(groupes, i)
+            }
+            documents.append(final_doc)
+        yield documents
+
+
+# Disposition par buckets : un document par ligne, jour et méthode d'imputation
+LAYOUT_BUCKET = 'bucket'
+
+# Nombre de buckets assemblés et écrits à la fois (environ TAILLE_LOT_DOCUMENTS lignes horaires)
+TAILLE_LOT_BUCKETS = 40
+
+def jours_et_heures(df_method, plan):
+    """
+    Jour ('AAAA-MM-JJ', None si la date est illisible) et heure (entier 0-23, None si
+    illisible) de chaque ligne, à partir de Date c et de la colonne Heure du plan.
+    """
+    j_date = plan['identification'].get('date_c')
+    dates = pd.to_datetime(df_method.iloc[:, j_date], errors='coerce') if j_date is not None else pd.Series(pd.NaT, index=df_method.index)
+
+    j_heure = plan['identification'].get('heure')
+    heures = heures_depuis_colonne(df_method.iloc[:, j_heure]) if j_heure is not None else pd.Series(np.nan, index=df_method.index)
+    heures = heures.fillna(dates.dt.hour).to_numpy(dtype='float64')
+
+    jours = dates.dt.strftime('%Y-%m-%d')
+    jours = jours.astype(object).where(jours.notna(), None).tolist()
+    heures_entieres = [None if np.isnan(h) else int(h) for h in heures]
+    return jours, heures_entieres
+
+def imbriquer_colonnes(groupes):
+    """
+    Dictionnaire imbriqué (mêmes chemins que imbriquer_ligne) dont les feuilles sont des
+    tableaux de valeurs alignés sur hour_index.
+    """
+    nested_doc_data = {}
+    for parent, cles, colonnes in groupes:
+        current_dict = nested_doc_data
+        for level in parent:
+            current_dict = current_dict.setdefault(level, {})
+        current_dict.update(zip(cles, colonnes))
+    return nested_doc_data
+
+def construire_documents_buckets(df_method, plan, ligne, method, batch_id,
+                                 empreintes=None, taille_lot=TAILLE_LOT_BUCKETS):
+    """
+    Regroupe les lignes horaires d'une méthode en un document par jour et par lot d'import :
+    chaque variable devient un tableau aligné sur hour_index (lignes triées par heure), de même
+    que les champs d'identification, original_row_index et row_fingerprint. Un jour dont les
+    heures arrivent en plusieurs imports a donc un bucket par lot (voir reconcilier_buckets).
+    Les lignes sans date lisible sont ignorées ; une ligne en double (mêmes champs d'unicité)
+    n'est conservée qu'une fois.
+    """
+    jours, heures = jours_et_heures(df_method, plan)
+    index_lignes = df_method.index.tolist()
+    empreintes = list(empreintes) if empreintes is not None else [None] * len(df_method)
+
+    # Valeurs sérialisées une seule fois par colonne, puis découpées par jour
+    colonnes = {
+        j: valeurs_serialisables(df_method.iloc[:, j])
+        for _, groupe in plan['groupes'] for j in groupe['positions']
+    }
+    identification = identification_lot(df_method, plan)
+
+    lignes_par_jour = {}
+    cles_vues = set()
+    sans_date = 0
+    for i, jour in enumerate(jours):
+        if jour is None:
+            sans_date += 1
+            continue
+        cle = identifiant_document((ligne, *(valeurs[i] for valeurs in identification.values()), method))
+        if cle in cles_vues:
+            continue
+        cles_vues.add(cle)
+        lignes_par_jour.setdefault(jour, []).append(i)
+    if sans_date:
+        debug_print(f"Buckets {method}: {sans_date} lignes sans date lisible ignorées.")
+
+    documents = []
+    for jour, lignes in lignes_par_jour.items():
+        # Tri stable par heure, heures illisibles en fin de bucket
+        lignes = sorted(lignes, key=lambda i: 24 if heures[i] is None else heures[i])
+        groupes = [
+            (parent, groupe['cles'], [[colonnes[j][i] for i in lignes] for j in groupe['positions']])
+            for parent, groupe in plan['groupes']
+        ]
+        # batch_id fait partie de la clé : un bucket n'appartient qu'à un lot, si bien que
+        # l'annulation reste une suppression indexée sur batch_id et que les lectures par lot
+        # (statistiques suffisantes) n'ont pas à filtrer les heures. reconcilier_buckets
+        # garantit qu'une heure n'est stockée que dans un seul bucket du jour.
+        documents.append({
+            '_id': identifiant_document((ligne, jour, LAYOUT_BUCKET, method, batch_id)),
+            'source_line': ligne,
+            'batch_id': batch_id,
+            'layout': LAYOUT_BUCKET,
+            'imputation_method': method,
+            'day': jour,
+            'hour_index': [heures[i] for i in lignes],
+            'original_row_index': [index_lignes[i] for i in lignes],
+            'row_fingerprint': [empreintes[i] for i in lignes],
+            **{champ: [valeurs[i] for i in lignes] for champ, valeurs in identification.items()},
+            'values': imbriquer_colonnes(groupes)
+        })
+        if len(documents) >= taille_lot:
+            yield documents
+            documents = []
+    if documents:
+        yield documents
+
+def cles_lignes_bucket(bucket):
+    """
+    Champs d'unicité de chaque ligne d'un bucket, sous la forme du _id qu'aurait le
+    document ligne à ligne correspondant.
+    """
+    n = len(bucket.get('hour_index', []))
+    colonnes = [bucket.get(champ) or [defaut] * n for champ, defaut in CHAMPS_IDENTIFICATION.items()]
+    return [
+        identifiant_document((bucket['source_line'], *(valeurs[i] for valeurs in colonnes), bucket['imputation_method']))
+        for i in range(n)
+    ]
+
+def filtrer_bucket(valeur, garder):
+    """
+    Ne conserve que les lignes `garder` (booléens alignés sur hour_index) de tous les
+    tableaux d'un bucket, y compris ceux imbriqués sous values.
+    """
+    if isinstance(valeur, dict):
+        return {cle: filtrer_bucket(sous_valeur, garder) for cle, sous_valeur in valeur.items()}
+    if isinstance(valeur, list) and len(valeur) == len(garder):
+        return [v for v, g in zip(valeur, garder) if g]
+    return valeur
+
+def reconcilier_buckets(collection, buckets, remplacer=False):
+    """
+    Applique aux buckets d'un lot la règle d'unicité des documents ligne à ligne, face aux
+    buckets des mêmes jours écrits par d'autres imports : une ligne déjà présente est retirée
+    du nouveau bucket (premier import conservé), ou, si `remplacer`, retirée de l'ancien bucket
+    (supprimé s'il devient vide). Retourne les buckets à écrire (vides exclus).
+    """
+    if not buckets:
+        return buckets
+    batch_id = buckets[0]['batch_id']
+    existants = collection.find({
+        'source_line': buckets[0]['source_line'],
+        'imputation_method': {'$in': sorted({b['imputation_method'] for b in buckets})},
+        'day': {'$in': sorted({b['day'] for b in buckets})},
+        'batch_id': {'$ne': batch_id},
+    })
+    cles_nouvelles = {}
+    for bucket in buckets:
+        cles_nouvelles.setdefault((bucket['imputation_method'], bucket['day']), set()).update(cles_lignes_bucket(bucket))
+
+    cles_existantes = {}
+    retirees = 0
+    for ancien in existants:
+        cles = cles_lignes_bucket(ancien)
+        if not remplacer:
+            cles_existantes.setdefault((ancien['imputation_method'], ancien['day']), set()).update(cles)
+            continue
+        nouvelles = cles_nouvelles.get((ancien['imputation_method'], ancien['day']), set())
+        garder = [cle not in nouvelles for cle in cles]
+        if all(garder):
+            continue
+        retirees += garder.count(False)
+        if any(garder):
+            collection.replace_one({'_id': ancien['_id']}, filtrer_bucket(ancien, garder))
+        else:
+            collection.delete_one({'_id': ancien['_id']})
+    if remplacer:
+        if retirees:
+            debug_print(f"Buckets: {retirees} lignes remplacées retirées des imports précédents.")
+        return buckets
+
+    conserves = []
+    for bucket in buckets:
+        connues = cles_existantes.get((bucket['imputation_method'], bucket['day']))
+        if not connues:
+            conserves.append(bucket)
+            continue
+        garder = [cle not in connues for cle in cles_lignes_bucket(bucket)]
+        retirees += garder.count(False)
+        if any(garder):
+            conserves.append(filtrer_bucket(bucket, garder))
+    if retirees:
+        debug_print(f"Buckets: {retirees} lignes déjà importées ignorées.")
+    return conserves
+
+
+# Écriture directe dans MongoDB (mode "sink")
+
+NOM_BASE_MONGODB = '107_DEF_KPI_dashboard'
+NOM_COLLECTION_KPI = 'kpidatas'
+NOM_COLLECTION_BUCKETS = 'kpibuckets'
+TAILLE_LOT_MONGODB = 500
+
+def connexion_collection_kpi(options):
+    """
+    Ouvre la collection kpidatas pour le mode sink.
+    Une URI "mongomock://" utilise mongomock (tests sans serveur MongoDB).
+    """
+    from pymongo.write_concern import WriteConcern
+
+    mongodb_uri = options.get('mongodb_uri') or os.getenv('MONGODB_URI')
+    if not mongodb_uri:
+        raise ValueError("MONGODB_URI non trouvée dans les variables d'environnement")
+
+    if mongodb_uri.startswith('mongomock://'):
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(mongodb_uri)
+
+    db = client[options.get('database', NOM_BASE_MONGODB)]
+    collection = db[options.get('collection', NOM_COLLECTION_KPI)]
+
+    write_concern = options.get('write_concern')
+    if write_concern:
+        if not isinstance(write_concern, dict):
+            write_concern = {'w': write_concern}
+        collection = collection.with_options(write_concern=WriteConcern(**write_concern))
+    return client, collection
+
+def date_schema(valeur):
+    """
+    Valeur de date_c telle que la stocke le schéma KpiData (type Date) : datetime naïf (UTC),
+    None si la valeur est absente ou illisible. Un nombre est une date pandas en nanosecondes.
+    """
+    if valeur is None:
+        return None
+    instant = pd.to_datetime(valeur, errors='coerce')
+    if pd.isna(instant):
+        return None
+    if instant.tzinfo is not None:
+        instant = instant.tz_convert('UTC').tz_localize(None)
+    return instant.to_pydatetime()
+
+def document_mongodb(doc, maintenant):
+    """
+    Document tel que l'écrirait Mongoose avec les schémas KpiData / KpiBucket : _id en ObjectId,
+    date_c en Date (documents ligne à ligne et compacts), import_date, createdAt et updatedAt.
+    Retourne None si date_c (obligatoire dans KpiData) est absente ou illisible.
+    """
+    from bson import ObjectId
+
+    doc_mongo = {**doc, '_id': ObjectId(doc['_id']), 'createdAt': maintenant, 'updatedAt': maintenant}
+    if doc.get('layout') == LAYOUT_BUCKET:
+        return doc_mongo
+    doc_mongo['date_c'] = date_schema(doc.get('date_c'))
+    if doc_mongo['date_c'] is None:
+        return None
+    doc_mongo['import_date'] = maintenant
+    return doc_mongo
+
+def ecrire_lot_mongodb(collection, documents, remplacer=False):
+    """
+    Upsert non ordonné d'un lot de documents, filtré sur leur _id (empreinte des champs d'unicité).
+    Les documents déjà présents ne sont pas modifiés ($setOnInsert, seul updatedAt est mis à
+    jour), comme côté Node, sauf si `remplacer` (mode delta : lignes modifiées depuis le dernier
+    import). Les lignes sans date_c lisible sont rejetées, comme par la validation de KpiData.
+    Un document rejeté par l'ancien index unique sur les champs d'unicité (base non migrée,
+    voir migrer_identifiants) est compté comme déjà présent au lieu de faire échouer l'import.
+    Retourne (insérés, déjà présents, rejetés).
+    """
+    from pymongo import UpdateOne, ReplaceOne
+    from pymongo.errors import BulkWriteError
+
+    maintenant = datetime.now(timezone.utc).replace(tzinfo=None)
+    operations = []
+    ids_vus = set()
+    rejetes = 0
+    for doc in documents:
+        if doc['_id'] in ids_vus:
+            continue
+        ids_vus.add(doc['_id'])
+        doc_mongo = document_mongodb(doc, maintenant)
+        if doc_mongo is None:
+            rejetes += 1
+            continue
+        if remplacer:
+            operations.append(ReplaceOne({'_id': doc_mongo['_id']}, doc_mongo, upsert=True))
+        else:
+            del doc_mongo['updatedAt']
+            operations.append(UpdateOne({'_id': doc_mongo['_id']},
+                                        {'$setOnInsert': doc_mongo, '$set': {'updatedAt': maintenant}},
+                                        upsert=True))
+    if rejetes:
+        debug_print(f"{rejetes} documents sans date_c lisible rejetés.")
+
+    if not operations:
+        return 0, len(documents) - rejetes, rejetes
+
     try:
-        # Lecture des données d'entrée
-        input_data = sys.stdin.read()
-        payload = json.loads(input_data)
+        if hasattr(collection, 'initialize_unordered_bulk_op'):
+            # mongomock : son bulk_write n'accepte plus les UpdateOne des versions récentes de pymongo
+            bulk = collection.initialize_unordered_bulk_op()
+            for operation in operations:
+                if remplacer:
+                    bulk.find(operation._filter).upsert().replace_one(operation._doc)
+                else:
+                    bulk.find(operation._filter).upsert().update_one(operation._doc)
+            inseres = bulk.execute().get('nUpserted', 0)
+        else:
+            result = collection.bulk_write(operations, ordered=False)
+            inseres = result.upserted_count if result.acknowledged else len(operations)
+    except BulkWriteError as e:
+        erreurs = e.details.get('writeErrors', [])
+        if not erreurs or any(erreur.get('code') != 11000 for erreur in erreurs):
+            raise
+        debug_print(f"{len(erreurs)} documents rejetés par un index unique hérité de {collection.name} "
+                    f"(lancer --migrate-ids pour le supprimer).")
+        inseres = e.details.get('nUpserted', 0)
+    return inseres, len(documents) - rejetes - inseres, rejetes
+
+def ecrire_documents_mongodb(collection, lots, taille_lot=TAILLE_LOT_MONGODB, remplacer=False):
+    """
+    Consomme des lots de documents et les écrit par paquets de taille_lot.
+    Retourne le bilan {'inserted', 'duplicates', 'replaced', 'rejected'}.
+    """
+    bilan = {'inserted': 0, 'duplicates': 0, 'replaced': 0, 'rejected': 0}
+    # En mode remplacement, les documents déjà présents sont remplacés et non ignorés
+    cle_existants = 'replaced' if remplacer else 'duplicates'
+    en_attente = []
+    ecriture = etape_cumulee('ecriture_mongodb')
+
+    def vider(paquet):
+        with mesurer_etape('ecriture_mongodb', cumul=ecriture) as mesure:
+            inseres, existants, rejetes = ecrire_lot_mongodb(collection, paquet, remplacer)
+            if mesure:
+                mesure['rows_out'] += len(paquet)
+        bilan['inserted'] += inseres
+        bilan[cle_existants] += existants
+        bilan['rejected'] += rejetes
+
+    for documents in lots:
+        en_attente.extend(documents)
+        while len(en_attente) >= taille_lot:
+            vider(en_attente[:taille_lot])
+            del en_attente[:taille_lot]
+    if en_attente:
+        vider(en_attente)
+
+    debug_print(f"Sink MongoDB: {bilan['inserted']} documents insérés, {bilan['replaced']} remplacés, {bilan['duplicates']} doublons ignorés, {bilan['rejected']} rejetés.")
+    return bilan
+
+def ecrire_documents_jsonl(lots, sortie):
+    """
+    Écrit les documents dans le flux `sortie`, un document JSON par ligne (un seul write par lot).
+    """
+    ecriture = etape_cumulee('ecriture_jsonl')
+    for documents in lots:
+        with mesurer_etape('ecriture_jsonl', cumul=ecriture) as mesure:
+            sortie.write(''.join(json.dumps(doc, ensure_ascii=False) + '\n' for doc in documents))
+            if mesure:
+                mesure['rows_out'] += len(documents)
+
+
+# Mode delta : empreinte des lignes brutes
+def valeurs_brutes_canoniques(serie):
+    """
+    Représentation texte stable d'une colonne brute : les nombres (et dates) sont écrits
+    sous forme de flottant quel que soit le type inféré à la lecture, les vides deviennent ''.
+    """
+    nombres = pd.to_numeric(serie, errors='coerce')
+    textes = serie.astype(str).where(serie.notna(), '')
+    return nombres.astype(str).where(nombres.notna(), textes)
+
+def empreintes_lignes(df_fusion, ligne):
+    """
+    Calcule l'empreinte de chaque ligne brute fusionnée (ligne + Date c + Poste + Heure +
+    toutes les valeurs brutes). Retourne une Series de chaînes hexadécimales (16 caractères)
+    indexée comme df_fusion.
+    """
+    colonnes = {'ligne': pd.Series(ligne, index=df_fusion.index)}
+    plan = plan_en_cache('documents', tuple(df_fusion.columns), lambda: plan_documents(df_fusion.columns))
+    for champ in ('date_c', 'poste', 'heure'):
+        j = plan['identification'].get(champ)
+        colonnes[champ] = valeurs_brutes_canoniques(df_fusion.iloc[:, j]) if j is not None else ''
+    for j in range(df_fusion.shape[1]):
+        colonnes[j] = valeurs_brutes_canoniques(df_fusion.iloc[:, j])
+
+    hachages = pd.util.hash_pandas_object(pd.DataFrame(colonnes), index=False)
+    return hachages.map('{:016x}'.format)
+
+def empreintes_connues(collection, ligne, empreintes, methodes=METHODES_IMPUTATION):
+    """
+    Récupère en une seule requête les empreintes déjà présentes en base pour cette ligne.
+    Une empreinte n'est connue que si toutes les `methodes` demandées sont déjà stockées
+    (en documents par méthode ou dans un document compact).
+    """
+    curseur = collection.find(
+        {
+            'source_line': ligne,
+            'row_fingerprint': {'$in': list(set(empreintes))},
+            '$or': [
+                {'imputation_method': {'$in': list(methodes)}},
+                {'imputation_methods': {'$in': list(methodes)}},
+            ],
+        },
+        {'_id': 0, 'row_fingerprint': 1, 'imputation_method': 1, 'imputation_methods': 1}
+    )
+    methodes_par_empreinte = {}
+    for doc in curseur:
+        trouvees = methodes_par_empreinte.setdefault(doc['row_fingerprint'], set())
+        if doc.get('imputation_method'):
+            trouvees.add(doc['imputation_method'])
+        trouvees.update(doc.get('imputation_methods') or [])
+    return {e for e, trouvees in methodes_par_empreinte.items() if set(methodes) <= trouvees}
+
+# Validation rapide d'une paire de classeurs, sur les seules lignes d'en-tête
+def entetes_classeur(file_content, nb_lignes=3):
+    """
+    Lit uniquement les `nb_lignes` premières lignes de la première feuille (read-only) et
+    retourne les en-têtes construits sur 3 niveaux (disposition LIMS) et sur 2 niveaux
+    (disposition PI), ainsi que le texte de toutes les cellules lues.
+    """
+    with ouvrir_classeur(file_content) as wb:
+        lignes = [tuple(cells) for cells in wb.worksheets[0].iter_rows(max_row=nb_lignes)]
+        return {
+            'lims': lire_entetes(iter(lignes), 3),
+            'pi': lire_entetes(iter(lignes), 2),
+            'cellules': [str(cell.value).strip() for cells in lignes for cell in cells if cell.value is not None],
+        }
 
-        ligne = payload['line']
-        originalname1 = payload['originalname1']
-        originalname2 = payload['originalname2']
+def valider_classeurs(ligne, file1_content, file2_content):
+    """
+    Vérifie, sans lire les données, qu'une paire de classeurs correspond à la ligne :
+    colonne d'ancrage et bloc '107 {ligne}' dans le LIMS (fichier 1), balises
+    J_107DEF_107{ligne} dans le PI (fichier 2). Retourne un verdict structuré
+    {valid, line, errors, warnings, detected, duration_ms} ; les erreurs sont celles qui
+    feraient échouer (ou fausseraient) le traitement complet.
+    """
+    debut = time.perf_counter()
+    erreurs = []
+    avertissements = []
+    detecte = {}
+
+    entetes = {}
+    for cle, contenu in (('file1', file1_content), ('file2', file2_content)):
+        try:
+            entetes[cle] = entetes_classeur(contenu)
+        except Exception as e:
+            erreurs.append({'code': 'classeur_illisible', 'file': cle, 'message': f"Classeur illisible: {str(e)}"})
 
-        # Décoder les fichiers depuis le format base64
-        file1_content = base64.b64decode(payload['file1_b64'])
-        file2_content = base64.b64decode(payload['file2_b64'])
+    if 'file1' in entetes:
+        lims = entetes['file1']['lims']
+        blocs = sorted({str(col[0]).strip()[-1] for col in lims if re.fullmatch(r'107 [A-Z]', str(col[0]).strip())})
+        detecte['file1_lines'] = blocs
+        if COLONNE_ANCRE not in lims:
+            if 'file2' in entetes and COLONNE_ANCRE in entetes['file2']['lims']:
+                erreurs.append({'code': 'classeurs_inverses', 'file': 'file1',
+                                'message': "Les classeurs LIMS et PI semblent inversés"})
+            else:
+                erreurs.append({'code': 'ancre_absente', 'file': 'file1',
+                                'message': f"Colonne de départ non trouvée: {COLONNE_ANCRE}"})
+        if ligne not in blocs:
+            erreurs.append({'code': 'mauvaise_ligne' if blocs else 'bloc_ligne_absent', 'file': 'file1',
+                            'message': f"Bloc '107 {ligne}' absent du classeur LIMS"
+                                       + (f" (ligne(s) détectée(s): {', '.join(blocs)})" if blocs else '')})
 
+    if 'file2' in entetes:
+        balises = sorted({m.group(1) for cellule in entetes['file2']['cellules']
+                          for m in re.finditer(r'J_107DEF_107([A-Z])', cellule)})
+        detecte['file2_lines'] = balises
+        if not balises:
+            avertissements.append({'code': 'balises_absentes', 'file': 'file2',
+                                   'message': f"Aucune balise J_107DEF_107{ligne} dans les en-têtes du classeur PI"})
+        elif ligne not in balises:
+            erreurs.append({'code': 'mauvaise_ligne', 'file': 'file2',
+                            'message': f"Balises J_107DEF_107{ligne} absentes du classeur PI "
+                                       f"(ligne(s) détectée(s): {', '.join(balises)})"})
+
+        # Colonnes PI sans description connue : elles seraient fusionnées en 'Description Manquante'
+        plan = resoudre_plan_fusion(ligne, entetes['file2']['pi'][1:])
+        inconnues = [col[2] for col in plan['colonnes'] if col[1] == 'Description Manquante']
+        if inconnues:
+            avertissements.append({'code': 'colonnes_pi_inconnues', 'file': 'file2', 'columns': inconnues,
+                                   'message': f"{len(inconnues)} colonne(s) PI sans description connue"})
+
+    return {
+        'valid': not erreurs,
+        'line': ligne,
+        'errors': erreurs,
+        'warnings': avertissements,
+        'detected': detecte,
+        'duration_ms': round((time.perf_counter() - debut) * 1000, 1),
+    }
+
+def contenus_classeurs(payload):
+    """
+    Chemins des classeurs sur disque si fournis, sinon contenu encodé en base64.
+    """
+    if payload.get('file1_path') and payload.get('file2_path'):
+        return Path(payload['file1_path']), Path(payload['file2_path'])
+    return base64.b64decode(payload['file1_b64']), base64.b64decode(payload['file2_b64'])
+
+# Lots d'import : un enregistrement ingest_batches par exécution du pipeline
+NOM_COLLECTION_LOTS = 'ingest_batches'
+
+def nouveau_batch_id():
+    """
+    Identifiant compact d'un lot d'import (24 caractères hexadécimaux).
+    """
+    return uuid.uuid4().hex[:24]
+
+def empreinte_contenu(contenu):
+    """
+    SHA-256 du contenu d'un classeur (bytes ou chemin, lu par blocs).
+    """
+    hachage = hashlib.sha256()
+    if isinstance(contenu, (bytes, bytearray)):
+        hachage.update(contenu)
+    else:
+        with open(contenu, 'rb') as f:
+            for bloc in iter(lambda: f.read(1 << 20), b''):
+                hachage.update(bloc)
+    return hachage.hexdigest()
+
+def enregistrer_lot_import(db, lot):
+    """
+    Écrit (ou remplace) l'enregistrement du lot dans ingest_batches.
+    """
+    doc = dict(lot)
+    for champ in ('started_at', 'finished_at'):
+        if doc.get(champ):
+            doc[champ] = datetime.fromisoformat(doc[champ])
+    db[NOM_COLLECTION_LOTS].replace_one({'_id': doc['_id']}, doc, upsert=True)
+
+def index_unicite_herites(collection):
+    """
+    Noms des index uniques sur les champs d'unicité créés avant le _id déterministe
+    (ancien modèle KpiData) : ils rejetteraient les upserts par _id des documents existants.
+    """
+    return [
+        nom for nom, index in collection.index_information().items()
+        if index.get('unique') and {'date_c', 'heure', 'imputation_method'} <= {cle for cle, _ in index['key']}
+    ]
+
+def cle_unicite_stockee(doc):
+    """
+    Valeurs des champs d'unicité d'un document stocké. date_c y est toujours une Date (schéma
+    KpiData, document_mongodb ; convertir_dates_heritees pour les anciens documents du pipeline).
+    """
+    return tuple(doc.get(champ) for champ in CLES_UNICITE)
+
+def convertir_dates_heritees(collection):
+    """
+    Convertit en Date les date_c stockées en nombre ou en texte par les anciennes versions du
+    pipeline (documents ligne à ligne), une mise à jour par valeur distincte. Retourne le
+    nombre de documents convertis.
+    """
+    filtre = {'layout': {'$ne': LAYOUT_BUCKET}, 'date_c': {'$exists': True, '$not': {'$type': 'date'}}}
+    convertis = 0
+    for valeur in collection.distinct('date_c', filtre):
+        convertis += collection.update_many(
+            {**filtre, 'date_c': valeur}, {'$set': {'date_c': date_schema(valeur)}}
+        ).modified_count
+    return convertis
+
+def migrer_identifiants(options):
+    """
+    Migration vers le _id déterministe (empreinte des champs d'unicité) :
+    - supprime l'ancien index unique sur les 8 champs d'unicité de kpidatas ;
+    - convertit en Date les date_c écrites en nombre ou en texte par l'ancien pipeline ;
+    - supprime les documents hérités (_id aléatoire, sans batch_id) dont la ligne a été
+      réimportée depuis avec un _id déterministe (doublons).
+    Les documents hérités sans équivalent sont conservés : les réimporter puis relancer la
+    migration les remplace. Idempotent. Retourne le bilan de la migration.
+    """
+    client, collection = connexion_collection_kpi(options)
+    try:
+        index_supprimes = index_unicite_herites(collection)
+        for nom in index_supprimes:
+            collection.drop_index(nom)
+            debug_print(f"Index unique hérité supprimé: {nom}")
+        dates_converties = convertir_dates_heritees(collection)
+
+        projection = {champ: 1 for champ in CLES_UNICITE}
+        filtre_herites = {'batch_id': {'$exists': False}, 'layout': {'$exists': False}}
+        cles_actuelles = {
+            cle_unicite_stockee(doc)
+            for doc in collection.find({'batch_id': {'$exists': True}, 'layout': {'$exists': False}}, projection)
+        }
+        doublons = []
+        conserves = 0
+        for doc in collection.find(filtre_herites, projection):
+            if cle_unicite_stockee(doc) in cles_actuelles:
+                doublons.append(doc['_id'])
+            else:
+                conserves += 1
+        supprimes = 0
+        for debut in range(0, len(doublons), TAILLE_LOT_MONGODB):
+            supprimes += collection.delete_many({'_id': {'$in': doublons[debut:debut + TAILLE_LOT_MONGODB]}}).deleted_count
+    finally:
+        client.close()
+    debug_print(f"Migration des identifiants: {dates_converties} date_c converties en Date, "
+                f"{supprimes} doublons hérités supprimés, {conserves} documents hérités conservés.")
+    return {'dropped_indexes': index_supprimes, 'converted_dates': dates_converties,
+            'deleted_duplicates': supprimes, 'legacy_remaining': conserves}
+
+def annuler_lot_import(options, batch_id):
+    """
+    Supprime les documents d'un lot (une suppression indexée sur batch_id par collection,
+    kpidatas et kpibuckets) et marque le lot comme annulé. Retourne le nombre de documents supprimés.
+    """
+    client, collection = connexion_collection_kpi(options)
+    try:
+        supprimes = collection.delete_many({'batch_id': batch_id}).deleted_count
+        supprimes += collection.database[NOM_COLLECTION_BUCKETS].delete_many({'batch_id': batch_id}).deleted_count
+        collection.database[NOM_COLLECTION_LOTS].update_one(
+            {'_id': batch_id}, {'$set': {'status': 'rolled_back', 'deleted_documents': supprimes}}
+        )
+    finally:
+        client.close()
+    debug_print(f"Lot {batch_id} annulé: {supprimes} documents supprimés.")
+    return supprimes
+
+
+# Cache Parquet des données nettoyées (après fusion et nettoyage, avant imputation),
+# indexé par le contenu des deux classeurs : permet de retraiter sans relire Excel.
+# Taille bornée par PIPELINE_CACHE_MAX_MB (voir cache_disque.py)
+REPERTOIRE_CACHE_NETTOYES = Path(os.getenv('PIPELINE_CACHE_DIR', tempfile.gettempdir())) / 'kpi_nettoyes'
+
+# À incrémenter quand traiter_fusion ou nettoyage_donnees changent de résultat
+VERSION_CACHE_NETTOYES = 1
+
+def cle_cache_nettoyage(ligne, empreintes_classeurs, alignement=None):
+    """
+    Clé du cache : empreintes des deux classeurs, ligne, options d'alignement et version.
+    """
+    forme = json.dumps(
+        [VERSION_CACHE_NETTOYES, ligne, empreintes_classeurs['file1'], empreintes_classeurs['file2'], alignement or {}],
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(forme.encode('utf-8')).hexdigest()[:32]
+
+def encoder_valeur_cache(valeur):
+    """
+    Forme JSON d'une valeur d'en-tête ou de cellule objet (dates conservées avec leur type).
+    """
+    if isinstance(valeur, (pd.Timestamp, datetime)):
+        return {'datetime': pd.Timestamp(valeur).isoformat()}
+    if isinstance(valeur, np.generic):
+        return valeur.item()
+    return valeur
+
+def decoder_valeur_cache(valeur):
+    if isinstance(valeur, dict) and 'datetime' in valeur:
+        return pd.Timestamp(valeur['datetime'])
+    return valeur
+
+def enregistrer_cache_nettoyage(cle, df_nettoye, empreintes, meta):
+    """
+    Écrit les données nettoyées et les empreintes des lignes brutes dans un fichier Parquet.
+    Les colonnes (MultiIndex) et les colonnes objet (types mélangés) sont encodées en JSON ;
+    les colonnes numériques et dates sont stockées telles quelles. Sans pyarrow, rien n'est écrit.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        debug_print("pyarrow non installé : cache Parquet des données nettoyées désactivé.")
+        return None
+
+    colonnes_json = []
+    donnees = {}
+    for j in range(df_nettoye.shape[1]):
+        serie = df_nettoye.iloc[:, j]
+        if serie.dtype == 'object':
+            colonnes_json.append(j)
+            donnees[f'c{j}'] = [json.dumps(encoder_valeur_cache(v), ensure_ascii=False) for v in serie.tolist()]
+        else:
+            donnees[f'c{j}'] = serie.to_numpy()
+    donnees['row_fingerprint'] = list(empreintes)
+
+    meta = {
+        **meta,
+        'version': VERSION_CACHE_NETTOYES,
+        'columns': [[encoder_valeur_cache(niveau) for niveau in col] for col in df_nettoye.columns],
+        'json_columns': colonnes_json,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+    }
+    table = pa.Table.from_pandas(pd.DataFrame(donnees, index=df_nettoye.index), preserve_index=True)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'kpi_cache': json.dumps(meta, ensure_ascii=False).encode('utf-8')})
+
+    fichier = REPERTOIRE_CACHE_NETTOYES / f'{cle}.parquet'
+    try:
+        REPERTOIRE_CACHE_NETTOYES.mkdir(parents=True, exist_ok=True)
+        temporaire = fichier.with_suffix(f'.{os.getpid()}.tmp')
+        pq.write_table(table, temporaire)
+        os.replace(temporaire, fichier)
+        evinces = limiter_cache(REPERTOIRE_CACHE_NETTOYES, '*.parquet', garder=fichier)
+        if evinces:
+            debug_print(f"Cache Parquet plein : {evinces} entrées les moins récemment utilisées supprimées.")
+    except Exception as e:
+        debug_print(f"Impossible d'écrire le cache Parquet ({fichier}): {str(e)}")
+        return None
+    debug_print(f"Données nettoyées mises en cache: {fichier}")
+    return fichier
+
+def lire_meta_cache(fichier):
+    """
+    Métadonnées d'un fichier du cache (ligne, fichiers d'origine, empreintes...), sans lire les données.
+    """
+    import pyarrow.parquet as pq
+    return json.loads(pq.read_schema(fichier).metadata[b'kpi_cache'])
+
+def charger_cache_nettoyage(cle):
+    """
+    Relit les données nettoyées d'une clé : {'df', 'empreintes', 'meta'}, ou None si la
+    clé est absente du cache (ou pyarrow non installé).
+    """
+    fichier = REPERTOIRE_CACHE_NETTOYES / f'{cle}.parquet'
+    if not fichier.exists():
+        return None
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+
+    table = pq.read_table(fichier)
+    meta = json.loads(table.schema.metadata[b'kpi_cache'])
+    if meta.get('version') != VERSION_CACHE_NETTOYES:
+        return None
+    marquer_utilise(fichier)
+    donnees = table.to_pandas()
+
+    colonnes_json = set(meta['json_columns'])
+    df = pd.DataFrame({
+        j: (
+            pd.Series([decoder_valeur_cache(json.loads(v)) for v in donnees[f'c{j}']], index=donnees.index, dtype='object')
+            if j in colonnes_json else donnees[f'c{j}']
+        )
+        for j in range(len(meta['columns']))
+    })
+    df.columns = pd.MultiIndex.from_tuples([tuple(decoder_valeur_cache(n) for n in col) for col in meta['columns']])
+    debug_print(f"Données nettoyées relues depuis le cache: {fichier}")
+    return {'df': df, 'empreintes': donnees['row_fingerprint'].to_numpy(dtype=object), 'meta': meta}
+
+def payloads_retraitement(ligne='all', options=None):
+    """
+    Un payload par entrée du cache Parquet pour une ligne (ou toutes avec 'all') : les
+    données nettoyées sont relues depuis le cache et les documents existants remplacés.
+    """
+    payloads = []
+    for fichier in sorted(REPERTOIRE_CACHE_NETTOYES.glob('*.parquet')):
+        meta = lire_meta_cache(fichier)
+        if meta.get('version') != VERSION_CACHE_NETTOYES or (ligne != 'all' and meta['line'] != ligne):
+            continue
+        payloads.append({
+            'replace': True,
+            **(options or {}),
+            'job_id': len(payloads) + 1,
+            'line': meta['line'],
+            'cache_key': fichier.stem,
+            'originalname1': meta['original_filenames']['file1'],
+            'originalname2': meta['original_filenames']['file2'],
+        })
+    return payloads
+
+def executer_pipeline(payload, sortie):
+    """
+    Exécute le pipeline complet pour une ligne (fusion, nettoyage, imputation, documents).
+    Les documents sont écrits dans `sortie` (JSON Lines) ou directement dans MongoDB en
+    mode sink. Retourne le bilan d'écriture du sink (ou None) et l'enregistrement du lot
+    d'import (fichiers sources, empreintes, durées et nombres de lignes par étape).
+    """
+    ligne = payload['line']
+    originalname1 = payload['originalname1']
+    originalname2 = payload['originalname2']
+    batch_id = payload.get('batch_id') or nouveau_batch_id()
+    debut = time.perf_counter()
+
+    if payload.get('cache_key'):
+        # Retraitement : données nettoyées relues depuis le cache Parquet, sans classeur Excel
+        cle_cache = payload['cache_key']
+        with mesurer_etape('cache') as mesure:
+            cache = charger_cache_nettoyage(cle_cache)
+            mesure['rows_out'] = len(cache['df']) if cache is not None else None
+        if cache is None:
+            raise ValueError(f"Données nettoyées absentes du cache: {cle_cache}")
+        empreintes_classeurs = cache['meta']['content_hashes']
+    else:
+        file1_content, file2_content = contenus_classeurs(payload)
+        empreintes_classeurs = {'file1': empreinte_contenu(file1_content), 'file2': empreinte_contenu(file2_content)}
+        cle_cache = cle_cache_nettoyage(ligne, empreintes_classeurs, payload.get('alignement'))
+        with mesurer_etape('cache') as mesure:
+            cache = charger_cache_nettoyage(cle_cache)
+            mesure['rows_out'] = len(cache['df']) if cache is not None else None
+
+    lot = {
+        '_id': batch_id,
+        'source_line': ligne,
+        'original_filenames': {'file1': originalname1, 'file2': originalname2},
+        'content_hashes': empreintes_classeurs,
+        'cache_key': cle_cache,
+        'source': 'cache' if cache is not None else 'excel',
+        'imputation_methods': methodes_demandees(payload.get('methods')),
+        'layout': payload.get('layout') or 'rows',
+        'delta': bool(payload.get('delta')),
+        'status': 'completed',
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'timings': {},
+        'rows': {},
+    }
+
+    if cache is not None:
+        df_nettoye, empreintes = cache['df'], cache['empreintes']
+        lot['rows']['fusion'] = cache['meta']['rows_fusion']
+        lot['timings']['cache'] = round(time.perf_counter() - debut, 3)
+    else:
         #  Fusion des fichiers
-        df_fusion = traiter_fusion(ligne, file1_content, file2_content)
+        etape = time.perf_counter()
+        with mesurer_etape('fusion') as mesure:
+            df_fusion = traiter_fusion(ligne, file1_content, file2_content, payload.get('alignement'))
+            mesure['rows_out'] = len(df_fusion)
+        lot['timings']['fusion'] = round(time.perf_counter() - etape, 3)
+        lot['rows']['fusion'] = len(df_fusion)
 
         #  Nettoyage des données
-        df_nettoye = nettoyage_donnees(df_fusion)
+        etape = time.perf_counter()
+        with mesurer_etape('nettoyage', len(df_fusion)) as mesure:
+            df_nettoye = nettoyage_donnees(df_fusion)
+            mesure['rows_out'] = len(df_nettoye)
+        lot['timings']['nettoyage'] = round(time.perf_counter() - etape, 3)
 
-        #  Remplissage des données avec différentes méthodes
-        dict_dfs_remplis = remplissage_donnees(df_nettoye, ligne)
-        
+        #  Empreintes des lignes brutes (la première ligne nettoyée n'est jamais émise)
+        empreintes = empreintes_lignes(df_fusion, ligne).loc[df_nettoye.index].to_numpy()
+        with mesurer_etape('cache.ecriture', len(df_nettoye)):
+            enregistrer_cache_nettoyage(cle_cache, df_nettoye, empreintes, {
+                'line': ligne,
+                'original_filenames': lot['original_filenames'],
+                'content_hashes': empreintes_classeurs,
+                'alignement': payload.get('alignement'),
+                'rows_fusion': len(df_fusion),
+            })
+    lot['rows']['nettoyees'] = len(df_nettoye) - 1
 
-        #  Préparation et envoi des données pour MongoDB (en streaming)
-        for method, df_method in dict_dfs_remplis.items():
-            df_method = df_method.drop(df_method.columns[0], axis=1)
-            #df_method = df_method.drop(df_method.columns[-1], axis=1)
-            df_method = df_method.iloc[1:].reset_index(drop=True)
+    sink = payload.get('sink') or {}
+    if payload.get('layout') == LAYOUT_BUCKET:
+        if payload.get('delta'):
+            raise ValueError("Le mode delta n'est pas disponible avec la disposition 'bucket'")
+        # Les buckets sont écrits dans leur propre collection
+        sink = {'collection': NOM_COLLECTION_BUCKETS, **sink}
+    lignes_emises = None
+    if payload.get('delta'):
+        client, collection = connexion_collection_kpi(sink)
+        try:
+            connues = empreintes_connues(collection, ligne, empreintes[1:], methodes_demandees(payload.get('methods')))
+        finally:
+            client.close()
+        nouvelles = ~np.isin(empreintes, list(connues))
+        nouvelles[0] = False
+        lignes_emises = np.flatnonzero(nouvelles)
+        debug_print(f"Mode delta: {len(lignes_emises)} lignes nouvelles ou modifiées sur {len(empreintes) - 1}.")
+    lot['rows']['emises'] = len(empreintes) - 1 if lignes_emises is None else len(lignes_emises)
 
-            for idx, row in df_method.iterrows():
-                nested_doc_data = create_nested_document(row, df_method.columns)
-                
-                # Extraire les champs d'identification unique
-                date_c = None
-                mois = None
-                date_num = None
-                semaine = None
-                poste = None
-                heure = None
-                
-                # Chercher ces valeurs dans les données
-                for col_name, value in zip(df_method.columns, row):
-                    if 'Date c' in str(col_name[-1]):
-                        date_c = value
-                    elif 'Mois' in str(col_name[-1]):
-                        mois = value
-                    elif 'Date ' in str(col_name[-1]) and 'Date c' not in str(col_name[-1]):
-                        date_num = value
-                    elif 'Semaine' in str(col_name[-1]):
-                        semaine = value
-                    elif 'Poste' in str(col_name[-1]):
-                        poste = value
-                    elif 'Heure' in str(col_name[-1]):
-                        heure = value
-                
-                # Construire le document final
-                final_doc = {
-                    'source_line': ligne,
-                    'original_filenames': {
-                        'file1': originalname1,
-                        'file2': originalname2
-                    },
-                    'imputation_method': method,
-                    'original_row_index': idx,
-                    
-                    # Champs d'identification unique
-                    'date_c': date_c,
-                    'mois': mois if mois is not None else 0,
-                    'date_num': date_num if date_num is not None else 0,
-                    'semaine': semaine if semaine is not None else 0,
-                    'poste': poste if poste is not None else 'Inconnu',
-                    'heure': heure if heure is not None else 'Inconnu',
-                    
-                    **nested_doc_data
-                }
-                
-                final_doc = convert_to_serializable(final_doc)
-                print(json.dumps(final_doc, ensure_ascii=False))
+    #  Remplissage des données avec différentes méthodes
+    #  Préparation et envoi des données pour MongoDB (en streaming)
+    def preparer_emission(df_method):
+        df_method = df_method.drop(df_method.columns[0], axis=1)
+        #df_method = df_method.drop(df_method.columns[-1], axis=1)
+        if lignes_emises is None:
+            return df_method.iloc[1:].reset_index(drop=True), empreintes[1:]
+        df_method.index = lignes_emises - 1
+        return df_method, empreintes[lignes_emises]
+
+    def generer_lots():
+        if payload.get('layout') == LAYOUT_COMPACT:
+            # Un document par ligne : toutes les variantes sont matérialisées ensemble
+            variantes = {
+                method: preparer_emission(df_method)[0]
+                for method, df_method in remplissage_donnees(df_nettoye, ligne, lignes_emises, payload.get('methods'),
+                                                             avec_original=True)
+            }
+            df_original = variantes.pop(METHODE_ORIGINALE)
+            empreintes_emises = empreintes[1:] if lignes_emises is None else empreintes[lignes_emises]
+            plan = plan_en_cache('documents', tuple(df_original.columns), lambda: plan_documents(df_original.columns))
+            yield from iterer_mesure('serialisation.compact',
+                                     construire_documents_compacts(df_original, variantes, plan, ligne, batch_id,
+                                                                   empreintes_emises),
+                                     len(df_original))
+            return
+
+        construire = construire_documents_buckets if payload.get('layout') == LAYOUT_BUCKET else construire_documents
+        for method, df_method in remplissage_donnees(df_nettoye, ligne, lignes_emises, payload.get('methods')):
+            df_method, empreintes_emises = preparer_emission(df_method)
+            plan = plan_en_cache('documents', tuple(df_method.columns), lambda: plan_documents(df_method.columns))
+            yield from iterer_mesure(f'serialisation.{method}',
+                                     construire(df_method, plan, ligne, method, batch_id, empreintes_emises),
+                                     len(df_method))
+
+    def lots_documents():
+        # Imputation et émission sont entrelacées (streaming) avec l'écriture : seule la
+        # production des lots (appels à next) est chronométrée, l'écriture l'est à part
+        lot['rows']['documents'] = 0
+        duree = 0.0
+        production = iterer_mesure('imputation_emission', generer_lots(), lot['rows']['emises'])
+        while True:
+            etape = time.perf_counter()
+            documents = next(production, None)
+            duree += time.perf_counter() - etape
+            if documents is None:
+                break
+            lot['rows']['documents'] += len(documents)
+            yield documents
+        lot['timings']['imputation_emission'] = round(duree, 3)
+
+    def terminer_lot():
+        lot['timings']['total'] = round(time.perf_counter() - debut, 3)
+        lot['finished_at'] = datetime.now(timezone.utc).isoformat()
+
+    if sink.get('type') == 'mongodb':
+        # Écriture directe dans kpidatas : le lot est enregistré dans la même base
+        client, collection = connexion_collection_kpi(sink)
+        try:
+            remplacer = bool(payload.get('delta') or payload.get('replace'))
+            lots = lots_documents()
+            if payload.get('layout') == LAYOUT_BUCKET:
+                reconciliation = etape_cumulee('reconciliation_buckets')
+
+                def reconcilier(documents):
+                    with mesurer_etape('reconciliation_buckets', cumul=reconciliation):
+                        return reconcilier_buckets(collection, documents, remplacer)
+
+                lots = (reconcilier(documents) for documents in lots)
+            etape = time.perf_counter()
+            bilan = ecrire_documents_mongodb(collection, lots, sink.get('batch_size', TAILLE_LOT_MONGODB),
+                                             remplacer=remplacer)
+            lot['timings']['ecriture'] = round(time.perf_counter() - etape - lot['timings']['imputation_emission'], 3)
+            terminer_lot()
+            lot['summary'] = bilan
+            enregistrer_lot_import(collection.database, lot)
+        finally:
+            client.close()
+        return {'summary': {**bilan, 'batch_id': batch_id}, 'ingest_batch': lot}
+
+    etape = time.perf_counter()
+    ecrire_documents_jsonl(lots_documents(), sortie)
+    lot['timings']['ecriture'] = round(time.perf_counter() - etape - lot['timings']['imputation_emission'], 3)
+    terminer_lot()
+    return {'summary': None, 'ingest_batch': lot}
+
+def enregistrer_mesures(destination, mesures, sink):
+    """
+    Émet l'enregistrement des mesures : une ligne JSON sur stderr, ou un document de la
+    collection ingest_metrics (même base que le sink).
+    """
+    if destination == 'mongodb':
+        client, collection = connexion_collection_kpi(sink)
+        try:
+            collection.database[NOM_COLLECTION_METRIQUES].insert_one(dict(mesures))
+        finally:
+            client.close()
+        return
+    print(json.dumps({'ingest_metrics': mesures}, ensure_ascii=False), file=sys.stderr)
+
+def traiter_payload(payload, sortie):
+    """
+    Exécute le pipeline (voir executer_pipeline) avec, si demandées, les mesures par étape
+    (payload.metrics ou PIPELINE_METRICS) et un profil cProfile (payload.profile : chemin
+    du fichier .prof ou true, ou répertoire PIPELINE_PROFILE_DIR).
+    """
+    global MESURES
+    destination = payload.get('metrics') or os.getenv('PIPELINE_METRICS')
+    if destination is True:
+        destination = 'stderr'
+    profil_demande = payload.get('profile') or os.getenv('PIPELINE_PROFILE_DIR')
+    if not destination and not profil_demande:
+        return executer_pipeline(payload, sortie)
+
+    payload = {**payload, 'batch_id': payload.get('batch_id') or nouveau_batch_id()}
+    if destination:
+        MESURES = {'stages': [], 'pics': []}
+        tracemalloc.start()
+    profil = cProfile.Profile() if profil_demande else None
+    if profil is not None:
+        profil.enable()
+    try:
+        with mesurer_etape('total') as total:
+            resultat = executer_pipeline(payload, sortie)
+    finally:
+        if profil is not None:
+            profil.disable()
+            chemin = payload.get('profile')
+            if not isinstance(chemin, str) or Path(chemin).is_dir():
+                # Un fichier par lot dans le répertoire indiqué (ou le répertoire temporaire)
+                repertoire = chemin if isinstance(chemin, str) else os.getenv('PIPELINE_PROFILE_DIR') or tempfile.gettempdir()
+                chemin = Path(repertoire) / f"{payload['batch_id']}.prof"
+            profil.dump_stats(chemin)
+            debug_print(f"Profil cProfile écrit dans {chemin}")
+        if destination:
+            tracemalloc.stop()
+            etapes = MESURES['stages']
+            MESURES = None
+
+    if destination:
+        lot = resultat['ingest_batch']
+        mesures = {
+            '_id': lot['_id'],
+            'batch_id': lot['_id'],
+            'source_line': lot['source_line'],
+            'layout': lot['layout'],
+            'imputation_methods': lot['imputation_methods'],
+            'started_at': lot['started_at'],
+            'wall_s': total['wall_s'],
+            'cpu_s': total['cpu_s'],
+            'peak_traced_mb': total['peak_traced_mb'],
+            'stages': [etape for etape in etapes if etape['stage'] != 'total'],
+        }
+        enregistrer_mesures(destination, mesures, payload.get('sink') or {})
+    return resultat
+
+# Mode service : processus persistant qui reçoit les traitements ligne par ligne sur stdin
+NB_WORKERS_SERVICE = 3
+
+def executer_travail(payload):
+    """
+    Exécute un traitement reçu par le service (dans un processus du pool) et retourne la
+    réponse à renvoyer : bilan du sink MongoDB, ou chemin du fichier JSON Lines produit et
+    lot d'import à enregistrer.
+    """
+    job_id = payload.get('job_id')
+    if payload.get('validate_only'):
+        try:
+            verdict = valider_classeurs(payload['line'], *contenus_classeurs(payload))
+            return {'job_id': job_id, 'status': 'success', 'verdict': verdict}
+        except Exception as e:
+            debug_print(f"PYTHON SCRIPT ERROR (job {job_id}): {str(e)}")
+            return {'job_id': job_id, 'status': 'error', 'message': str(e)}
+
+    output = payload.get('output')
+    if not output:
+        fd, output = tempfile.mkstemp(prefix=f"kpi_{payload.get('line')}_", suffix='.jsonl')
+        os.close(fd)
+    try:
+        with open(output, 'w', encoding='utf-8') as sortie:
+            resultat = traiter_payload(payload, sortie)
+        if resultat['summary'] is not None:
+            os.remove(output)
+            return {'job_id': job_id, 'status': 'success', 'summary': {'sink': 'mongodb', **resultat['summary']}}
+        return {'job_id': job_id, 'status': 'success', 'output': output, 'ingest_batch': resultat['ingest_batch']}
+    except Exception as e:
+        import traceback
+        debug_print(f"PYTHON SCRIPT ERROR (job {job_id}): {str(e)}")
+        debug_print(traceback.format_exc())
+        if os.path.exists(output):
+            os.remove(output)
+        return {'job_id': job_id, 'status': 'error', 'message': str(e)}
+
+def service_pipeline(nb_workers=NB_WORKERS_SERVICE):
+    """
+    Boucle du mode service : un payload JSON par ligne sur stdin, une réponse JSON par ligne
+    sur stdout (dans l'ordre de fin des traitements, identifiée par job_id).
+    Les imports et les plans compilés restent chargés dans les processus du pool.
+    Chaque traitement reçoit une réponse, y compris si son worker s'arrête brutalement ;
+    un pool cassé est alors recréé pour les traitements suivants.
+    """
+    import threading
+    from functools import partial
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    verrou_sortie = threading.Lock()
+
+    def repondre(job_id, future):
+        try:
+            reponse = future.result()
+        except Exception as e:
+            # Worker arrêté (BrokenProcessPool), payload non transmissible... : le job est en erreur
+            debug_print(f"PYTHON SCRIPT ERROR (job {job_id}): {type(e).__name__}: {str(e)}")
+            message = str(e) or type(e).__name__
+            reponse = {'job_id': job_id, 'status': 'error', 'error': message, 'message': message}
+        with verrou_sortie:
+            sys.stdout.write(json.dumps(reponse, ensure_ascii=False) + '\n')
+            sys.stdout.flush()
+
+    debug_print(f"Service pipeline démarré ({nb_workers} workers).")
+    pool = ProcessPoolExecutor(max_workers=nb_workers)
+    try:
+        for ligne_json in sys.stdin:
+            if not ligne_json.strip():
+                continue
+            try:
+                payload = json.loads(ligne_json)
+            except json.JSONDecodeError as e:
+                debug_print(f"Requête de service invalide: {str(e)}")
+                continue
+            try:
+                future = pool.submit(executer_travail, payload)
+            except BrokenProcessPool:
+                debug_print("Pool de workers cassé : redémarrage.")
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = ProcessPoolExecutor(max_workers=nb_workers)
+                future = pool.submit(executer_travail, payload)
+            future.add_done_callback(partial(repondre, payload.get('job_id')))
+    finally:
+        pool.shutdown(wait=True)
+    debug_print("Service pipeline arrêté.")
+
+# Mode lot : manifeste de traitements (ligne, paire de classeurs) exécutés en parallèle
+def charger_manifeste(source):
+    """
+    Lit un manifeste JSON (chemin, ou '-' pour stdin) et retourne la liste des payloads :
+    {"defaults": {options communes}, "jobs": [{"line": "F", "file1_path": ..., "file2_path": ...}]}
+    ou directement la liste des traitements. Les noms d'origine valent par défaut le nom des fichiers.
+    """
+    if source == '-':
+        manifeste = json.load(sys.stdin)
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            manifeste = json.load(f)
+    if isinstance(manifeste, list):
+        manifeste = {'jobs': manifeste}
+
+    payloads = []
+    for i, travail in enumerate(manifeste.get('jobs', []), start=1):
+        payload = {**manifeste.get('defaults', {}), **travail}
+        payload.setdefault('job_id', i)
+        for n in ('1', '2'):
+            if payload.get(f'file{n}_path'):
+                payload.setdefault(f'originalname{n}', Path(payload[f'file{n}_path']).name)
+        payloads.append(payload)
+    return payloads
+
+def executer_manifeste(payloads, sortie, nb_workers=None):
+    """
+    Exécute les traitements d'un manifeste dans un pool de processus (un par cœur par défaut).
+    Chaque processus garde ses plans compilés d'un traitement à l'autre et les plans de fusion
+    sont partagés par le cache disque (REPERTOIRE_CACHE_PLANS). Les résultats sont transmis dès
+    la fin de chaque traitement : documents puis lot d'import (JSON Lines) ou bilan du sink.
+    Un traitement en erreur (y compris l'arrêt brutal de son processus) est consigné dans
+    bilan['failed'] sans interrompre les autres. Retourne le bilan du manifeste.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    nb_workers = max(1, min(nb_workers or os.cpu_count() or 1, len(payloads)))
+    bilan = {'jobs': len(payloads), 'succeeded': 0, 'failed': []}
+    debug_print(f"Manifeste: {len(payloads)} traitements sur {nb_workers} processus.")
+
+    # Fichiers de sortie créés ici (et non dans les workers) : ils sont supprimés même si le
+    # processus qui les remplissait s'arrête brutalement
+    temporaires = []
+
+    def avec_sortie(payload):
+        if payload.get('output'):
+            return payload
+        fd, output = tempfile.mkstemp(prefix=f"kpi_{payload.get('line')}_", suffix='.jsonl')
+        os.close(fd)
+        temporaires.append(output)
+        return {**payload, 'output': output}
+
+    payloads = [avec_sortie(payload) for payload in payloads]
+
+    try:
+        with ProcessPoolExecutor(max_workers=nb_workers) as pool:
+            futures = {pool.submit(executer_travail, payload): payload for payload in payloads}
+            for future in as_completed(futures):
+                payload = futures[future]
+                try:
+                    reponse = future.result()
+                    if reponse['status'] != 'success':
+                        raise RuntimeError(reponse['message'])
+                    if 'summary' in reponse:
+                        sortie.write(json.dumps({'job_id': reponse['job_id'], **reponse['summary']}) + '\n')
+                    else:
+                        with open(reponse['output'], 'r', encoding='utf-8') as documents:
+                            for bloc in iter(lambda: documents.read(1 << 20), ''):
+                                sortie.write(bloc)
+                        os.remove(reponse['output'])
+                        sortie.write(json.dumps({'ingest_batch': reponse['ingest_batch']}, ensure_ascii=False) + '\n')
+                    sortie.flush()
+                except Exception as e:
+                    # Worker arrêté (BrokenProcessPool), traitement en erreur, sortie illisible :
+                    # le traitement est compté en échec et le manifeste continue
+                    message = str(e) or type(e).__name__
+                    debug_print(f"Manifeste: traitement {payload.get('job_id')} (ligne {payload.get('line')}) en échec: {message}")
+                    bilan['failed'].append({'job_id': payload.get('job_id'), 'line': payload.get('line'), 'message': message})
+                    continue
+                bilan['succeeded'] += 1
+                debug_print(f"Manifeste: traitement {reponse['job_id']} (ligne {payload.get('line')}) terminé.")
+    finally:
+        for output in temporaires:
+            if os.path.exists(output):
+                os.remove(output)
+
+    return bilan
+
+
+def main():
+    if '--service' in sys.argv:
+        nb_workers = NB_WORKERS_SERVICE
+        if '--workers' in sys.argv:
+            nb_workers = int(sys.argv[sys.argv.index('--workers') + 1])
+        service_pipeline(nb_workers)
+        return
+
+    try:
+        if '--manifest' in sys.argv:
+            # Import en lot : python full_pipeline_memory.py --manifest manifeste.json [--workers N]
+            nb_workers = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else None
+            bilan = executer_manifeste(charger_manifeste(sys.argv[sys.argv.index('--manifest') + 1]), sys.stdout, nb_workers)
+            print(json.dumps({'manifest_summary': bilan}, ensure_ascii=False))
+            if bilan['failed']:
+                sys.exit(1)
+            return
+
+        if '--reprocess' in sys.argv:
+            # Retraitement depuis le cache Parquet, sans relire Excel :
+            # python full_pipeline_memory.py --reprocess <F|all> [--options '{"sink": {"type": "mongodb"}}'] [--workers N]
+            options = json.loads(sys.argv[sys.argv.index('--options') + 1]) if '--options' in sys.argv else {}
+            payloads = payloads_retraitement(sys.argv[sys.argv.index('--reprocess') + 1], options)
+            if not payloads:
+                raise ValueError(f"Aucune donnée nettoyée en cache dans {REPERTOIRE_CACHE_NETTOYES}")
+            nb_workers = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else None
+            bilan = executer_manifeste(payloads, sys.stdout, nb_workers)
+            print(json.dumps({'manifest_summary': bilan}, ensure_ascii=False))
+            if bilan['failed']:
+                sys.exit(1)
+            return
+
+        if '--migrate-ids' in sys.argv:
+            # Migration vers le _id déterministe : python full_pipeline_memory.py --migrate-ids
+            print(json.dumps({'migration': migrer_identifiants({})}))
+            return
+
+        if '--rollback' in sys.argv:
+            # Annulation d'un import : python full_pipeline_memory.py --rollback <batch_id>
+            batch_id = sys.argv[sys.argv.index('--rollback') + 1]
+            print(json.dumps({'rolled_back': batch_id, 'deleted': annuler_lot_import({}, batch_id)}))
+            return
+
+        # Lecture des données d'entrée
+        input_data = sys.stdin.read()
+        payload = json.loads(input_data)
+
+        if payload.get('validate_only'):
+            # Validation rapide des en-têtes, sans traitement complet
+            print(json.dumps(valider_classeurs(payload['line'], *contenus_classeurs(payload)), ensure_ascii=False))
+            return
+
+        resultat = traiter_payload(payload, sys.stdout)
+        if resultat['summary'] is not None:
+            print(json.dumps({'sink': 'mongodb', **resultat['summary']}))
+        else:
+            # Dernière ligne : le lot d'import, enregistré par Node après l'insertion des documents
+            print(json.dumps({'ingest_batch': resultat['ingest_batch']}, ensure_ascii=False))
 
     except Exception as e:
         debug_print(f"PYTHON SCRIPT ERROR: {str(e)}")
@@ -614,4 +2657,4 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
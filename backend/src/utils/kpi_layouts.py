@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+# Lecture des dispositions de stockage produites par full_pipeline_memory.py ('compact' et
+# 'bucket'), commune à statistics_analyzer.py, pretrain_models.py et predict.py
+
+def materialiser_document(valeur, method):
+    """Matérialise une méthode d'imputation dans un document compact (layout 'compact') :
+    chaque valeur {original_value, imputed_values} est remplacée par la valeur de la méthode"""
+    if isinstance(valeur, dict):
+        if 'original_value' in valeur:
+            return (valeur.get('imputed_values') or {}).get(method, valeur.get('original_value'))
+        return {k: materialiser_document(v, method) for k, v in valeur.items()}
+    return valeur
+
+def feuilles_bucket(valeur, prefixe=''):
+    """Parcourt les valeurs imbriquées d'un bucket : (nom de colonne, tableau), noms joints
+    par '.' selon la règle de pd.json_normalize (pas de séparateur après un préfixe vide)"""
+    for cle, sous_valeur in valeur.items():
+        nom = f"{prefixe}.{cle}" if prefixe else cle
+        if isinstance(sous_valeur, dict):
+            yield from feuilles_bucket(sous_valeur, nom)
+        else:
+            yield nom, sous_valeur
+
+def colonnes_buckets(buckets):
+    """Convertit des documents bucket (layout 'bucket' : un document par ligne/jour/méthode,
+    variables en tableaux alignés sur hour_index) en DataFrame, colonne par colonne avec NumPy.
+    Les noms de colonnes sont ceux produits par expand_nested_columns sur les documents ligne à ligne."""
+    tailles = [len(bucket.get('hour_index', [])) for bucket in buckets]
+    par_colonne = {}
+    for k, bucket in enumerate(buckets):
+        for cle, valeur in bucket.get('values', {}).items():
+            # Même nommage que expand_nested_columns : "colonne.sous-colonne"
+            feuilles = ((f"{cle}.{nom}", v) for nom, v in feuilles_bucket(valeur)) if isinstance(valeur, dict) else [(cle, valeur)]
+            for nom, valeurs in feuilles:
+                par_colonne.setdefault(nom, {})[k] = valeurs
+
+    colonnes = {}
+    for nom, par_bucket in par_colonne.items():
+        morceaux = []
+        for k, taille in enumerate(tailles):
+            valeurs = par_bucket.get(k)
+            if valeurs is None:
+                morceaux.append(np.full(taille, np.nan))
+            elif all(v is None or isinstance(v, (int, float)) for v in valeurs):
+                morceaux.append(np.asarray(valeurs, dtype='float64'))
+            else:
+                morceaux.append(np.asarray(valeurs, dtype=object))
+        colonnes[nom] = np.concatenate(morceaux)
+    return pd.DataFrame(colonnes)
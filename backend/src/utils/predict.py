@@ -11,6 +11,7 @@ from pymongo import MongoClient
 from dotenv import load_dotenv
 from sklearn.linear_model import LinearRegression, Lasso, Ridge
 from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+from kpi_layouts import materialiser_document, colonnes_buckets
             
 
 # Configuration MongoDB
@@ -42,39 +43,51 @@ def load_data_from_mongodb_for_features(line, imputation_methods=['mean', 'media
         collection = db['kpidatas']
         
         line_letter = line.replace('107', '')
-        documents = list(collection.find({'source_line': line_letter}))
+        documents = list(collection.find({'source_line': line_letter, 'layout': {'$ne': 'compact'}}))
+        # Documents compacts (un par ligne horaire) : une vue par méthode d'imputation stockée
+        for doc in collection.find({'source_line': line_letter, 'layout': 'compact'}):
+            documents += [materialiser_document(doc, method) for method in doc.get('imputation_methods', [])]
+        # Buckets (un document par jour et méthode) : convertis directement en colonnes NumPy
+        buckets = list(db['kpibuckets'].find({'source_line': line_letter}).sort('day', 1))
         
-        if not documents:
+        if not documents and not buckets:
             print(f"Aucune donnée trouvée pour la ligne {line_letter}", file=sys.stderr)
             return {"error": f"Aucune donnée trouvée pour la ligne {line_letter}"}
         
-        # Convertir en DataFrame
-        df = pd.DataFrame(documents)
-        
-        # Supprimer les colonnes de métadonnées
-        metadata_cols = ['_id', 'source_line', 'import_date', 'original_filenames', 
-                       'imputation_method', 'original_row_index', 'date_c', 'mois', 
-                       'date_num', 'semaine', 'poste', 'heure', 'createdAt', 'updatedAt', '__v']
+        frames = []
+        if documents:
+            # Convertir en DataFrame
+            df = pd.DataFrame(documents)
+            
+            # Supprimer les colonnes de métadonnées
+            metadata_cols = ['_id', 'source_line', 'import_date', 'original_filenames', 
+                           'imputation_method', 'original_row_index', 'date_c', 'mois', 
+                           'date_num', 'semaine', 'poste', 'heure', 'createdAt', 'updatedAt', '__v',
+                           'row_fingerprint', 'layout', 'imputation_methods', 'batch_id']
         
-        df = df.drop(columns=[col for col in metadata_cols if col in df.columns], errors='ignore')
+            df = df.drop(columns=[col for col in metadata_cols if col in df.columns], errors='ignore')
         
-        # Développer les colonnes imbriquées
-        expanded_dfs = []
-        for col in df.columns:
-            if df[col].apply(lambda x: isinstance(x, dict)).any():
-                try:
-                    expanded = pd.json_normalize(df[col])
-                    expanded.columns = [f"{col}.{subcol}" for subcol in expanded.columns]
-                    expanded_dfs.append(expanded)
-                except:
+            # Développer les colonnes imbriquées
+            expanded_dfs = []
+            for col in df.columns:
+                if df[col].apply(lambda x: isinstance(x, dict)).any():
+                    try:
+                        expanded = pd.json_normalize(df[col])
+                        expanded.columns = [f"{col}.{subcol}" for subcol in expanded.columns]
+                        expanded_dfs.append(expanded)
+                    except:
+                        expanded_dfs.append(df[[col]])
+                else:
                     expanded_dfs.append(df[[col]])
-            else:
-                expanded_dfs.append(df[[col]])
         
-        if expanded_dfs:
-            df = pd.concat(expanded_dfs, axis=1)
+            if expanded_dfs:
+                df = pd.concat(expanded_dfs, axis=1)
+            frames.append(df)
+        if buckets:
+            # Buckets : seules les variables (sous values) deviennent des colonnes, sans métadonnées
+            frames.append(colonnes_buckets(buckets))
         
-        return df
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
         
     except Exception as e:
         print(f"Erreur lors du chargement depuis MongoDB: {e}", file=sys.stderr)
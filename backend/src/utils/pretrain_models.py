@@ -14,6 +14,7 @@ from dotenv import load_dotenv
 import warnings
 import io
 from bson.binary import Binary
+from kpi_layouts import materialiser_document, colonnes_buckets
 
 warnings.filterwarnings("ignore")
 
@@ -111,7 +112,7 @@ exclude_cols = [
     'imputation_method', 'poste', '107 D.Mois', '107 D.Date', 
     '107 D.Semaine', '107 D.Poste', '107 D.Heure', '__v', 'createdAt',
     'import_date', 'original_filenames.file1', 'original_filenames.file2',
-    'original_row_index', 'updatedAt',
+    'original_row_index', 'updatedAt', 'row_fingerprint', 'layout', 'imputation_methods', 'batch_id',
     '107 E.Mois', '107 E.Date', '107 E.Semaine', '107 E.Poste', '107 E.Heure',
     '107 F.Mois', '107 F.Date', '107 F.semaine','107 F.Semaine', '107 F.Poste', '107 F.Heure',
     'Valeurs.Nbr HM',
@@ -167,25 +168,38 @@ def load_data_from_mongodb(line, imputation_methods=['mean', 'median', 'mode', '
                 'imputation_method': method
             }
             documents = list(collection.find(query))
+            # Documents compacts (un par ligne horaire) : la méthode est matérialisée à la lecture
+            documents += [
+                materialiser_document(doc, method)
+                for doc in collection.find({'source_line': line_letter, 'layout': 'compact', 'imputation_methods': method})
+            ]
+            # Buckets (un document par jour) : convertis directement en colonnes NumPy
+            buckets = list(db['kpibuckets'].find(query).sort('day', 1))
             
-            if not documents:
+            if not documents and not buckets:
                 print(f"Aucune donnée trouvée pour la ligne {line_letter} avec la méthode '{method}'")
                 continue
             
-            print(f"{len(documents)} documents récupérés pour la ligne {line_letter} (méthode: {method})")
+            print(f"{len(documents)} documents et {len(buckets)} buckets récupérés pour la ligne {line_letter} (méthode: {method})")
             
-            # Convertir en DataFrame
-            df_method = pd.DataFrame(documents)
-            
-            # Supprimer les colonnes de métadonnées
-            metadata_cols = ['_id', 'source_line', 'import_date', 'original_filenames', 
-                           'imputation_method', 'original_row_index', 'date_c', 'mois', 
-                           'date_num', 'semaine', 'poste', 'heure', 'createdAt', 'updatedAt', '__v']
-            
-            df_method = df_method.drop(columns=[col for col in metadata_cols if col in df_method.columns], errors='ignore')
-            
-            # Développer les colonnes imbriquées
-            df_expanded = expand_nested_columns(df_method)
+            frames = []
+            if documents:
+                # Convertir en DataFrame
+                df_method = pd.DataFrame(documents)
+                
+                # Supprimer les colonnes de métadonnées
+                metadata_cols = ['_id', 'source_line', 'import_date', 'original_filenames', 
+                               'imputation_method', 'original_row_index', 'date_c', 'mois', 
+                               'date_num', 'semaine', 'poste', 'heure', 'createdAt', 'updatedAt', '__v',
+                               'row_fingerprint', 'layout', 'imputation_methods', 'batch_id']
+                
+                df_method = df_method.drop(columns=[col for col in metadata_cols if col in df_method.columns], errors='ignore')
+                
+                # Développer les colonnes imbriquées
+                frames.append(expand_nested_columns(df_method))
+            if buckets:
+                frames.append(colonnes_buckets(buckets))
+            df_expanded = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
             
             # Exclure les colonnes spécifiées
             columns_to_drop = [col for col in exclude_cols if col in df_expanded.columns]
@@ -12,9 +12,15 @@ from scipy.stats import norm
 from pymongo import MongoClient
 import warnings
 import os
+import hashlib
+import tempfile
+from math import comb
+from pathlib import Path
 from pymongo import MongoClient
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from kpi_layouts import materialiser_document, colonnes_buckets
+from cache_disque import limiter_cache, marquer_utilise
 warnings.filterwarnings("ignore")
 
 import sys
@@ -48,6 +54,27 @@ def get_mongodb_connection():
         print(f"❌ Erreur de connexion MongoDB: {e}")
         return None
 
+def enregistrer_variables(db, line, variables):
+    """Upsert des statistiques de chaque variable dans statistics_variables ; retourne leur nombre"""
+    variables_collection = db['statistics_variables']
+    variables_count = 0
+    
+    for var_name, var_data in variables.items():
+        if var_data:  # Vérifier que les données ne sont pas vides
+            variable_doc = {
+                "line": line,
+                "variable_name": var_name,
+                **var_data
+            }
+            # Remplacement complet : pas de champ résiduel d'une analyse précédente
+            variables_collection.replace_one(
+                {"line": line, "variable_name": var_name},
+                variable_doc,
+                upsert=True
+            )
+            variables_count += 1
+    return variables_count
+
 def save_statistics_to_mongodb(line, statistics_data):
     """Sauvegarde les résultats statistiques dans MongoDB en documents séparés"""
     client = get_mongodb_connection()
@@ -59,22 +86,7 @@ def save_statistics_to_mongodb(line, statistics_data):
         db = client['107_DEF_KPI_dashboard']
         
         #  Sauvegarder les variables individuellement
-        variables_collection = db['statistics_variables']
-        variables_count = 0
-        
-        for var_name, var_data in statistics_data.get("Variables", {}).items():
-            if var_data:  # Vérifier que les données ne sont pas vides
-                variable_doc = {
-                    "line": line,
-                    "variable_name": var_name,
-                    **var_data
-                }
-                variables_collection.update_one(
-                    {"line": line, "variable_name": var_name},
-                    {"$set": variable_doc},
-                    upsert=True
-                )
-                variables_count += 1
+        variables_count = enregistrer_variables(db, line, statistics_data.get("Variables", {}))
         
         #  Sauvegarder les relations individuellement
         relations_collection = db['statistics_relations']
@@ -173,8 +185,9 @@ def expand_nested_columns(df):
             expanded_dfs.append(df[[col]])
     return pd.concat(expanded_dfs, axis=1)
 
-def get_data_from_mongodb(line, method='4fill'):
-    """Récupère les données depuis MongoDB pour une ligne spécifique"""
+def get_data_from_mongodb(line, method='4fill', batch_ids=None):
+    """Récupère les données depuis MongoDB pour une ligne spécifique
+    (limitées aux documents des lots `batch_ids` si renseigné)"""
     client = get_mongodb_connection()
     if not client:
         return {"error": "Impossible de se connecter à MongoDB"}
@@ -191,19 +204,35 @@ def get_data_from_mongodb(line, method='4fill'):
             'source_line': line_letter,
             'imputation_method': method  # Utilise le paramètre ici
         }
+        # Documents sans batch_id (antérieurs aux lots d'import) retenus avec None
+        filtre_lots = {'batch_id': {'$in': list(batch_ids)}} if batch_ids is not None else {}
+        query.update(filtre_lots)
         documents = list(collection.find(query))
+        # Documents compacts (un par ligne horaire) : la méthode est matérialisée à la lecture
+        documents += [
+            materialiser_document(doc, method)
+            for doc in collection.find({'source_line': line_letter, 'layout': 'compact', 'imputation_methods': method, **filtre_lots})
+        ]
+        # Buckets (un document par jour) : convertis directement en colonnes NumPy
+        buckets = list(db['kpibuckets'].find(query).sort('day', 1))
         
-        if not documents:
+        if not documents and not buckets:
             # Message d'erreur plus clair
             return {"error": f"Aucune donnée trouvée pour la ligne {line_letter} avec la méthode '{method}'"}
         
-        print(f"✅ {len(documents)} documents récupérés pour la ligne {line_letter} (méthode: {method})")
+        print(f"✅ {len(documents)} documents et {len(buckets)} buckets récupérés pour la ligne {line_letter} (méthode: {method})")
         
-        df = pd.DataFrame(documents)
-        df = expand_nested_columns(df)
-        
-        if '_id' in df.columns:
-            df = df.drop('_id', axis=1)
+        frames = []
+        if documents:
+            df = pd.DataFrame(documents)
+            df = expand_nested_columns(df)
+            
+            if '_id' in df.columns:
+                df = df.drop('_id', axis=1)
+            frames.append(df)
+        if buckets:
+            frames.append(colonnes_buckets(buckets))
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
         
         print(f"📋 Dimensions initiales du DataFrame: {df.shape}")
         return df
@@ -224,7 +253,8 @@ def reconstruct_dataframe(documents):
     
     metadata_fields = ['_id', 'source_line', 'import_date', 'original_filenames', 
                       'imputation_method', 'original_row_index', 'date_c', 'mois', 
-                      'date_num', 'semaine', 'poste', 'heure']
+                      'date_num', 'semaine', 'poste', 'heure', 'row_fingerprint', 'layout',
+                      'imputation_methods', 'batch_id']
     
     for key_path in all_keys:
         if not any(excluded in key_path for excluded in metadata_fields):
@@ -328,55 +358,39 @@ def get_data(file_path):
     except Exception as e:
         return {"error": f"Erreur de lecture du fichier {file_path} : {str(e)}"}
 
-def analyze_quantitative(series):
-    series = series.dropna()
-    if len(series) == 0:
-        return {}
+def comptes_classes(valeurs, bins, poids=None):
+    """Effectifs des classes (bins[i], bins[i+1]], la première incluant bins[0] :
+    même affectation que pd.cut(include_lowest=True, right=True), avec np.bincount.
+    `poids` : effectif de chaque valeur (valeurs distinctes comptées)"""
+    nb_classes = len(bins) - 1
+    if nb_classes < 1:
+        return np.zeros(0, dtype='int64')
+    indices = np.clip(np.searchsorted(bins, valeurs, side='left') - 1, 0, nb_classes - 1)
+    return np.bincount(indices, weights=poids, minlength=nb_classes).astype('int64')
 
-    print(f"    - Quantitative : {series.name} (n={len(series)})")
-
-    bins = np.linspace(series.min(), series.max(), 51)
-    bins = np.unique(bins)
-    counts = pd.cut(series, bins=bins, include_lowest=True, right=True).value_counts().sort_index()
-    cumulative_count = 0
-    distribution_table = []
-    for i, count in enumerate(counts):
-        cumulative_count += count
-        if i < len(bins)-1:
-            distribution_table.append({
-                "classe": f"[{bins[i]:.2f}, {bins[i+1]:.2f}]",
-                "effectif": int(count),
-                "cumulatif": int(cumulative_count)
-            })
-    frequency_polygon = []
-    for i in range(len(bins)-1):
-        midpoint = (bins[i] + bins[i+1]) / 2
-        count_value = 0
-        for j, count_item in enumerate(counts.items()):
-            if j == i:
-                count_value = count_item[1]
-                break
-        frequency_polygon.append({
-            "x": float(midpoint),
-            "y": float(count_value)
-        })
+def resultat_quantitatif(n, bins, counts, mode, mean, std_dev, q1, median, q3, vmin, vmax, range_val, skewness, kurtosis_val):
+    """Assemble le résultat d'une variable quantitative à partir des effectifs et des moments"""
+    cumulatifs = np.cumsum(counts)
+    distribution_table = [
+        {
+            "classe": f"[{bins[i]:.2f}, {bins[i+1]:.2f}]",
+            "effectif": int(counts[i]),
+            "cumulatif": int(cumulatifs[i])
+        }
+        for i in range(len(counts))
+    ]
+    milieux = (bins[:-1] + bins[1:]) / 2
+    frequency_polygon = [
+        {"x": float(x), "y": float(y)} for x, y in zip(milieux, counts)
+    ]
 
-    mode = series.mode().iloc[0] if not series.mode().empty else None
-    median = series.median()
-    mean = series.mean()
-    std_dev = series.std()
-    q1 = series.quantile(0.25)
-    q3 = series.quantile(0.75)
     iqr = q3 - q1
-    range_val = series.max() - series.min()
     cv = std_dev / mean if mean != 0 else None
-    skewness = skew(series)
-    kurtosis_val = kurtosis(series)
-    x_norm = np.linspace(series.min(), series.max(), 100)
+    x_norm = np.linspace(vmin, vmax, 100)
     y_norm = norm.pdf(x_norm, mean, std_dev)
     
-    bin_width = (series.max() - series.min()) / 50
-    y_norm = y_norm * bin_width * len(series)
+    bin_width = (vmax - vmin) / 50
+    y_norm = y_norm * bin_width * n
     
     print(f"      Moyenne={mean:.2f}, Médiane={median:.2f}, Écart-type={std_dev:.2f}")
 
@@ -409,11 +423,11 @@ def analyze_quantitative(series):
                 for item in distribution_table
             ],
             "boxplot": {
-                "min": float(series.min()),
+                "min": float(vmin),
                 "q1": float(q1),
                 "median": float(median),
                 "q3": float(q3),
-                "max": float(series.max())
+                "max": float(vmax)
             },
             "normal_distribution": [
                 {"x": float(x), "y": float(y)} for x, y in zip(x_norm, y_norm)
@@ -422,11 +436,493 @@ def analyze_quantitative(series):
             "summary_stats": {
                 "mean": float(mean),
                 "std_dev": float(std_dev),
-                "sample_size": len(series)
+                "sample_size": n
             }
         }
     }
 
+def analyze_quantitative(series):
+    series = series.dropna()
+    if len(series) == 0:
+        return {}
+
+    print(f"    - Quantitative : {series.name} (n={len(series)})")
+
+    valeurs = series.to_numpy()
+    vmin, vmax = valeurs.min(), valeurs.max()
+    range_val = vmax - vmin
+    bins = np.unique(np.linspace(vmin, vmax, 51))
+    counts = comptes_classes(valeurs, bins)
+
+    uniques, effectifs = np.unique(valeurs, return_counts=True)
+    q1, median, q3 = np.quantile(valeurs, [0.25, 0.5, 0.75])
+
+    return resultat_quantitatif(
+        len(valeurs), bins, counts,
+        mode=uniques[np.argmax(effectifs)],
+        mean=series.mean(),
+        std_dev=series.std(),
+        q1=q1, median=median, q3=q3,
+        vmin=vmin, vmax=vmax, range_val=range_val,
+        skewness=skew(valeurs),
+        kurtosis_val=kurtosis(valeurs)
+    )
+
+def interpoler_quantiles(tries, effectifs, probabilites):
+    """Quantiles (interpolation linéaire, comme np.quantile) de chaque colonne d'un tableau
+    trié par colonne, les NaN en fin de colonne : tableau (len(probabilites), colonnes)"""
+    positions = np.outer(probabilites, effectifs - 1)
+    bas = np.floor(positions).astype('int64')
+    haut = np.minimum(bas + 1, effectifs - 1)
+    t = positions - bas
+    return interpolation_lineaire(np.take_along_axis(tries, bas, axis=0), np.take_along_axis(tries, haut, axis=0), t)
+
+def interpolation_lineaire(a, b, t):
+    """Même formule que np.quantile (_lerp), pour des résultats identiques"""
+    ecart = b - a
+    return np.where(t >= 0.5, b - ecart * (1 - t), a + ecart * t)
+
+def modes_colonnes(tries, effectifs):
+    """Mode (plus petite valeur la plus fréquente) de chaque colonne d'un tableau trié par
+    colonne, à partir des longueurs de séries de valeurs égales"""
+    colonnes = np.repeat(np.arange(tries.shape[1]), effectifs)
+    valeurs = tries.T[np.arange(tries.shape[0])[None, :] < effectifs[:, None]]
+    debut = np.ones(len(valeurs), dtype=bool)
+    debut[1:] = (valeurs[1:] != valeurs[:-1]) | (colonnes[1:] != colonnes[:-1])
+    series_debut = np.flatnonzero(debut)
+    longueurs = np.diff(np.append(series_debut, len(valeurs)))
+    colonne_serie = colonnes[series_debut]
+    premieres = np.searchsorted(colonne_serie, np.arange(tries.shape[1]))
+    plus_longues = np.maximum.reduceat(longueurs, premieres)
+    gagnantes = longueurs == plus_longues[colonne_serie]
+    _, premiere_gagnante = np.unique(colonne_serie[gagnantes], return_index=True)
+    return valeurs[series_debut[gagnantes][premiere_gagnante]]
+
+def analyze_quantitative_batch(df):
+    """Variante groupée d'analyze_quantitative pour toutes les colonnes float d'une ligne :
+    histogrammes (un seul np.bincount), quantiles, modes et moments calculés sur un tableau 2-D.
+    Retourne {colonne: résultat} ; les colonnes non float ou dont les classes seraient
+    dégénérées (étendue nulle ou quasi nulle) sont laissées à analyze_column."""
+    colonnes = []
+    for col in df.columns:
+        try:
+            serie = pd.to_numeric(df[col], errors='raise')
+        except (ValueError, TypeError):
+            continue
+        if serie.dtype.kind == 'f':
+            colonnes.append((col, serie))
+    if not colonnes:
+        return {}
+
+    valeurs = np.column_stack([serie.to_numpy() for _, serie in colonnes])
+    effectifs = (~np.isnan(valeurs)).sum(axis=0)
+    resultats = {col: {} for (col, _), n in zip(colonnes, effectifs) if n == 0}
+
+    tries = np.sort(valeurs, axis=0)
+    vmin = tries[0]
+    vmax = np.take_along_axis(tries, np.maximum(effectifs - 1, 0)[None, :], axis=0)[0]
+    gardees = np.flatnonzero((effectifs > 0) & (vmax > vmin))
+    # Bords calculés sur les seules colonnes d'étendue non nulle : np.linspace change de
+    # formule dès qu'un pas est nul, les bords ne seraient plus ceux du calcul par colonne
+    bords = np.linspace(vmin[gardees], vmax[gardees], 51, axis=1)
+    distincts = np.all(np.diff(bords, axis=1) > 0, axis=1)
+    gardees, bords = gardees[distincts], bords[distincts]
+    if len(gardees) == 0:
+        return resultats
+
+    tries, effectifs = tries[:, gardees], effectifs[gardees]
+    valeurs = valeurs[:, gardees]
+    vmin, vmax = vmin[gardees], vmax[gardees]
+
+    # Histogrammes : classe estimée par l'échelle linéaire puis corrigée sur les bords réels,
+    # les effectifs de toutes les colonnes en un seul bincount
+    lignes, cols = np.nonzero(~np.isnan(valeurs))
+    v = valeurs[lignes, cols]
+    estimee = np.clip(np.ceil((v - vmin[cols]) / (vmax[cols] - vmin[cols]) * 50).astype('int64'), 0, 50)
+    for _ in range(2):
+        estimee += (estimee < 51) & (bords[cols, np.minimum(estimee, 50)] < v)
+        estimee -= (estimee > 0) & (bords[cols, np.maximum(estimee - 1, 0)] >= v)
+    classes = np.clip(estimee - 1, 0, 49)
+    counts = np.bincount(cols * 50 + classes, minlength=len(gardees) * 50).reshape(len(gardees), 50)
+
+    q1, median, q3 = interpoler_quantiles(tries, effectifs, [0.25, 0.5, 0.75])
+    modes = modes_colonnes(tries, effectifs)
+
+    moyennes = np.nansum(valeurs, axis=0) / effectifs
+    ecarts = valeurs - moyennes
+    m2 = np.nansum(ecarts ** 2, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(m2 / (effectifs - 1))
+        m2 = m2 / effectifs
+        skewness = (np.nansum(ecarts ** 3, axis=0) / effectifs) / m2 ** 1.5
+        kurtosis_val = (np.nansum(ecarts ** 4, axis=0) / effectifs) / m2 ** 2 - 3
+
+    print(f"    - Quantitatives (groupées) : {len(gardees)} colonnes")
+    for k, j in enumerate(gardees):
+        col = colonnes[j][0]
+        print(f"    - Quantitative : {col} (n={effectifs[k]})")
+        resultats[col] = resultat_quantitatif(
+            int(effectifs[k]), bords[k], counts[k],
+            mode=modes[k],
+            mean=moyennes[k],
+            std_dev=std[k],
+            q1=q1[k], median=median[k], q3=q3[k],
+            vmin=vmin[k], vmax=vmax[k], range_val=vmax[k] - vmin[k],
+            skewness=skewness[k],
+            kurtosis_val=kurtosis_val[k]
+        )
+    return resultats
+
+# Statistiques suffisantes par ligne et par variable (collection statistics_sufficient) :
+# effectif, sommes des puissances 1 à 4, min/max, histogramme à bords fixes, sketch de
+# quantiles fusionnable et comptes exacts des valeurs (tant qu'elles sont peu nombreuses).
+# Elles sont mises à jour lot d'import par lot d'import ; les statistiques descriptives des
+# variables quantitatives en sont dérivées sans relire les documents kpidatas.
+NOM_COLLECTION_STATS_SUFFISANTES = 'statistics_sufficient'
+
+# À incrémenter quand la structure des statistiques suffisantes change (reconstruction)
+VERSION_STATS_SUFFISANTES = 1
+
+DELTA_SKETCH = 200              # compression du sketch (environ DELTA_SKETCH / 2 centroïdes)
+CLASSES_HISTOGRAMME = 1024      # résolution visée de l'histogramme à bords fixes
+TAILLE_MAX_HISTOGRAMME = 4096   # classes non vides au-delà desquelles la largeur double
+TAILLE_MAX_VALEURS = 2048       # valeurs distinctes comptées exactement
+
+def decaler_sommes(n, sommes, de, vers):
+    """Sommes des puissances 1 à 4 de (v - vers) à partir de celles de (v - de)"""
+    c = de - vers
+    s = [n] + list(sommes)
+    return [
+        sum(comb(k, j) * c ** (k - j) * s[j] for j in range(k + 1))
+        for k in range(1, 5)
+    ]
+
+def compresser_sketch(moyennes, poids, delta=DELTA_SKETCH):
+    """Sketch de quantiles (centroïdes moyenne/poids, à la manière du t-digest) : les centroïdes
+    voisins sont regroupés selon l'échelle k1, plus fine aux extrémités de la distribution.
+    Deux sketches se fusionnent en concaténant leurs centroïdes puis en recompressant."""
+    moyennes, poids = np.asarray(moyennes, dtype='float64'), np.asarray(poids, dtype='float64')
+    ordre = np.argsort(moyennes, kind='stable')
+    moyennes, poids = moyennes[ordre], poids[ordre]
+    if len(moyennes) > delta // 2:
+        q = (np.cumsum(poids) - poids / 2) / poids.sum()
+        echelle = delta / (2 * np.pi) * np.arcsin(2 * q - 1)
+        _, groupes = np.unique(np.floor(echelle - echelle[0]), return_inverse=True)
+        poids_groupes = np.bincount(groupes, weights=poids)
+        moyennes = np.bincount(groupes, weights=poids * moyennes) / poids_groupes
+        poids = poids_groupes
+    return {"moyennes": moyennes.tolist(), "poids": poids.tolist()}
+
+def exposant_histogramme(vmin, vmax):
+    """Largeur des classes de l'histogramme à bords fixes : une puissance de deux, de sorte que
+    deux histogrammes se fusionnent toujours en ramenant le plus fin à la largeur du plus large"""
+    plafond = int(np.floor(np.log2(max(abs(vmin), abs(vmax), 1.0)))) - 40
+    if vmax > vmin:
+        return max(int(np.floor(np.log2((vmax - vmin) / CLASSES_HISTOGRAMME))), plafond)
+    return plafond + 20
+
+def elargir_histogramme(histogramme, exposant):
+    """Ramène un histogramme {exposant, indices, effectifs} à une largeur 2**exposant plus grande
+    (puis la double tant qu'il a plus de TAILLE_MAX_HISTOGRAMME classes non vides)"""
+    indices = np.asarray(histogramme["indices"], dtype='int64')
+    effectifs = np.asarray(histogramme["effectifs"], dtype='int64')
+    exposant = max(exposant, histogramme["exposant"])
+    while True:
+        indices_larges, groupes = np.unique(indices // (1 << (exposant - histogramme["exposant"])), return_inverse=True)
+        if len(indices_larges) <= TAILLE_MAX_HISTOGRAMME:
+            break
+        exposant += 1
+    return {
+        "exposant": exposant,
+        "indices": indices_larges.tolist(),
+        "effectifs": np.bincount(groupes, weights=effectifs).astype('int64').tolist()
+    }
+
+def partiel_depuis_valeurs(valeurs):
+    """Statistiques suffisantes d'un tableau de valeurs (sans NaN)"""
+    origine = float(valeurs.mean())
+    ecarts = valeurs - origine
+    uniques, effectifs = np.unique(valeurs, return_counts=True)
+    vmin, vmax = float(uniques[0]), float(uniques[-1])
+    exposant = exposant_histogramme(vmin, vmax)
+    indices, comptes = np.unique(np.floor(valeurs / 2.0 ** exposant).astype('int64'), return_counts=True)
+    return {
+        "n": int(len(valeurs)),
+        "origine": origine,
+        "sommes": [float(np.sum(ecarts ** k)) for k in range(1, 5)],
+        "min": vmin,
+        "max": vmax,
+        "histogramme": elargir_histogramme({"exposant": exposant, "indices": indices, "effectifs": comptes}, exposant),
+        "sketch": compresser_sketch(uniques, effectifs),
+        "valeurs": {"valeurs": uniques.tolist(), "effectifs": effectifs.tolist()} if len(uniques) <= TAILLE_MAX_VALEURS else None
+    }
+
+def fusionner_partiels(a, b):
+    """Fusionne deux statistiques suffisantes (l'origine des sommes de `a` est conservée)"""
+    # Histogrammes ramenés à la même largeur (la plus grande), puis classes additionnées
+    exposant = max(a["histogramme"]["exposant"], b["histogramme"]["exposant"])
+    ha, hb = elargir_histogramme(a["histogramme"], exposant), elargir_histogramme(b["histogramme"], exposant)
+    exposant = max(ha["exposant"], hb["exposant"])
+    ha, hb = elargir_histogramme(ha, exposant), elargir_histogramme(hb, exposant)
+    histogramme = elargir_histogramme({
+        "exposant": exposant,
+        "indices": ha["indices"] + hb["indices"],
+        "effectifs": ha["effectifs"] + hb["effectifs"]
+    }, exposant)
+
+    valeurs = None
+    if a["valeurs"] is not None and b["valeurs"] is not None:
+        uniques, groupes = np.unique(a["valeurs"]["valeurs"] + b["valeurs"]["valeurs"], return_inverse=True)
+        if len(uniques) <= TAILLE_MAX_VALEURS:
+            effectifs = np.bincount(groupes, weights=a["valeurs"]["effectifs"] + b["valeurs"]["effectifs"])
+            valeurs = {"valeurs": uniques.tolist(), "effectifs": effectifs.astype('int64').tolist()}
+
+    return {
+        "n": a["n"] + b["n"],
+        "origine": a["origine"],
+        "sommes": [x + y for x, y in zip(a["sommes"], decaler_sommes(b["n"], b["sommes"], b["origine"], a["origine"]))],
+        "min": min(a["min"], b["min"]),
+        "max": max(a["max"], b["max"]),
+        "histogramme": histogramme,
+        "sketch": compresser_sketch(a["sketch"]["moyennes"] + b["sketch"]["moyennes"],
+                                    a["sketch"]["poids"] + b["sketch"]["poids"]),
+        "valeurs": valeurs
+    }
+
+def quantiles_valeurs(valeurs, effectifs, probabilites):
+    """Quantiles exacts (interpolation linéaire, comme np.quantile) à partir des valeurs
+    distinctes triées et de leurs effectifs"""
+    cumuls = np.cumsum(effectifs)
+    positions = np.asarray(probabilites) * (cumuls[-1] - 1)
+    bas = np.floor(positions)
+    haut = np.minimum(bas + 1, cumuls[-1] - 1)
+    a = valeurs[np.searchsorted(cumuls, bas, side='right')]
+    b = valeurs[np.searchsorted(cumuls, haut, side='right')]
+    return interpolation_lineaire(a, b, positions - bas)
+
+def quantiles_sketch(sketch, n, vmin, vmax, probabilites):
+    """Quantiles approchés d'un sketch : interpolation entre les centres des centroïdes"""
+    poids = np.asarray(sketch["poids"])
+    centres = np.cumsum(poids) - poids / 2
+    return np.interp(
+        np.asarray(probabilites) * n,
+        np.concatenate([[0], centres, [n]]),
+        np.concatenate([[vmin], sketch["moyennes"], [vmax]])
+    )
+
+def analyze_quantitative_from_stats(nom, partiel):
+    """Statistiques descriptives d'une variable dérivées de ses statistiques suffisantes, en
+    temps constant par variable. Histogramme, quartiles et mode sont exacts tant que les
+    valeurs distinctes sont comptées, approchés sinon (histogramme à bords fixes, sketch)."""
+    n = partiel["n"]
+    vmin, vmax = partiel["min"], partiel["max"]
+    mean = partiel["origine"] + partiel["sommes"][0] / n
+    _, c2, c3, c4 = np.asarray(decaler_sommes(n, partiel["sommes"], partiel["origine"], mean), dtype='float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std_dev = np.sqrt(c2 / (n - 1)) if n > 1 else np.nan
+        m2 = c2 / n
+        skewness = (c3 / n) / m2 ** 1.5
+        kurtosis_val = (c4 / n) / m2 ** 2 - 3
+
+    print(f"    - Quantitative : {nom} (n={n}, statistiques suffisantes)")
+
+    bins = np.unique(np.linspace(vmin, vmax, 51))
+    exact = partiel["valeurs"] is not None
+    if exact:
+        valeurs = np.asarray(partiel["valeurs"]["valeurs"], dtype='float64')
+        effectifs = np.asarray(partiel["valeurs"]["effectifs"], dtype='int64')
+        counts = comptes_classes(valeurs, bins, effectifs)
+        q1, median, q3 = quantiles_valeurs(valeurs, effectifs, [0.25, 0.5, 0.75])
+        mode = valeurs[np.argmax(effectifs)]
+    else:
+        histogramme = partiel["histogramme"]
+        centres = (np.asarray(histogramme["indices"], dtype='float64') + 0.5) * 2.0 ** histogramme["exposant"]
+        effectifs = np.asarray(histogramme["effectifs"], dtype='int64')
+        counts = comptes_classes(np.clip(centres, vmin, vmax), bins, effectifs)
+        q1, median, q3 = quantiles_sketch(partiel["sketch"], n, vmin, vmax, [0.25, 0.5, 0.75])
+        mode = centres[np.argmax(effectifs)]
+
+    resultat = resultat_quantitatif(
+        n, bins, counts,
+        mode=mode,
+        mean=mean,
+        std_dev=std_dev,
+        q1=q1, median=median, q3=q3,
+        vmin=vmin, vmax=vmax, range_val=vmax - vmin,
+        skewness=skewness,
+        kurtosis_val=kurtosis_val
+    )
+    resultat["statistiques_suffisantes"] = {"exact": exact}
+    return resultat
+
+def partiels_depuis_dataframe(df):
+    """Statistiques suffisantes de chaque variable d'un DataFrame de documents.
+    None pour une variable non quantitative (même critère qu'analyze_column)."""
+    partiels = {}
+    for col in df.columns:
+        try:
+            serie = pd.to_numeric(df[col], errors='raise')
+        except (ValueError, TypeError):
+            partiels[col] = None
+            continue
+        if pd.api.types.is_bool_dtype(serie):
+            partiels[col] = None
+            continue
+        valeurs = serie.dropna().to_numpy(dtype='float64')
+        if len(valeurs):
+            partiels[col] = partiel_depuis_valeurs(valeurs)
+    return partiels
+
+# Verrou de la mise à jour des statistiques suffisantes, par ligne et méthode : l'import et
+# l'annulation d'un lot (ou une analyse scope=variables) peuvent la lancer en même temps
+NOM_COLLECTION_VERROUS_STATS = 'statistics_locks'
+DUREE_VERROU_STATS = int(os.getenv('STATISTICS_LOCK_SECONDS', '1800'))
+
+def acquerir_verrou_statistiques(db, cle, duree=DUREE_VERROU_STATS, attente=DUREE_VERROU_STATS):
+    """Prend le verrou `cle` (find_one_and_update conditionnel : libre ou expiré), en attendant
+    au plus `attente` secondes qu'il se libère. Retourne le jeton du verrou, None si l'attente
+    a expiré. Un verrou dont le détenteur s'est arrêté expire au bout de `duree` secondes"""
+    import time
+    from uuid import uuid4
+    from datetime import datetime, timedelta
+    from pymongo.errors import DuplicateKeyError
+
+    jeton = uuid4().hex
+    limite = time.monotonic() + attente
+    while True:
+        maintenant = datetime.utcnow()
+        try:
+            db[NOM_COLLECTION_VERROUS_STATS].find_one_and_update(
+                {'_id': cle, 'expire_at': {'$lt': maintenant}},
+                {'$set': {'jeton': jeton, 'expire_at': maintenant + timedelta(seconds=duree)}},
+                upsert=True
+            )
+            return jeton
+        except DuplicateKeyError:
+            # Verrou détenu par une autre mise à jour : l'insertion du même _id est refusée
+            if time.monotonic() >= limite:
+                return None
+            time.sleep(1)
+
+def liberer_verrou_statistiques(db, cle, jeton):
+    db[NOM_COLLECTION_VERROUS_STATS].delete_one({'_id': cle, 'jeton': jeton})
+
+def mettre_a_jour_statistiques_suffisantes(line, method='4fill'):
+    """Applique aux statistiques suffisantes de la ligne les lots d'import terminés qui ne l'ont
+    pas encore été, en ne lisant que leurs documents (index batch_id). Reconstruction complète
+    si le store est absent, si un lot appliqué a été annulé ou si un nouveau lot a remplacé
+    des documents (leurs anciennes valeurs ne peuvent pas être retirées des sommes).
+    Les mises à jour d'une même ligne et méthode sont sérialisées (acquerir_verrou_statistiques)."""
+    client = get_mongodb_connection()
+    if not client:
+        return {"error": "Impossible de se connecter à MongoDB"}
+
+    jeton = None
+    try:
+        db = client['107_DEF_KPI_dashboard']
+        store = db[NOM_COLLECTION_STATS_SUFFISANTES]
+        line_letter = line.replace('107', '')
+        id_etat = f"{line_letter}|{method}"
+        jeton = acquerir_verrou_statistiques(db, id_etat)
+        if jeton is None:
+            return {"error": f"Mise à jour des statistiques suffisantes déjà en cours pour la ligne {line_letter}"}
+
+        lots = list(db['ingest_batches'].find(
+            {'source_line': line_letter, 'imputation_methods': method}, {'status': 1, 'summary': 1}
+        ).sort('started_at', 1))
+        termines = [lot['_id'] for lot in lots if lot.get('status', 'completed') == 'completed']
+        remplacants = {lot['_id'] for lot in lots if (lot.get('summary') or {}).get('replaced')}
+
+        etat = store.find_one({'_id': id_etat})
+        appliques = etat['batch_ids'] if etat and etat.get('version') == VERSION_STATS_SUFFISANTES else None
+        en_attente = [b for b in termines if appliques is not None and b not in appliques]
+        reconstruire = (appliques is None
+                        or any(b not in termines for b in appliques)
+                        or any(b in remplacants for b in en_attente))
+        if not reconstruire and not en_attente:
+            print(f"✅ Statistiques suffisantes à jour pour la ligne {line_letter} ({len(appliques)} lots)")
+            return {"status": "up_to_date", "batches": len(appliques)}
+
+        # Reconstruction : lots terminés et documents antérieurs aux lots d'import (sans batch_id)
+        df = get_data_from_mongodb(line, method, batch_ids=termines + [None] if reconstruire else en_attente)
+        if isinstance(df, dict):
+            if not df["error"].startswith("Aucune donnée"):
+                return df
+            df = pd.DataFrame()
+        partiels = partiels_depuis_dataframe(df.drop(columns=COLONNES_EXCLUES, errors='ignore'))
+
+        if reconstruire:
+            store.delete_many({'line': line_letter, 'imputation_method': method})
+        for variable, partiel in partiels.items():
+            id_variable = f"{id_etat}|{variable}"
+            ancien = None if reconstruire else store.find_one({'_id': id_variable})
+            if ancien is None:
+                stats = partiel
+            elif partiel is None or not ancien['quantitative']:
+                stats = None
+            else:
+                stats = fusionner_partiels(ancien['stats'], partiel)
+            store.replace_one({'_id': id_variable}, {
+                '_id': id_variable,
+                'line': line_letter,
+                'imputation_method': method,
+                'variable': variable,
+                'quantitative': stats is not None,
+                'stats': stats
+            }, upsert=True)
+
+        appliques = termines if reconstruire else appliques + en_attente
+        store.replace_one({'_id': id_etat}, {
+            '_id': id_etat,
+            'line': line_letter,
+            'imputation_method': method,
+            'version': VERSION_STATS_SUFFISANTES,
+            'batch_ids': appliques,
+            'updated_at': pd.Timestamp.now().isoformat()
+        }, upsert=True)
+
+        statut = "rebuilt" if reconstruire else "updated"
+        print(f"✅ Statistiques suffisantes {'reconstruites' if reconstruire else 'mises à jour'} pour la ligne {line_letter}: "
+              f"{len(df)} documents lus, {len(partiels)} variables")
+        return {"status": statut, "batches": len(appliques), "documents_read": len(df), "variables": len(partiels)}
+    except Exception as e:
+        return {"error": f"Erreur MongoDB: {str(e)}"}
+    finally:
+        if jeton is not None:
+            liberer_verrou_statistiques(db, id_etat, jeton)
+        client.close()
+
+def analyze_variables_from_store(line, method='4fill'):
+    """Met à jour les statistiques suffisantes puis recalcule les statistiques des variables
+    quantitatives à partir d'elles seules (sans relire les documents de la ligne) et les
+    enregistre dans statistics_variables. Les variables qualitatives et les relations restent
+    celles de la dernière analyse complète."""
+    mise_a_jour = mettre_a_jour_statistiques_suffisantes(line, method)
+    if "error" in mise_a_jour:
+        print(f"❌ Erreur: {mise_a_jour['error']}")
+        return mise_a_jour
+
+    client = get_mongodb_connection()
+    if not client:
+        return {"error": "Impossible de se connecter à MongoDB"}
+    try:
+        db = client['107_DEF_KPI_dashboard']
+        documents = db[NOM_COLLECTION_STATS_SUFFISANTES].find(
+            {'line': line.replace('107', ''), 'imputation_method': method, 'quantitative': True}
+        )
+        print(f"\n--- Variables quantitatives depuis les statistiques suffisantes ---")
+        variables = convert_numpy_types({
+            doc['variable']: analyze_quantitative_from_stats(doc['variable'], doc['stats'])
+            for doc in documents
+        })
+        variables_count = enregistrer_variables(db, line, variables)
+        print(f"✅ {variables_count} variables mises à jour pour la ligne {line}")
+        return {"success": True, "variables": variables_count, "store": mise_a_jour}
+    except Exception as e:
+        return {"error": f"Erreur MongoDB: {str(e)}"}
+    finally:
+        client.close()
+
 def analyze_qualitative(series):
     series = series.dropna()
     if len(series) == 0:
@@ -451,7 +947,210 @@ def analyze_qualitative(series):
         }
     }
 
-def analyze_relations(df):
+# Graphiques PNG : le frontend trace les relations à partir de chart_data, le rendu
+# matplotlib n'est donc fait que sur demande (--png ou STATISTICS_RENDER_PNG=1)
+RENDU_PNG_PAR_DEFAUT = os.getenv('STATISTICS_RENDER_PNG', '0') == '1'
+
+TYPES_GRAPHIQUES = ('regression', 'barre_groupe', 'barre_empile', 'boxplot')
+
+# Cache des graphiques rendus sur demande, adressé par le contenu (version des données + relation),
+# taille bornée par PIPELINE_CACHE_MAX_MB (voir cache_disque.py)
+REPERTOIRE_CACHE_GRAPHIQUES = Path(os.getenv('STATISTICS_CHART_CACHE_DIR', tempfile.gettempdir())) / 'kpi_graphiques'
+
+# À incrémenter quand le rendu des graphiques change
+VERSION_GRAPHIQUES = 1
+
+def tracer_graphique(sub_df, kind, var1, var2):
+    """Rend un graphique de relation en PNG et retourne les octets.
+    regression : var1 (cible) vs var2 ; barre_groupe / barre_empile : tableau de contingence
+    var1 x var2 ; boxplot : var1 (quantitative) par var2 (qualitative)."""
+    img = io.BytesIO()
+    if kind == 'regression':
+        plt.figure(figsize=(6,4))
+        sns.regplot(x=var1, y=var2, data=sub_df)
+        plt.title(f"Linear Regression: {var1} vs {var2}")
+    elif kind in ('barre_groupe', 'barre_empile'):
+        contingency_table = pd.crosstab(sub_df[var1], sub_df[var2])
+        empile = kind == 'barre_empile'
+        contingency_table.plot(kind="bar", stacked=empile)
+        plt.title(f"{'Stacked' if empile else 'Grouped'} Bar Chart: {var1} vs {var2}")
+    elif kind == 'boxplot':
+        plt.figure(figsize=(6,4))
+        sns.boxplot(x=var2, y=var1, data=sub_df)
+        plt.title(f"Box Plot: {var1} by {var2}")
+    else:
+        raise ValueError(f"Type de graphique inconnu : {kind} (attendu : {', '.join(TYPES_GRAPHIQUES)})")
+    plt.tight_layout()
+    plt.savefig(img, format='png')
+    plt.close()
+    return img.getvalue()
+
+def image_base64(png):
+    return f"data:image/png;base64,{base64.b64encode(png).decode('utf-8')}"
+
+def version_donnees(db, line_letter, method):
+    """Version des données d'une ligne : empreinte des lots d'import (ingest_batches) et de leur
+    statut, qui change à chaque import ou annulation. None si aucun lot n'est enregistré."""
+    lots = list(db['ingest_batches'].find(
+        {'source_line': line_letter, 'imputation_methods': method}, {'_id': 1, 'status': 1}
+    ).sort('_id', 1))
+    if not lots:
+        return None
+    return hashlib.sha256(json.dumps([[str(lot['_id']), lot.get('status')] for lot in lots]).encode('utf-8')).hexdigest()
+
+def cle_graphique(version, line_letter, method, kind, var1, var2):
+    forme = json.dumps([VERSION_GRAPHIQUES, version, line_letter, method, kind, var1, var2], ensure_ascii=False)
+    return hashlib.sha256(forme.encode('utf-8')).hexdigest()
+
+def render_relation_chart(line, var1, var2, kind='regression', method='4fill'):
+    """Rend un seul graphique de relation sur demande et le garde dans le cache.
+    La clé est calculée avant de lire les données quand la version est connue (lots d'import) :
+    un graphique déjà rendu est servi sans requête sur kpidatas. Sans lot enregistré,
+    la clé est l'empreinte du contenu des deux colonnes."""
+    if kind not in TYPES_GRAPHIQUES:
+        return {"error": f"Type de graphique inconnu : {kind} (attendu : {', '.join(TYPES_GRAPHIQUES)})"}
+    line_letter = line.replace('107', '')
+
+    version = None
+    client = get_mongodb_connection()
+    if client:
+        try:
+            version = version_donnees(client['107_DEF_KPI_dashboard'], line_letter, method)
+        except Exception as e:
+            print(f"⚠️ Version des données indisponible : {e}")
+        finally:
+            client.close()
+
+    if version:
+        fichier = REPERTOIRE_CACHE_GRAPHIQUES / f"{cle_graphique(version, line_letter, method, kind, var1, var2)}.png"
+        if fichier.exists():
+            marquer_utilise(fichier)
+            return {"chart": str(fichier), "cached": True}
+
+    df = get_data_from_mongodb(line, method)
+    if isinstance(df, dict):
+        return df
+    for col in (var1, var2):
+        if col not in df.columns:
+            return {"error": f"Colonne introuvable : {col}"}
+    sub_df = df[[var1, var2]].dropna()
+    if sub_df.empty:
+        return {"error": f"Aucune donnée commune pour {var1} et {var2}"}
+
+    if not version:
+        version = 'contenu:' + hashlib.sha256(pd.util.hash_pandas_object(sub_df, index=False).values.tobytes()).hexdigest()
+        fichier = REPERTOIRE_CACHE_GRAPHIQUES / f"{cle_graphique(version, line_letter, method, kind, var1, var2)}.png"
+        if fichier.exists():
+            marquer_utilise(fichier)
+            return {"chart": str(fichier), "cached": True}
+
+    png = tracer_graphique(sub_df, kind, var1, var2)
+    REPERTOIRE_CACHE_GRAPHIQUES.mkdir(parents=True, exist_ok=True)
+    temporaire = fichier.with_suffix(f'.{os.getpid()}.tmp')
+    temporaire.write_bytes(png)
+    os.replace(temporaire, fichier)
+    limiter_cache(REPERTOIRE_CACHE_GRAPHIQUES, '*.png', garder=fichier)
+    return {"chart": str(fichier), "cached": False}
+
+# Réduction des nuages de points stockés dans chart_data.scatter_data (documents
+# statistics_relations) : 'uniform', 'stratified', 'bins' (comptes 2-D) ou 'none'
+MODE_NUAGE = os.getenv('STATISTICS_SCATTER_MODE', 'stratified')
+BUDGET_NUAGE = int(os.getenv('STATISTICS_SCATTER_BUDGET', '500'))
+MODES_NUAGE = ('uniform', 'stratified', 'bins', 'none')
+
+def reduire_nuage(x, y, mode=MODE_NUAGE, budget=BUDGET_NUAGE):
+    """Réduit un nuage (x, y) à environ `budget` points, sans boucle Python sur les points.
+    uniform : points régulièrement espacés dans l'ordre des lignes ;
+    stratified : grille 2-D, chaque case non vide garde au moins un point puis une part
+    proportionnelle à son effectif (les points isolés sont conservés) ;
+    bins : comptes sur une grille 2-D, un point {x, y, count} par case non vide.
+    Retourne (scatter_data, description de la réduction)."""
+    if mode not in MODES_NUAGE:
+        raise ValueError(f"Mode de réduction inconnu : {mode} (attendu : {', '.join(MODES_NUAGE)})")
+    n = len(x)
+    reduction = {"mode": mode, "budget": budget, "sample_size": n}
+
+    if mode == 'bins':
+        cases = max(1, int(np.sqrt(budget)))
+        comptes, bords_x, bords_y = np.histogram2d(x, y, bins=cases)
+        ix, iy = np.nonzero(comptes)
+        centres_x = (bords_x[:-1] + bords_x[1:]) / 2
+        centres_y = (bords_y[:-1] + bords_y[1:]) / 2
+        points = [
+            {"x": float(vx), "y": float(vy), "count": int(c)}
+            for vx, vy, c in zip(centres_x[ix], centres_y[iy], comptes[ix, iy])
+        ]
+        reduction["points"] = len(points)
+        return points, reduction
+
+    if mode == 'none' or n <= budget:
+        garder = np.arange(n)
+    elif mode == 'uniform':
+        garder = np.unique(np.linspace(0, n - 1, budget).round().astype('int64'))
+    else:
+        cases = max(1, int(np.sqrt(budget / 2)))
+        _, bords_x = np.histogram(x, bins=cases)
+        _, bords_y = np.histogram(y, bins=cases)
+        case = (np.clip(np.searchsorted(bords_x, x, side='right') - 1, 0, cases - 1) * cases
+                + np.clip(np.searchsorted(bords_y, y, side='right') - 1, 0, cases - 1))
+        ordre = np.argsort(case, kind='stable')
+        effectifs = np.bincount(case, minlength=cases * cases)
+        quotas = np.where(effectifs > 0, np.maximum(1, (budget * effectifs) // n), 0)
+        debuts = np.cumsum(effectifs) - effectifs
+        rang = np.arange(n) - debuts[case[ordre]]
+        c, q = effectifs[case[ordre]], quotas[case[ordre]]
+        # q points régulièrement espacés parmi les c points de la case
+        choisis = ((rang + 1) * q) // c - (rang * q) // c == 1
+        garder = np.sort(ordre[choisis])
+
+    points = [{"x": float(vx), "y": float(vy)} for vx, vy in zip(x[garder], y[garder])]
+    reduction["points"] = len(points)
+    return points, reduction
+
+def matrices_relations(df, cibles, colonnes):
+    """Statistiques de toutes les paires cible x colonne sur les observations communes
+    (équivalent d'un dropna par paire) : effectif, covariance, corrélation de Pearson,
+    pente et ordonnée à l'origine de la régression colonne ~ cible.
+    Calculées par quelques produits matriciels sur des tableaux float masqués ;
+    chaque colonne est d'abord centrée sur sa moyenne pour limiter les pertes de précision."""
+    x = df[cibles].astype('float64').to_numpy()
+    y = df[colonnes].astype('float64').to_numpy()
+    mx, my = ~np.isnan(x), ~np.isnan(y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centre_x, centre_y = np.nanmean(x, axis=0), np.nanmean(y, axis=0)
+        x = np.where(mx, x - centre_x, 0.0)
+        y = np.where(my, y - centre_y, 0.0)
+        mx, my = mx.astype('float64'), my.astype('float64')
+
+        n = mx.T @ my
+        sx, sy = x.T @ my, mx.T @ y
+        sxx, syy, sxy = (x * x).T @ my, mx.T @ (y * y), x.T @ y
+
+        moy_x, moy_y = sx / n, sy / n
+        cxy = sxy - sx * moy_y
+        cxx = sxx - sx * moy_x
+        cyy = syy - sy * moy_y
+        # Variance nulle à l'arrondi près : pente indéfinie, la paire est recalculée directement
+        degeneres = (cxx <= 1e-12 * sxx) | (cyy <= 1e-12 * syy)
+        pente = np.where(degeneres, np.nan, cxy / cxx)
+        return {
+            "n": n.astype('int64'),
+            "covariance": cxy / (n - 1),
+            "correlation": np.clip(cxy / np.sqrt(cxx * cyy), -1.0, 1.0),
+            "pente": pente,
+            "ordonnee_origine": (moy_y + centre_y[None, :]) - pente * (moy_x + centre_x[:, None]),
+        }
+
+def statistiques_paire(sub_df, target_col, other_col):
+    """Calcul direct pour une paire (cas dégénérés : variable constante sur les observations communes)"""
+    cov = sub_df[target_col].cov(sub_df[other_col])
+    corr, _ = pearsonr(sub_df[target_col], sub_df[other_col])
+    slope, intercept = np.polyfit(sub_df[target_col], sub_df[other_col], 1)
+    return cov, corr, slope, intercept
+
+def analyze_relations(df, rendre_png=False, mode_nuage=MODE_NUAGE, budget_nuage=BUDGET_NUAGE):
+    if mode_nuage not in MODES_NUAGE:
+        raise ValueError(f"Mode de réduction inconnu : {mode_nuage} (attendu : {', '.join(MODES_NUAGE)})")
     relations = {}
     print("\n--- Analyse des relations ---")
     relation_counter = 1
@@ -469,31 +1168,21 @@ def analyze_relations(df):
 
                     try:
                         contingency_table = pd.crosstab(df[c1], df[c2])
+                        if contingency_table.empty:
+                            # Aucune paire observée : relation non retenue (comme lorsque le rendu échouait)
+                            print(f"    ✗ Empty contingency table for {c1} vs {c2}")
+                            continue
 
-                        img_grouped = io.BytesIO()
-                        contingency_table.plot(kind="bar", stacked=False)
-                        plt.title(f"Grouped Bar Chart: {c1} vs {c2}")
-                        plt.tight_layout()
-                        plt.savefig(img_grouped, format='png')
-                        plt.close()
-                        img_grouped_base64 = base64.b64encode(img_grouped.getvalue()).decode('utf-8')
-
-                        img_stacked = io.BytesIO()
-                        contingency_table.plot(kind="bar", stacked=True)
-                        plt.title(f"Stacked Bar Chart: {c1} vs {c2}")
-                        plt.tight_layout()
-                        plt.savefig(img_stacked, format='png')
-                        plt.close()
-                        img_stacked_base64 = base64.b64encode(img_stacked.getvalue()).decode('utf-8')
-
-                        relations[f"relation_{relation_counter}_qualitatives"] = {
+                        relation = {
                             "variables": [c1, c2],
-                            "tableau_contingence": contingency_table.to_dict(),
-                            "graphiques": {
-                                "barre_groupe": f"data:image/png;base64,{img_grouped_base64}",
-                                "barre_empile": f"data:image/png;base64,{img_stacked_base64}"
-                            }
+                            "tableau_contingence": contingency_table.to_dict()
                         }
+                        if rendre_png:
+                            relation["graphiques"] = {
+                                kind: image_base64(tracer_graphique(df, kind, c1, c2))
+                                for kind in ('barre_groupe', 'barre_empile')
+                            }
+                        relations[f"relation_{relation_counter}_qualitatives"] = relation
                         relation_counter += 1
                         print(f"    ✓ Qualitative relation generated")
 
@@ -535,6 +1224,13 @@ def analyze_relations(df):
     target_vars_normalized = [normalize_name(t) for t in target_vars_list]
 
     if len(quant_cols) >= 2:
+        cibles = [c for c in dict.fromkeys(target_vars_normalized) if c in quant_cols]
+        autres = [c for c in quant_cols if c not in target_vars_normalized]
+        if cibles and autres:
+            matrices = matrices_relations(df, cibles, autres)
+            valeurs_cibles = df[cibles].astype('float64').to_numpy()
+            valeurs_autres = df[autres].astype('float64').to_numpy()
+
         for target_col in target_vars_normalized:
             if target_col not in quant_cols:
                 continue
@@ -548,21 +1244,26 @@ def analyze_relations(df):
                 print(f"  > Analyzing quantitative relation: {target_col} vs {other_col}")
 
                 try:
-                    sub_df = df[[target_col, other_col]].dropna()
-
-                    if not sub_df.empty and len(sub_df) > 10:
-                        cov = sub_df[target_col].cov(sub_df[other_col])
-                        corr, _ = pearsonr(sub_df[target_col], sub_df[other_col])
-
-                        slope, intercept = np.polyfit(sub_df[target_col], sub_df[other_col], 1)
-                        img_scatter = io.BytesIO()
-                        plt.figure(figsize=(6,4))
-                        sns.regplot(x=target_col, y=other_col, data=sub_df)
-                        plt.title(f"Linear Regression: {target_col} vs {other_col}")
-                        plt.tight_layout()
-                        plt.savefig(img_scatter, format='png')
-                        plt.close()
-                        img_scatter_base64 = base64.b64encode(img_scatter.getvalue()).decode('utf-8')
+                    i, j = cibles.index(target_col), autres.index(other_col)
+                    sample_size = int(matrices["n"][i, j])
+
+                    if sample_size > 10:
+                        x = valeurs_cibles[:, i]
+                        y = valeurs_autres[:, j]
+                        communs = ~np.isnan(x) & ~np.isnan(y)
+                        x, y = x[communs], y[communs]
+
+                        slope = matrices["pente"][i, j]
+                        if np.isfinite(slope):
+                            cov = matrices["covariance"][i, j]
+                            corr = matrices["correlation"][i, j]
+                            intercept = matrices["ordonnee_origine"][i, j]
+                        else:
+                            cov, corr, slope, intercept = statistiques_paire(
+                                pd.DataFrame({target_col: x, other_col: y}), target_col, other_col
+                            )
+
+                        scatter_data, scatter_reduction = reduire_nuage(x, y, mode_nuage, budget_nuage)
 
                         relations[f"relation_{relation_counter}_quantitatives"] = {
                             "variables": [target_col, other_col],
@@ -573,18 +1274,21 @@ def analyze_relations(df):
                                 "ordonnee_origine": float(intercept)
                             },
                             "chart_data": {
-                                "scatter_data": [
-                                    {"x": float(row[target_col]), "y": float(row[other_col])}
-                                    for _, row in sub_df.iterrows()
-                                ],
+                                "scatter_data": scatter_data,
+                                "scatter_reduction": scatter_reduction,
                                 "regression_line": {
                                     "slope": float(slope),
                                     "intercept": float(intercept),
                                     "r_squared": float(corr ** 2)
                                 },
-                                "sample_size": len(sub_df)
+                                "sample_size": sample_size
                             }
                         }
+                        if rendre_png:
+                            sub_df = pd.DataFrame({target_col: x, other_col: y})
+                            relations[f"relation_{relation_counter}_quantitatives"]["graphiques"] = {
+                                "regression": image_base64(tracer_graphique(sub_df, 'regression', target_col, other_col))
+                            }
                         relation_counter += 1
                         print(f"    ✓ Quantitative relation generated: corr={corr:.3f}")
                     else:
@@ -607,14 +1311,6 @@ def analyze_relations(df):
             agg_mean_std = sub_df.groupby(qual_col_name)[quant_col_name].agg(['mean', 'std']).reset_index()
             agg_median_quartiles = sub_df.groupby(qual_col_name)[quant_col_name].agg(['median', lambda x: x.quantile(0.25), lambda x: x.quantile(0.75)]).reset_index()
             agg_median_quartiles.columns = [qual_col_name, 'median', 'Q1', 'Q3']
-            img_box = io.BytesIO()
-            plt.figure(figsize=(6,4))
-            sns.boxplot(x=qual_col_name, y=quant_col_name, data=sub_df)
-            plt.title(f"Box Plot: {quant_col_name} by {qual_col_name}")
-            plt.tight_layout()
-            plt.savefig(img_box, format='png')
-            plt.close()
-            img_box_base64 = base64.b64encode(img_box.getvalue()).decode('utf-8')
 
             relations[f"relation_{relation_counter}_quant_qual"] = {
                 "variables": [quant_col_name, qual_col_name],
@@ -641,6 +1337,10 @@ def analyze_relations(df):
                     "mean": float(row['mean']),
                     "std_dev": float(row['std'])
                 }
+            if rendre_png:
+                relations[f"relation_{relation_counter}_quant_qual"]["graphiques"] = {
+                    "boxplot": image_base64(tracer_graphique(sub_df, 'boxplot', quant_col_name, qual_col_name))
+                }
             relation_counter += 1
             print(f"    ✓ Quantitative/qualitative relation generated")
 
@@ -675,6 +1375,15 @@ def convert_numpy_types(obj):
         return None
     return obj
 
+# Métadonnées des documents, exclues des variables analysées
+COLONNES_EXCLUES = [
+    'source_line', 'heure', 'semaine', 'date_c', 'mois', 'date_num',
+    'imputation_method', 'poste', '107 D.Mois', '107 D.Date', 
+    '107 D.Semaine', '107 D.Poste', '107 D.Heure', '__v', 'createdAt',
+    'import_date', 'original_filenames.file1', 'original_filenames.file2',
+    'original_row_index', 'updatedAt', 'row_fingerprint', 'layout', 'imputation_methods', 'batch_id'
+]
+
 def analyze_column(series, col_name):
     try:
         numeric_series = pd.to_numeric(series, errors='raise')
@@ -682,7 +1391,7 @@ def analyze_column(series, col_name):
     except (ValueError, TypeError):
         return analyze_qualitative(series)
 
-def analyze_file_from_mongodb(line):
+def analyze_file_from_mongodb(line, rendre_png=RENDU_PNG_PAR_DEFAUT):
     """Analyse les données depuis MongoDB pour une ligne spécifique et sauvegarde dans Azure Cosmos DB"""
     print(f"\n{'='*60}")
     print(f"📊 DÉBUT DE L'ANALYSE POUR LA LIGNE {line}")
@@ -697,17 +1406,11 @@ def analyze_file_from_mongodb(line):
     if df.empty:
         return {"error": "DataFrame vide après récupération depuis MongoDB"}
 
-    columns_to_exclude = [
-        'source_line', 'heure', 'semaine', 'date_c', 'mois', 'date_num',
-        'imputation_method', 'poste', '107 D.Mois', '107 D.Date', 
-        '107 D.Semaine', '107 D.Poste', '107 D.Heure', '__v', 'createdAt',
-        'import_date', 'original_filenames.file1', 'original_filenames.file2',
-        'original_row_index', 'updatedAt'
-    ]
+
     
-    df_filtered = df.drop(columns=columns_to_exclude, errors='ignore')
+    df_filtered = df.drop(columns=COLONNES_EXCLUES, errors='ignore')
     
-    print(f"✅ {len(columns_to_exclude)} colonnes spécifiées pour exclusion.")
+    print(f"✅ {len(COLONNES_EXCLUES)} colonnes spécifiées pour exclusion.")
     print(f"📋 Dimensions du DataFrame après exclusion : {df_filtered.shape}")
 
     results = {
@@ -718,11 +1421,12 @@ def analyze_file_from_mongodb(line):
     
     print(f"\n--- Analyse des variables restantes ({len(df_filtered.columns)} colonnes) ---")
     
+    quantitatives = analyze_quantitative_batch(df_filtered)
     for i, col in enumerate(df_filtered.columns):
         print(f"  [{i+1}/{len(df_filtered.columns)}] Analyse de: {col}")
-        results["Variables"][col] = analyze_column(df_filtered[col], col)
+        results["Variables"][col] = quantitatives[col] if col in quantitatives else analyze_column(df_filtered[col], col)
     
-    results["Relations"] = analyze_relations(df_filtered)
+    results["Relations"] = analyze_relations(df_filtered, rendre_png=rendre_png)
     
     results = convert_numpy_types(results)
     
@@ -738,7 +1442,7 @@ def analyze_file_from_mongodb(line):
     
 
 # Fonction principale pour analyser les 3 lignes
-def analyze_all_lines():
+def analyze_all_lines(rendre_png=RENDU_PNG_PAR_DEFAUT):
     """Analyse les 3 lignes (107D, 107E, 107F) et sauvegarde dans Azure Cosmos DB"""
     lines = ['107D', '107E', '107F']
     results = {}
@@ -748,7 +1452,7 @@ def analyze_all_lines():
         print(f"LANCEMENT DE L'ANALYSE POUR LA LIGNE: {line}")
         print(f"{'='*80}")
         
-        result = analyze_file_from_mongodb(line)  
+        result = analyze_file_from_mongodb(line, rendre_png=rendre_png)
         results[line] = result
         
         print(f"\n⏳ Attente de 2 secondes avant la prochaine ligne...")
@@ -769,10 +1473,38 @@ def analyze_all_lines():
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) > 1:
-        line_to_analyze = sys.argv[1]
+    args = sys.argv[1:]
+    if args and args[0] == '--chart':
+        # Rendu d'un seul graphique : --chart <ligne> <var1> <var2> [type] [méthode]
+        # La dernière ligne de sortie est le JSON {"chart": chemin du PNG, "cached": bool}
+        if len(args) < 4:
+            print(json.dumps({"error": "Usage : --chart <ligne> <var1> <var2> [type] [méthode]"}))
+            sys.exit(1)
+        result = render_relation_chart(*args[1:6])
+        print(json.dumps(result, ensure_ascii=False))
+        sys.exit(1 if "error" in result else 0)
+
+    if args and args[0] in ('--update-stats', '--variables'):
+        # Statistiques suffisantes : mise à jour incrémentale (après un import) ou
+        # recalcul des variables quantitatives sans relire les documents de la ligne
+        if len(args) < 2:
+            print(json.dumps({"error": f"Usage : {args[0]} <ligne> [méthode]"}))
+            sys.exit(1)
+        if args[0] == '--update-stats':
+            result = mettre_a_jour_statistiques_suffisantes(*args[1:3])
+        else:
+            result = analyze_variables_from_store(*args[1:3])
+        print(json.dumps(result, ensure_ascii=False))
+        sys.exit(1 if "error" in result else 0)
+
+    rendre_png = RENDU_PNG_PAR_DEFAUT
+    if '--png' in args:
+        args.remove('--png')
+        rendre_png = True
+    if args:
+        line_to_analyze = args[0]
         print(f"Argument détecté. Lancement de l'analyse pour la ligne unique : {line_to_analyze}")
-        analyze_file_from_mongodb(line_to_analyze) 
+        analyze_file_from_mongodb(line_to_analyze, rendre_png=rendre_png) 
     else:
         print("ℹ️ Aucun argument détecté. Lancement de l'analyse pour toutes les lignes (D, E, F).")
-        analyze_all_lines()
\ No newline at end of file
+        analyze_all_lines(rendre_png=rendre_png)
@@ -8,7 +8,7 @@ const __filename = fileURLToPath(import.meta.url);
 const __dirname = path.dirname(__filename);
 
 const runAnalysis = () => {
-    const { line } = workerData;
+    const { line, scope } = workerData;
     const lineLetter = line.replace('107', '').toUpperCase();
 
     const path1 = path.resolve(__dirname, '../utils/statistics_analyzer.py');
@@ -27,7 +27,8 @@ const runAnalysis = () => {
     }
 
     console.log(`WORKER: Lancement du script d'analyse pour la ligne ${lineLetter} via : ${scriptPath}`);
-    const pythonProcess = spawn('python', [scriptPath, lineLetter]);
+    const args = scope === 'variables' ? ['--variables', lineLetter] : [lineLetter];
+    const pythonProcess = spawn('python', [scriptPath, ...args]);
 
     let stderrOutput = '';
     pythonProcess.stderr.on('data', (data) => {
@@ -2,7 +2,7 @@ import { parentPort, workerData } from 'worker_threads';
 import { spawn } from 'child_process';
 import fs from 'fs';
 
-const { line, file1_b64, file2_b64, originalname1, originalname2 } = workerData;
+const { line, file1_path, file2_path, originalname1, originalname2, sink, delta, alignement, methods, layout } = workerData;
 
 const runPythonScript = () => {
     const path1 = 'src/utils/full_pipeline_memory.py';
@@ -38,10 +38,15 @@ const runPythonScript = () => {
 
     const inputPayload = {
         line: line,
-        file1_b64: file1_b64,
-        file2_b64: file2_b64,
+        file1_path: file1_path,
+        file2_path: file2_path,
         originalname1: originalname1,
-        originalname2: originalname2
+        originalname2: originalname2,
+        sink: sink,
+        delta: delta,
+        alignement: alignement,
+        methods: methods,
+        layout: layout
     };
 
     pythonProcess.stdin.write(JSON.stringify(inputPayload));
@@ -54,17 +59,36 @@ const runPythonScript = () => {
     pythonProcess.stderr.on('data', (data) => { scriptError += data.toString(); });
 
     pythonProcess.on('close', (code) => {
-        const hasRealError = scriptError && !scriptError.includes('RuntimeWarning') && !scriptError.includes('Mean of empty slice') && !scriptError.includes('FutureWarning');
-
-        if (code === 0 && !hasRealError) {
+        // Le code de sortie fait foi : le script écrit ses traces de progression sur stderr
+        if (code === 0) {
+            // Mesures par étape (PIPELINE_METRICS=stderr) : relayées dans les logs du serveur
+            for (const errLine of scriptError.split('\n')) {
+                if (errLine.startsWith('{"ingest_metrics"')) {
+                    console.log(`[Worker Ligne ${line}] ${errLine}`);
+                }
+            }
             try {
                 const lines = scriptOutput.trim().split('\n');
+
+                if (sink && sink.type === 'mongodb') {
+                    // Mode sink : Python a écrit directement dans kpidatas, seul le bilan est renvoyé
+                    const summary = JSON.parse(lines[lines.length - 1]);
+                    parentPort.postMessage({ status: 'success', summary });
+                    return;
+                }
+
                 const documents = [];
+                let ingestBatch = null;
 
                 for (const docLine of lines) {
                     if (docLine.trim()) {
                         try {
                             const doc = JSON.parse(docLine);
+                            // Dernière ligne : l'enregistrement du lot d'import
+                            if (doc.ingest_batch) {
+                                ingestBatch = doc.ingest_batch;
+                                continue;
+                            }
                             documents.push(doc);
                         } catch (parseError) {
                             console.error(`[Worker Ligne ${line}] Erreur de parsing sur une ligne JSON: ${parseError.message}`);
@@ -72,7 +96,7 @@ const runPythonScript = () => {
                     }
                 }
                 
-                parentPort.postMessage({ status: 'success', documents });
+                parentPort.postMessage({ status: 'success', documents, ingestBatch });
 
             } catch (e) {
                 parentPort.postMessage({ status: 'error', message: 'Erreur de traitement de la sortie Python.', details: e.message });
@@ -0,0 +1,142 @@
+import datetime
+import io
+import json
+import random
+import sys
+from pathlib import Path
+
+import pytest
+from openpyxl import Workbook
+
+# Scripts Python du backend (lancés depuis src/utils par Node) importables par les tests
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'utils'))
+
+import full_pipeline_memory as pipeline  # noqa: E402
+
+COLONNES_LIMS = [
+    ('ACIDE PHOSPHORIQUE', 'Picage AR29', '%P2O5 AR29', (25, 30)),
+    (None, None, 'Densité AR29', (1.2, 1.4)),
+    ('PHOSPHATE BROYE', 'Phosphate brute broyé', '%P2O5 TOT broyé', (28, 33)),
+    ('TSP', "Cuve D'attaque (bouillie)", 'Densité bouillie', (1.5, 1.7)),
+    (None, None, '%P2O5  SE bouillie', (40, 48)),
+    (None, None, '%Acide libre bouillie', (2, 5)),
+    ('TSP', 'Sortie granulateur', '%P2O5 SE granu', (40, 46)),
+    (None, None, '%Acide libre granul', (2, 5)),
+    ('PRODUIT FINI TSP', 'Détermination', '%P2O5  TOT PF', (44, 48)),
+    (None, None, '%P2O5 SE PF', (38, 45)),
+    (None, 'Granulométrie', '˃2-˃4mm', (50, 80)),
+    (None, None, '˃4mm', (1, 5)),
+]
+
+COLONNES_PI = [
+    ('Moyenne de %P2O5 AR29', (25, 30)),
+    ('Débit ACP 1 M3/H', (10, 40)),
+    ('Débit ACP 2 M3/H', (10, 40)),
+    ('DébIT PP Kg/H', (10, 40)),
+    ('Débit bouillie T/H 1', (10, 40)),
+    ('Recyclage T/H', (10, 40)),
+    ('Production TSP balance T/H', (40, 80)),
+]
+
+
+def valeur_saisie(hasard, valeur):
+    """
+    Valeur telle qu'on la trouve dans les exports : vides, marqueurs, virgules décimales...
+    """
+    tirage = hasard.random()
+    if tirage < 0.08:
+        return None
+    if tirage < 0.10:
+        return '**'
+    if tirage < 0.12:
+        return f"{valeur:.2f}".replace('.', ',')
+    if tirage < 0.13:
+        return f"{valeur:.2f}-"
+    if tirage < 0.14:
+        return f" {valeur:.3f} "
+    return round(valeur, 3)
+
+
+def ecrire_paire_classeurs(dossier, ligne='F', nb_lignes=72, graine=1, debut=datetime.datetime(2025, 8, 1)):
+    """
+    Écrit une paire de classeurs LIMS / PI réaliste (en-têtes sur plusieurs niveaux, ligne
+    d'unités, valeurs sales) de `nb_lignes` relevés horaires. Retourne les deux chemins.
+    """
+    hasard = random.Random(graine)
+    wb = Workbook()
+    ws = wb.active
+    ws.append([None, f'107 {ligne}', None, None, None, None, *[c[0] for c in COLONNES_LIMS]])
+    ws.append([None] * 6 + [c[1] for c in COLONNES_LIMS])
+    ws.append(['Date c', 'Mois', 'Date c ', 'Semaine', 'Poste', 'Heure', *[c[2] for c in COLONNES_LIMS]])
+    ws.append(['unité'] + [None] * (5 + len(COLONNES_LIMS)))
+    instants = [debut + datetime.timedelta(hours=i) for i in range(nb_lignes)]
+    for t in instants:
+        valeurs = [valeur_saisie(hasard, hasard.uniform(*c[3])) for c in COLONNES_LIMS]
+        ws.append([t, t.month, t, t.isocalendar()[1], 'ABC'[t.hour // 8], f"{t.hour:02d}:00", *valeurs])
+    chemin_lims = Path(dossier) / f'lims_{ligne}_{graine}.xlsx'
+    wb.save(chemin_lims)
+
+    wb = Workbook()
+    ws = wb.active
+    ws.append([None] * 4 + ['Valeurs'] + [None] * (len(COLONNES_PI) - 1))
+    ws.append([None, 'Date c', 'Poste', 'Heure', *[c[0] for c in COLONNES_PI]])
+    ws.append([None, 'x', 'x', 'x'] + ['x'] * len(COLONNES_PI))
+    for i, t in enumerate(instants):
+        valeurs = [valeur_saisie(hasard, hasard.uniform(*c[1])) for c in COLONNES_PI]
+        ws.append([i, t, 'ABC'[t.hour // 8], t.hour, *valeurs])
+    chemin_pi = Path(dossier) / f'pi_{ligne}_{graine}.xlsx'
+    wb.save(chemin_pi)
+    return chemin_lims, chemin_pi
+
+
+@pytest.fixture(autouse=True)
+def caches_temporaires(tmp_path, monkeypatch):
+    # Caches disque du pipeline isolés par test
+    monkeypatch.setattr(pipeline, 'REPERTOIRE_CACHE_NETTOYES', tmp_path / 'cache' / 'kpi_nettoyes')
+    monkeypatch.setattr(pipeline, 'REPERTOIRE_CACHE_PLANS', tmp_path / 'cache' / 'kpi_plans_fusion')
+
+
+@pytest.fixture
+def payload_classeurs(tmp_path):
+    """
+    Fabrique de payloads Node (file1_path / file2_path) sur une paire de classeurs générée.
+    """
+    def fabriquer(ligne='F', nb_lignes=72, graine=1, debut=datetime.datetime(2025, 8, 1), **options):
+        chemin_lims, chemin_pi = ecrire_paire_classeurs(tmp_path, ligne, nb_lignes, graine, debut)
+        return {
+            'line': ligne,
+            'file1_path': str(chemin_lims),
+            'file2_path': str(chemin_pi),
+            'originalname1': chemin_lims.name,
+            'originalname2': chemin_pi.name,
+            **options,
+        }
+    return fabriquer
+
+
+@pytest.fixture
+def executer():
+    """
+    Exécute le pipeline en mémoire. Retourne (documents émis, enregistrement du lot).
+    """
+    def lancer(payload):
+        sortie = io.StringIO()
+        resultat = pipeline.executer_pipeline(payload, sortie)
+        documents = [json.loads(ligne) for ligne in sortie.getvalue().splitlines()]
+        return documents, resultat['ingest_batch']
+    return lancer
+
+
+@pytest.fixture
+def base_kpi(monkeypatch):
+    """
+    Base 107_DEF_KPI_dashboard en mémoire (mongomock), partagée par toutes les connexions
+    du pipeline pendant le test.
+    """
+    import mongomock
+
+    client = mongomock.MongoClient()
+    db = client[pipeline.NOM_BASE_MONGODB]
+    monkeypatch.setattr(pipeline, 'connexion_collection_kpi',
+                        lambda options: (client, db[options.get('collection', pipeline.NOM_COLLECTION_KPI)]))
+    return db
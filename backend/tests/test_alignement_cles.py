@@ -0,0 +1,47 @@
+import pandas as pd
+
+import full_pipeline_memory as pipeline
+
+
+def releves(heures, valeurs=None):
+    jour = pd.Timestamp('2025-08-01')
+    colonnes = {
+        ('Valeurs', 'Date c'): [jour + pd.Timedelta(hours=h) for h in heures],
+        ('Valeurs', 'Heure'): [f'{h:02d}:00' for h in heures],
+    }
+    if valeurs is not None:
+        colonnes[('Valeurs', 'Débit')] = valeurs
+    return pd.DataFrame(colonnes)
+
+
+def test_alignement_par_cles_identique_a_la_position_sur_classeurs_alignes(payload_classeurs):
+    payload = payload_classeurs()
+    contenus = pipeline.contenus_classeurs(payload)
+
+    par_position = pipeline.traiter_fusion('F', *contenus)
+    par_cles = pipeline.traiter_fusion('F', *contenus, alignement={'mode': 'cles'})
+
+    pd.testing.assert_frame_equal(par_cles, par_position)
+
+
+def test_lignes_pi_desordonnees_et_cles_en_double():
+    lims = releves([0, 1, 2, 3])
+    pi = releves([3, 1, 0, 1, 2], valeurs=[30.0, 10.0, 0.0, 99.0, 20.0])
+
+    aligne, rapport = pipeline.aligner_par_cles(lims, pi, pi[[('Valeurs', 'Débit')]], {})
+
+    assert aligne[('Valeurs', 'Débit')].tolist() == [0.0, 10.0, 20.0, 30.0]
+    assert rapport['lignes_pi_doublons'] == 1
+    assert rapport['lignes_pi_non_utilisees'] == 0
+    assert rapport['lignes_lims_non_appariees'] == 0
+
+
+def test_lignes_hors_tolerance_non_appariees():
+    lims = releves([0, 1, 5])
+    pi = releves([0, 1], valeurs=[0.0, 10.0])
+
+    aligne, rapport = pipeline.aligner_par_cles(lims, pi, pi[[('Valeurs', 'Débit')]], {'tolerance': '30min'})
+
+    assert aligne[('Valeurs', 'Débit')].tolist()[:2] == [0.0, 10.0]
+    assert pd.isna(aligne[('Valeurs', 'Débit')].iloc[2])
+    assert rapport['lignes_lims_non_appariees'] == 1
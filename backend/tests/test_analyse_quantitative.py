@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import statistics_analyzer as analyzer
+
+
+@pytest.fixture
+def variables():
+    hasard = np.random.default_rng(5)
+    n = 2000
+    df = pd.DataFrame({
+        'p2o5': np.round(hasard.normal(27.5, 1.2, size=n), 2),
+        'debit': hasard.gamma(2.0, 10.0, size=n),
+        'densite': np.round(hasard.uniform(1.2, 1.4, size=n), 3),
+        'constante': np.full(n, 4.0),
+        'vide': np.full(n, np.nan),
+        'poste': hasard.choice(['A', 'B', 'C'], size=n),
+    })
+    for colonne, part in (('p2o5', 0.1), ('debit', 0.4), ('densite', 0.02)):
+        df.loc[hasard.random(n) < part, colonne] = np.nan
+    return df
+
+
+def test_analyse_groupee_identique_a_l_analyse_par_colonne(variables):
+    resultats = analyzer.analyze_quantitative_batch(variables)
+
+    assert set(resultats) == {'p2o5', 'debit', 'densite', 'vide'}
+    assert resultats['vide'] == analyzer.analyze_quantitative(variables['vide']) == {}
+    for colonne in ('p2o5', 'debit', 'densite'):
+        attendu = analyzer.convert_numpy_types(analyzer.analyze_quantitative(variables[colonne]))
+        obtenu = analyzer.convert_numpy_types(resultats[colonne])
+        assert obtenu['distribution_table'] == attendu['distribution_table']
+        assert obtenu['tendance_centrale']['mode'] == attendu['tendance_centrale']['mode']
+        assert obtenu['quartiles'] == attendu['quartiles']
+        assert obtenu['chart_data']['boxplot'] == attendu['chart_data']['boxplot']
+        for groupe in ('dispersion', 'forme'):
+            for cle, valeur in attendu[groupe].items():
+                assert obtenu[groupe][cle] == pytest.approx(valeur, rel=1e-9)
+        assert obtenu['tendance_centrale']['moyenne'] == pytest.approx(attendu['tendance_centrale']['moyenne'], rel=1e-12)
+
+
+def test_colonnes_degenerees_laissees_a_l_analyse_par_colonne(variables):
+    resultats = analyzer.analyze_quantitative_batch(variables)
+
+    assert 'constante' not in resultats
+    assert 'poste' not in resultats
@@ -0,0 +1,53 @@
+import os
+
+import full_pipeline_memory as pipeline
+from cache_disque import limiter_cache, marquer_utilise
+
+MO = 1024 * 1024
+
+
+def entree(dossier, nom, date, taille=MO // 2):
+    fichier = dossier / nom
+    fichier.write_bytes(b'\0' * taille)
+    os.utime(fichier, (date, date))
+    return fichier
+
+
+def test_eviction_des_entrees_les_moins_recemment_utilisees(tmp_path):
+    anciennes = [entree(tmp_path, f'{i}.parquet', 1000 + i) for i in range(4)]
+    marquer_utilise(anciennes[0])
+    nouvelle = entree(tmp_path, 'nouvelle.parquet', 999)
+    autre = entree(tmp_path, 'plan.json', 1)
+
+    supprimes = limiter_cache(tmp_path, '*.parquet', garder=nouvelle, taille_max_mo=1)
+
+    assert supprimes == 3
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['0.parquet', 'nouvelle.parquet', 'plan.json']
+    assert autre.exists()
+
+
+def test_sans_limite(tmp_path):
+    for i in range(3):
+        entree(tmp_path, f'{i}.png', i)
+
+    assert limiter_cache(tmp_path, '*.png', taille_max_mo=0) == 0
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_cle_du_cache_nettoye_versionnee(monkeypatch):
+    empreintes = {'file1': 'a' * 64, 'file2': 'b' * 64}
+    cle = pipeline.cle_cache_nettoyage('F', empreintes)
+
+    monkeypatch.setattr(pipeline, 'VERSION_CACHE_NETTOYES', pipeline.VERSION_CACHE_NETTOYES + 1)
+
+    assert pipeline.cle_cache_nettoyage('F', empreintes) != cle
+
+
+def test_cache_nettoye_borne_apres_ecriture(payload_classeurs, executer, monkeypatch):
+    monkeypatch.setattr(pipeline, 'limiter_cache',
+                        lambda repertoire, motif, garder=None: limiter_cache(repertoire, motif, garder, taille_max_mo=1e-6))
+
+    executer(payload_classeurs(graine=1))
+    executer(payload_classeurs(graine=2))
+
+    assert len(list(pipeline.REPERTOIRE_CACHE_NETTOYES.glob('*.parquet'))) == 1
@@ -0,0 +1,69 @@
+import datetime
+import secrets
+
+from openpyxl import Workbook
+
+import full_pipeline_memory as pipeline
+
+
+def depot_multer(dossier, classeur):
+    """
+    Enregistre le classeur comme le fait multer.diskStorage : nom aléatoire de 32 caractères
+    hexadécimaux, sans extension.
+    """
+    chemin = dossier / secrets.token_hex(16)
+    classeur.save(chemin)
+    return chemin
+
+
+def classeur_lims(ligne):
+    wb = Workbook()
+    ws = wb.active
+    ws.append([None, f'107 {ligne}', None, 'ACIDE PHOSPHORIQUE', None])
+    ws.append([None, None, None, 'Picage AR29', None])
+    ws.append(['Date c', 'Poste', 'Heure', '%P2O5 AR29', 'Densité AR29'])
+    debut = datetime.datetime(2025, 8, 1)
+    for i in range(5):
+        t = debut + datetime.timedelta(hours=i)
+        ws.append([t, 'A', f"{t.hour:02d}:00", 27.5 + i, 1.3])
+    return wb
+
+
+def classeur_pi(ligne):
+    wb = Workbook()
+    ws = wb.active
+    ws.append([None, None, None, None, 'Valeurs'])
+    ws.append([None, 'Date c', 'Poste', 'Heure', f'J_107DEF_107{ligne} Débit ACP 1 M3/H'])
+    ws.append([None, 'x', 'x', 'x', 'x'])
+    return wb
+
+
+def test_entetes_classeur_depuis_chemin_sans_extension(tmp_path):
+    chemin = depot_multer(tmp_path, classeur_lims('F'))
+    assert chemin.suffix == ''
+
+    entetes = pipeline.entetes_classeur(chemin)
+
+    assert pipeline.COLONNE_ANCRE in entetes['lims']
+
+
+def test_iterer_blocs_excel_depuis_chemin_sans_extension(tmp_path):
+    chemin = depot_multer(tmp_path, classeur_lims('F'))
+
+    blocs = list(pipeline.iterer_blocs_excel(chemin, 3, taille_bloc=2))
+
+    assert sum(len(bloc) for bloc in blocs) == 5
+    assert pipeline.COLONNE_ANCRE in blocs[0].columns
+
+
+def test_validation_payload_multer(tmp_path):
+    payload = {
+        'file1_path': str(depot_multer(tmp_path, classeur_lims('F'))),
+        'file2_path': str(depot_multer(tmp_path, classeur_pi('F'))),
+    }
+
+    verdict = pipeline.valider_classeurs('F', *pipeline.contenus_classeurs(payload))
+
+    codes = [erreur['code'] for erreur in verdict['errors']]
+    assert 'classeur_illisible' not in codes
+    assert verdict['valid'], verdict['errors']
@@ -0,0 +1,63 @@
+import datetime
+from collections import Counter
+
+import full_pipeline_memory as pipeline
+from kpi_layouts import colonnes_buckets, feuilles_bucket
+
+CHAMPS_DOCUMENT = {'_id', 'source_line', 'batch_id', 'imputation_method', 'original_row_index', 'row_fingerprint',
+                   *pipeline.CHAMPS_IDENTIFICATION}
+
+
+def feuilles_document(doc):
+    return dict(feuilles_bucket({cle: valeur for cle, valeur in doc.items() if cle not in CHAMPS_DOCUMENT}))
+
+
+def lignes_stockees(collection):
+    """
+    Clé d'unicité de chaque ligne stockée en buckets, avec le lot qui l'a écrite.
+    """
+    return [(cle, bucket['batch_id']) for bucket in collection.find({}) for cle in pipeline.cles_lignes_bucket(bucket)]
+
+
+def test_buckets_contiennent_les_documents_par_ligne(payload_classeurs, executer):
+    payload = payload_classeurs(methods=['mean'])
+    par_ligne = {doc['original_row_index']: doc for doc in executer(payload)[0]}
+
+    buckets, _ = executer({**payload, 'layout': pipeline.LAYOUT_BUCKET})
+
+    assert [b['day'] for b in buckets] == ['2025-08-01', '2025-08-02', '2025-08-03']
+    assert sum(len(b['hour_index']) for b in buckets) == len(par_ligne)
+    for bucket in buckets:
+        colonnes = dict(feuilles_bucket(bucket['values']))
+        for k, rang in enumerate(bucket['original_row_index']):
+            doc = par_ligne[rang]
+            assert {nom: valeurs[k] for nom, valeurs in colonnes.items()} == feuilles_document(doc)
+            assert bucket['row_fingerprint'][k] == doc['row_fingerprint']
+            assert pipeline.cles_lignes_bucket(bucket)[k] == doc['_id']
+
+    df = colonnes_buckets(buckets)
+    assert len(df) == len(par_ligne)
+
+
+def test_reconciliation_des_imports_qui_se_chevauchent(payload_classeurs, executer, base_kpi):
+    options = {'layout': pipeline.LAYOUT_BUCKET, 'methods': ['mean'], 'sink': {'type': 'mongodb'}}
+    # Heures 1 à 35 du 1er août, puis heures 25 à 71 : 11 lignes en commun
+    premier = payload_classeurs(nb_lignes=36, graine=1, **options)
+    second = payload_classeurs(nb_lignes=48, graine=2, debut=datetime.datetime(2025, 8, 2), **options)
+    collection = base_kpi[pipeline.NOM_COLLECTION_BUCKETS]
+
+    _, lot_premier = executer(premier)
+    _, lot_second = executer(second)
+
+    lignes = lignes_stockees(collection)
+    assert len(lignes) == len({cle for cle, _ in lignes}) == 71
+    assert Counter(lot for _, lot in lignes) == {lot_premier['_id']: 35, lot_second['_id']: 36}
+
+    _, lot_remplacant = executer({**second, 'replace': True})
+
+    lignes = lignes_stockees(collection)
+    assert len(lignes) == len({cle for cle, _ in lignes}) == 71
+    assert Counter(lot for _, lot in lignes) == {lot_premier['_id']: 24, lot_remplacant['_id']: 47}
+
+    pipeline.annuler_lot_import({}, lot_remplacant['_id'])
+    assert Counter(lot for _, lot in lignes_stockees(collection)) == {lot_premier['_id']: 24}
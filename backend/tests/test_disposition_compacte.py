@@ -0,0 +1,26 @@
+import pytest
+
+import full_pipeline_memory as pipeline
+from kpi_layouts import materialiser_document
+
+CHAMPS_DISPOSITION = {'_id', 'batch_id', 'layout', 'imputation_method', 'imputation_methods'}
+
+
+def valeurs(doc):
+    return {cle: valeur for cle, valeur in doc.items() if cle not in CHAMPS_DISPOSITION}
+
+
+@pytest.mark.parametrize('methode', pipeline.METHODES_IMPUTATION)
+def test_document_compact_materialise_comme_le_document_par_methode(payload_classeurs, executer, methode):
+    payload = payload_classeurs()
+    par_ligne = {
+        doc['original_row_index']: valeurs(doc)
+        for doc in executer(payload)[0] if doc['imputation_method'] == methode
+    }
+
+    compacts, _ = executer({**payload, 'layout': pipeline.LAYOUT_COMPACT})
+
+    assert len(compacts) == len(par_ligne)
+    for doc in compacts:
+        assert doc['imputation_methods'] == pipeline.METHODES_IMPUTATION
+        assert materialiser_document(valeurs(doc), methode) == par_ligne[doc['original_row_index']]
@@ -0,0 +1,30 @@
+import datetime
+
+import full_pipeline_memory as pipeline
+
+
+def test_lot_enregistre_et_documents_rattaches(payload_classeurs, executer, base_kpi):
+    payload = payload_classeurs(sink={'type': 'mongodb'})
+
+    _, lot = executer(payload)
+
+    stocke = base_kpi[pipeline.NOM_COLLECTION_LOTS].find_one({'_id': lot['_id']})
+    assert stocke['original_filenames'] == {'file1': payload['originalname1'], 'file2': payload['originalname2']}
+    assert stocke['summary']['inserted'] == lot['rows']['documents']
+    assert stocke['status'] == 'completed'
+    kpidatas = base_kpi[pipeline.NOM_COLLECTION_KPI]
+    assert kpidatas.count_documents({'batch_id': lot['_id']}) == lot['rows']['documents']
+    assert kpidatas.count_documents({'original_filenames': {'$exists': True}}) == 0
+
+
+def test_annulation_ne_supprime_que_le_lot(payload_classeurs, executer, base_kpi):
+    _, premier = executer(payload_classeurs(graine=1, sink={'type': 'mongodb'}))
+    _, second = executer(payload_classeurs(graine=2, debut=datetime.datetime(2025, 9, 1), sink={'type': 'mongodb'}))
+
+    supprimes = pipeline.annuler_lot_import({}, second['_id'])
+
+    kpidatas = base_kpi[pipeline.NOM_COLLECTION_KPI]
+    assert supprimes == second['rows']['documents']
+    assert kpidatas.count_documents({'batch_id': second['_id']}) == 0
+    assert kpidatas.count_documents({}) == premier['rows']['documents']
+    assert base_kpi[pipeline.NOM_COLLECTION_LOTS].find_one({'_id': second['_id']})['status'] == 'rolled_back'
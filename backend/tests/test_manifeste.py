@@ -0,0 +1,57 @@
+import io
+import json
+import os
+import tempfile
+
+import full_pipeline_memory as pipeline
+
+executer_travail_origine = pipeline.executer_travail
+
+
+def travail_instable(payload):
+    # Arrêt brutal du processus du pool, comme un worker tué par manque de mémoire
+    if payload.get('job_id') == 3:
+        os._exit(1)
+    return executer_travail_origine(payload)
+
+
+def sans_lot(documents):
+    return [{cle: valeur for cle, valeur in doc.items() if cle != 'batch_id'} for doc in documents]
+
+
+def test_manifeste_identique_aux_imports_unitaires(payload_classeurs, executer):
+    payloads = [payload_classeurs('F', graine=1, job_id=1), payload_classeurs('D', graine=2, job_id=2)]
+    sortie = io.StringIO()
+
+    bilan = pipeline.executer_manifeste(payloads, sortie, nb_workers=2)
+
+    assert bilan == {'jobs': 2, 'succeeded': 2, 'failed': []}
+    par_ligne = {}
+    for ligne in sortie.getvalue().splitlines():
+        doc = json.loads(ligne)
+        if 'ingest_batch' not in doc:
+            par_ligne.setdefault(doc['source_line'], []).append(doc)
+    for payload in payloads:
+        assert sans_lot(par_ligne[payload['line']]) == sans_lot(executer(payload)[0])
+
+
+def test_manifeste_continue_apres_un_echec(payload_classeurs, tmp_path, monkeypatch):
+    temporaire = tmp_path / 'tmp'
+    temporaire.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(temporaire))
+    monkeypatch.setattr(pipeline, 'executer_travail', travail_instable)
+    valide = payload_classeurs(job_id=1)
+    payloads = [
+        valide,
+        {**valide, 'job_id': 2, 'file1_path': str(tmp_path / 'absent.xlsx')},
+        {**valide, 'job_id': 3},
+        {**valide, 'job_id': 4},
+    ]
+    sortie = io.StringIO()
+
+    bilan = pipeline.executer_manifeste(payloads, sortie, nb_workers=1)
+
+    assert bilan['succeeded'] == 1
+    assert sorted(echec['job_id'] for echec in bilan['failed']) == [2, 3, 4]
+    assert json.loads(sortie.getvalue().splitlines()[-1])['ingest_batch']['_id']
+    assert list(temporaire.iterdir()) == []
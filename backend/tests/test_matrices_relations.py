@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import pearsonr
+
+import statistics_analyzer as analyzer
+
+
+@pytest.fixture
+def mesures():
+    hasard = np.random.default_rng(7)
+    n = 400
+    base = hasard.normal(size=n)
+    df = pd.DataFrame({
+        'cible_a': 1e6 + base,
+        'cible_b': hasard.normal(30, 2, size=n),
+        'debit': 3 * base + hasard.normal(size=n),
+        'densite': 1.3 + 0.01 * hasard.normal(size=n),
+        'recyclage': -base + hasard.normal(scale=0.5, size=n),
+    })
+    # Valeurs manquantes différentes d'une colonne à l'autre : observations communes par paire
+    for colonne, part in (('cible_a', 0.1), ('cible_b', 0.3), ('debit', 0.2), ('recyclage', 0.05)):
+        df.loc[hasard.random(n) < part, colonne] = np.nan
+    return df
+
+
+def test_matrices_identiques_au_calcul_par_paire(mesures):
+    cibles, colonnes = ['cible_a', 'cible_b'], ['debit', 'densite', 'recyclage']
+
+    matrices = analyzer.matrices_relations(mesures, cibles, colonnes)
+
+    for i, cible in enumerate(cibles):
+        for j, colonne in enumerate(colonnes):
+            paire = mesures[[cible, colonne]].dropna()
+            correlation, _ = pearsonr(paire[cible], paire[colonne])
+            pente, ordonnee = np.polyfit(paire[cible], paire[colonne], 1)
+            assert matrices['n'][i, j] == len(paire)
+            assert matrices['covariance'][i, j] == pytest.approx(paire[cible].cov(paire[colonne]), rel=1e-9)
+            assert matrices['correlation'][i, j] == pytest.approx(correlation, rel=1e-9)
+            assert matrices['pente'][i, j] == pytest.approx(pente, rel=1e-6)
+            assert matrices['ordonnee_origine'][i, j] == pytest.approx(ordonnee, rel=1e-6, abs=1e-6)
+
+
+def test_colonne_constante_sur_les_observations_communes(mesures):
+    mesures['constante'] = 5.0
+
+    matrices = analyzer.matrices_relations(mesures, ['cible_b'], ['constante'])
+
+    assert np.isnan(matrices['pente'][0, 0])
@@ -0,0 +1,31 @@
+import time
+
+import full_pipeline_memory as pipeline
+
+LATENCE_SINK = 0.2
+
+
+def test_ecriture_du_sink_mesuree_a_part(payload_classeurs, base_kpi, monkeypatch):
+    ecrire_lot = pipeline.ecrire_lot_mongodb
+
+    def ecrire_lot_lent(collection, documents, remplacer=False):
+        time.sleep(LATENCE_SINK)
+        return ecrire_lot(collection, documents, remplacer)
+
+    monkeypatch.setattr(pipeline, 'ecrire_lot_mongodb', ecrire_lot_lent)
+    enregistrees = []
+    monkeypatch.setattr(pipeline, 'enregistrer_mesures', lambda destination, mesures, sink: enregistrees.append(mesures))
+    payload = payload_classeurs(methods=['mean'], metrics='stderr', sink={'type': 'mongodb', 'batch_size': 20})
+
+    resultat = pipeline.traiter_payload(payload, None)
+
+    etapes = {etape['stage']: etape for etape in enregistrees[0]['stages']}
+    documents = resultat['ingest_batch']['rows']['documents']
+    paquets = -(-documents // 20)
+    assert etapes['ecriture_mongodb']['rows_out'] == documents
+    assert etapes['ecriture_mongodb']['wall_s'] >= paquets * LATENCE_SINK
+    assert etapes['imputation_emission']['rows_out'] == documents
+    # Les pauses du sink ne sont pas comptées dans la production des documents
+    assert etapes['imputation_emission']['wall_s'] < paquets * LATENCE_SINK
+    timings = resultat['ingest_batch']['timings']
+    assert timings['imputation_emission'] < paquets * LATENCE_SINK <= timings['ecriture']
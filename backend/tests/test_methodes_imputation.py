@@ -0,0 +1,27 @@
+import pytest
+
+import full_pipeline_memory as pipeline
+
+
+def par_methode(documents):
+    groupes = {}
+    for doc in documents:
+        doc = {cle: valeur for cle, valeur in doc.items() if cle != 'batch_id'}
+        groupes.setdefault(doc['imputation_method'], []).append(doc)
+    return groupes
+
+
+@pytest.mark.parametrize('methodes', [['median'], ['4fill', 'mean'], ['ffill', 'mode']])
+def test_methodes_demandees_identiques_a_l_import_complet(payload_classeurs, executer, methodes):
+    payload = payload_classeurs()
+    complets = par_methode(executer(payload)[0])
+
+    partiels, lot = executer({**payload, 'methods': methodes})
+
+    assert lot['imputation_methods'] == pipeline.methodes_demandees(methodes)
+    assert par_methode(partiels) == {methode: complets[methode] for methode in methodes}
+
+
+def test_methode_inconnue_refusee():
+    with pytest.raises(ValueError, match='interpolate'):
+        pipeline.methodes_demandees(['mean', 'interpolate'])
@@ -0,0 +1,57 @@
+import datetime
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+import full_pipeline_memory as pipeline
+
+
+def valeurs_unicite(date_c, heure='01:00'):
+    return {'source_line': 'F', 'date_c': date_c, 'mois': 8, 'date_num': 0, 'semaine': 31,
+            'poste': 'A', 'heure': heure, 'imputation_method': 'mean'}
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    client = mongomock.MongoClient()
+    collection = client['107_DEF_KPI_dashboard']['kpidatas']
+    monkeypatch.setattr(pipeline, 'connexion_collection_kpi', lambda options: (client, collection))
+    return collection
+
+
+def test_identifiant_document_deterministe():
+    valeurs = ('F', '2025-08-01 01:00:00', 8, 0, 31, 'A', '01:00', 'mean')
+
+    identifiant = pipeline.identifiant_document(valeurs)
+
+    assert identifiant == pipeline.identifiant_document(list(valeurs))
+    assert identifiant != pipeline.identifiant_document((*valeurs[:-1], 'median'))
+    assert ObjectId.is_valid(identifiant)
+
+
+def test_migration_convertit_les_dates_et_supprime_les_doublons(collection):
+    instant = datetime.datetime(2025, 8, 1, 1, 0)
+    # Ancien modèle Mongoose (Date), ancien pipeline (nanosecondes, texte), import actuel
+    collection.insert_many([
+        {'_id': ObjectId(), **valeurs_unicite(instant)},
+        {'_id': ObjectId(), **valeurs_unicite(1.75401e18 + 3.6e12, heure='02:00')},
+        {'_id': ObjectId(), **valeurs_unicite('2025-08-01 05:00:00', heure='05:00')},
+        {'_id': ObjectId(), 'batch_id': 'lot1', **valeurs_unicite(instant)},
+        {'_id': ObjectId(), 'batch_id': 'lot1', **valeurs_unicite(instant.replace(hour=2), heure='02:00')},
+    ])
+
+    bilan = pipeline.migrer_identifiants({})
+
+    assert bilan == {'dropped_indexes': [], 'converted_dates': 2,
+                     'deleted_duplicates': 2, 'legacy_remaining': 1}
+    restant = collection.find_one({'batch_id': {'$exists': False}})
+    assert restant['date_c'] == datetime.datetime(2025, 8, 1, 5, 0)
+    assert pipeline.migrer_identifiants({})['deleted_duplicates'] == 0
+
+
+def test_migration_supprime_l_index_unique_herite(collection):
+    collection.create_index([(champ, 1) for champ in pipeline.CLES_UNICITE], unique=True, name='herite')
+
+    assert pipeline.migrer_identifiants({})['dropped_indexes'] == ['herite']
+    assert pipeline.index_unicite_herites(collection) == []
@@ -0,0 +1,68 @@
+from openpyxl import load_workbook
+
+import full_pipeline_memory as pipeline
+
+# Première ligne de données du classeur LIMS (4 lignes d'en-tête) et colonne %P2O5 AR29
+LIGNE_DONNEES_LIMS = 5
+COLONNE_P2O5 = 7
+
+
+def modifier_cellule(chemin, rang, valeur):
+    wb = load_workbook(chemin)
+    wb.active.cell(row=LIGNE_DONNEES_LIMS + rang, column=COLONNE_P2O5, value=valeur)
+    wb.save(chemin)
+
+
+def empreintes(payload):
+    df_fusion = pipeline.traiter_fusion('F', *pipeline.contenus_classeurs(payload))
+    return pipeline.empreintes_lignes(df_fusion, 'F')
+
+
+def sans_lot(documents):
+    return [{cle: valeur for cle, valeur in doc.items() if cle != 'batch_id'} for doc in documents]
+
+
+def test_empreintes_ne_changent_qu_avec_la_ligne_brute(payload_classeurs):
+    payload = payload_classeurs()
+    avant = empreintes(payload)
+
+    assert avant.equals(empreintes(payload))
+    assert avant.is_unique
+
+    modifier_cellule(payload['file1_path'], 10, 99.5)
+    apres = empreintes(payload)
+
+    assert (avant != apres).sum() == 1
+
+
+def test_empreintes_connues_exigent_toutes_les_methodes(base_kpi):
+    collection = base_kpi[pipeline.NOM_COLLECTION_KPI]
+    collection.insert_many([
+        {'source_line': 'F', 'row_fingerprint': 'a', 'imputation_method': 'mean'},
+        {'source_line': 'F', 'row_fingerprint': 'a', 'imputation_method': 'median'},
+        {'source_line': 'F', 'row_fingerprint': 'b', 'imputation_method': 'mean'},
+        {'source_line': 'F', 'row_fingerprint': 'c', 'imputation_methods': ['mean', 'median']},
+        {'source_line': 'D', 'row_fingerprint': 'd', 'imputation_methods': ['mean', 'median']},
+    ])
+
+    connues = pipeline.empreintes_connues(collection, 'F', ['a', 'b', 'c', 'd'], ['mean', 'median'])
+
+    assert connues == {'a', 'c'}
+    assert pipeline.empreintes_connues(collection, 'F', ['a', 'b'], ['mean']) == {'a', 'b'}
+
+
+def test_delta_emet_les_documents_de_l_import_complet(payload_classeurs, executer, base_kpi):
+    payload = payload_classeurs()
+    executer({**payload, 'sink': {'type': 'mongodb'}})
+
+    documents, lot = executer({**payload, 'delta': True})
+    assert documents == [] and lot['rows']['emises'] == 0
+
+    modifier_cellule(payload['file1_path'], 10, 99.5)
+    delta, lot = executer({**payload, 'delta': True})
+    complets, _ = executer(payload)
+
+    assert lot['rows']['emises'] == 1
+    assert len(delta) == len(pipeline.METHODES_IMPUTATION)
+    empreinte = delta[0]['row_fingerprint']
+    assert sans_lot(delta) == sans_lot([doc for doc in complets if doc['row_fingerprint'] == empreinte])
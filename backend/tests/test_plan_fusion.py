@@ -0,0 +1,29 @@
+import full_pipeline_memory as pipeline
+
+
+def colonnes(payload):
+    lims, pi = (pipeline.charger_excel_streaming(contenu, niveaux).iloc[:, 1:]
+                for contenu, niveaux in zip(pipeline.contenus_classeurs(payload), (3, 2)))
+    return lims.columns, pi.columns
+
+
+def test_plan_relu_depuis_le_disque(payload_classeurs, monkeypatch):
+    colonnes_lims, colonnes_pi = colonnes(payload_classeurs())
+    monkeypatch.setattr(pipeline, 'PLANS_EN_CACHE', {})
+    plan = pipeline.charger_plan_fusion('F', colonnes_lims, colonnes_pi)
+
+    monkeypatch.setattr(pipeline, 'PLANS_EN_CACHE', {})
+    relu = pipeline.charger_plan_fusion('F', colonnes_lims, colonnes_pi)
+
+    assert relu == plan
+    assert [f.suffix for f in pipeline.REPERTOIRE_CACHE_PLANS.iterdir()] == ['.json']
+
+
+def test_empreinte_change_avec_la_version_du_plan(payload_classeurs, monkeypatch):
+    colonnes_lims, colonnes_pi = colonnes(payload_classeurs())
+    empreinte = pipeline.empreinte_disposition('F', colonnes_lims, colonnes_pi)
+
+    monkeypatch.setattr(pipeline, 'VERSION_PLAN_FUSION', pipeline.VERSION_PLAN_FUSION + 1)
+
+    assert pipeline.empreinte_disposition('F', colonnes_lims, colonnes_pi) != empreinte
+    assert pipeline.empreinte_disposition('D', colonnes_lims, colonnes_pi) != empreinte
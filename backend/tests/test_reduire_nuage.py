@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import statistics_analyzer as analyzer
+
+
+@pytest.fixture
+def nuage():
+    hasard = np.random.default_rng(3)
+    x = hasard.normal(size=20000)
+    y = 2 * x + hasard.normal(size=20000)
+    # Point isolé, loin du reste du nuage
+    x[12345], y[12345] = 40.0, -40.0
+    return x, y
+
+
+def points(scatter):
+    return {(p['x'], p['y']) for p in scatter}
+
+
+def test_petit_nuage_conserve_entier():
+    x, y = np.arange(10.0), np.arange(10.0) * 2
+
+    for mode in ('uniform', 'stratified'):
+        scatter, reduction = analyzer.reduire_nuage(x, y, mode, budget=50)
+        assert points(scatter) == set(zip(x, y))
+        assert reduction['points'] == reduction['sample_size'] == 10
+
+
+def test_uniforme_reguliere_dans_l_ordre_des_lignes(nuage):
+    x, y = nuage
+
+    scatter, reduction = analyzer.reduire_nuage(x, y, 'uniform', budget=500)
+
+    assert reduction['points'] == len(scatter) == 500
+    assert (scatter[0]['x'], scatter[-1]['x']) == (x[0], x[-1])
+
+
+def test_stratifiee_garde_les_points_isoles(nuage):
+    x, y = nuage
+
+    scatter, reduction = analyzer.reduire_nuage(x, y, 'stratified', budget=500)
+
+    assert (40.0, -40.0) in points(scatter)
+    assert points(scatter) <= set(zip(x, y))
+    assert 250 <= reduction['points'] <= 750
+
+
+def test_grille_compte_tous_les_points(nuage):
+    x, y = nuage
+
+    scatter, reduction = analyzer.reduire_nuage(x, y, 'bins', budget=400)
+
+    assert sum(p['count'] for p in scatter) == len(x)
+    assert reduction['points'] == len(scatter) <= 400
+
+
+def test_mode_inconnu_refuse(nuage):
+    with pytest.raises(ValueError, match='inconnu'):
+        analyzer.reduire_nuage(*nuage, mode='random')
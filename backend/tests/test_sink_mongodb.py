@@ -0,0 +1,80 @@
+import datetime
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+import full_pipeline_memory as pipeline
+
+
+def document(date_c='2025-08-01 01:00:00', heure='01:00', valeur=1.0, **champs):
+    identification = {'date_c': date_c, 'mois': 8, 'date_num': 0, 'semaine': 31, 'poste': 'A', 'heure': heure}
+    return {
+        '_id': pipeline.identifiant_document(('F', *identification.values(), 'mean')),
+        'source_line': 'F',
+        'batch_id': 'lot1',
+        'imputation_method': 'mean',
+        **identification,
+        'Valeurs': {'Débit': valeur},
+        **champs,
+    }
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient()['107_DEF_KPI_dashboard']['kpidatas']
+
+
+def test_set_on_insert_ignore_les_doublons_du_lot_et_de_la_base(collection):
+    premier = document(valeur=1.0)
+    doublon = document(valeur=2.0)
+    autre = document(heure='02:00')
+
+    assert pipeline.ecrire_lot_mongodb(collection, [premier, doublon, autre]) == (2, 1, 0)
+    assert pipeline.ecrire_lot_mongodb(collection, [document(valeur=3.0)]) == (0, 1, 0)
+
+    stocke = collection.find_one({'_id': ObjectId(premier['_id'])})
+    assert stocke['Valeurs']['Débit'] == 1.0
+    assert collection.count_documents({}) == 2
+
+
+def test_documents_au_format_du_schema_kpidata(collection):
+    pipeline.ecrire_lot_mongodb(collection, [document(date_c=1.75401e18)])
+
+    stocke = collection.find_one({})
+    assert isinstance(stocke['_id'], ObjectId)
+    assert stocke['date_c'] == datetime.datetime(2025, 8, 1, 1, 0)
+    assert {'import_date', 'createdAt', 'updatedAt'} <= set(stocke)
+
+
+def test_lignes_sans_date_rejetees(collection):
+    assert pipeline.ecrire_lot_mongodb(collection, [document(date_c=None), document(heure='02:00')]) == (1, 0, 1)
+    assert collection.count_documents({'date_c': None}) == 0
+
+
+def test_remplacer_ecrase_les_documents_existants(collection):
+    pipeline.ecrire_lot_mongodb(collection, [document(valeur=1.0)])
+
+    assert pipeline.ecrire_lot_mongodb(collection, [document(valeur=5.0), document(heure='02:00')], remplacer=True) == (1, 1, 0)
+
+    stocke = collection.find_one({'heure': '01:00'})
+    assert stocke['Valeurs']['Débit'] == 5.0
+    assert collection.count_documents({}) == 2
+
+
+def test_rejets_de_l_index_unique_herite_comptes_comme_presents(collection):
+    collection.create_index([(champ, 1) for champ in pipeline.CLES_UNICITE], unique=True, name='herite')
+    # Document de l'ancien modèle : _id aléatoire, mêmes champs d'unicité
+    ancien = pipeline.document_mongodb(document(), datetime.datetime(2024, 1, 1))
+    collection.insert_one({**ancien, '_id': ObjectId()})
+
+    assert pipeline.ecrire_lot_mongodb(collection, [document(), document(heure='02:00')]) == (1, 1, 0)
+    assert collection.count_documents({}) == 2
+
+
+def test_ecriture_par_paquets_et_bilan(collection):
+    lots = [[document(heure=f'{h:02d}:00') for h in range(5)], [document(heure='00:00'), document(date_c=None, heure='09:00')]]
+
+    bilan = pipeline.ecrire_documents_mongodb(collection, iter(lots), taille_lot=2)
+
+    assert bilan == {'inserted': 5, 'duplicates': 1, 'replaced': 0, 'rejected': 1}
@@ -0,0 +1,97 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import statistics_analyzer as analyzer
+
+
+def assert_proches(obtenu, attendu, rel=1e-9):
+    """
+    Compare deux résultats d'analyse (dictionnaires et listes imbriqués), nombres à `rel` près.
+    """
+    if isinstance(attendu, dict):
+        assert obtenu.keys() == attendu.keys()
+        for cle in attendu:
+            assert_proches(obtenu[cle], attendu[cle], rel)
+    elif isinstance(attendu, list):
+        assert len(obtenu) == len(attendu)
+        for a, b in zip(obtenu, attendu):
+            assert_proches(a, b, rel)
+    elif isinstance(attendu, (float, np.floating)):
+        assert obtenu == pytest.approx(attendu, rel=rel, abs=1e-9, nan_ok=True)
+    else:
+        assert obtenu == attendu
+
+
+def fusion(morceaux):
+    partiel = analyzer.partiel_depuis_valeurs(morceaux[0])
+    for morceau in morceaux[1:]:
+        partiel = analyzer.fusionner_partiels(partiel, analyzer.partiel_depuis_valeurs(morceau))
+    return partiel
+
+
+def test_partiels_fusionnes_identiques_au_calcul_complet():
+    hasard = np.random.default_rng(11)
+    # Valeurs de laboratoire arrondies : peu de valeurs distinctes, statistiques exactes
+    valeurs = np.round(hasard.normal(27.5, 1.2, size=3000), 1)
+
+    resultat = analyzer.analyze_quantitative_from_stats('p2o5', fusion(np.array_split(valeurs, [500, 1800])))
+
+    assert resultat.pop('statistiques_suffisantes') == {'exact': True}
+    assert_proches(resultat, analyzer.analyze_quantitative(pd.Series(valeurs, name='p2o5')))
+
+
+def test_partiels_fusionnes_approches_au_dela_des_valeurs_comptees():
+    hasard = np.random.default_rng(12)
+    valeurs = hasard.gamma(2.0, 10.0, size=20000)
+    attendu = analyzer.analyze_quantitative(pd.Series(valeurs, name='debit'))
+
+    resultat = analyzer.analyze_quantitative_from_stats('debit', fusion(np.array_split(valeurs, 4)))
+
+    assert resultat['statistiques_suffisantes'] == {'exact': False}
+    assert resultat['chart_data']['summary_stats']['sample_size'] == len(valeurs)
+    for cle in ('moyenne', 'mediane'):
+        assert resultat['tendance_centrale'][cle] == pytest.approx(attendu['tendance_centrale'][cle], rel=1e-2)
+    assert resultat['dispersion']['ecart_type'] == pytest.approx(attendu['dispersion']['ecart_type'], rel=1e-9)
+    assert resultat['chart_data']['boxplot']['max'] == attendu['chart_data']['boxplot']['max']
+    etendue = valeurs.max() - valeurs.min()
+    for quartile in ('Q1', 'Q3'):
+        assert abs(resultat['quartiles'][quartile] - attendu['quartiles'][quartile]) < 0.01 * etendue
+
+
+def test_verrou_exclusif_et_repris_a_expiration():
+    import mongomock
+
+    db = mongomock.MongoClient()['107_DEF_KPI_dashboard']
+
+    jeton = analyzer.acquerir_verrou_statistiques(db, 'F|4fill', attente=0)
+    assert jeton is not None
+    assert analyzer.acquerir_verrou_statistiques(db, 'F|4fill', attente=0) is None
+    assert analyzer.acquerir_verrou_statistiques(db, 'D|4fill', attente=0) is not None
+
+    analyzer.liberer_verrou_statistiques(db, 'F|4fill', jeton)
+    # Détenteur arrêté sans libérer : le verrou expiré est repris
+    assert analyzer.acquerir_verrou_statistiques(db, 'F|4fill', duree=-1, attente=0) is not None
+    assert analyzer.acquerir_verrou_statistiques(db, 'F|4fill', attente=0) is not None
+
+
+def test_mise_a_jour_incrementale_par_lot(payload_classeurs, executer, base_kpi, monkeypatch):
+    monkeypatch.setattr(base_kpi.client, 'close', lambda: None)
+    monkeypatch.setattr(analyzer, 'get_mongodb_connection', lambda: base_kpi.client)
+    options = {'methods': ['4fill'], 'sink': {'type': 'mongodb'}}
+
+    executer(payload_classeurs(graine=1, **options))
+    assert analyzer.mettre_a_jour_statistiques_suffisantes('107F')['status'] == 'rebuilt'
+    executer(payload_classeurs(graine=2, debut=datetime.datetime(2025, 9, 1), **options))
+    assert analyzer.mettre_a_jour_statistiques_suffisantes('107F')['status'] == 'updated'
+
+    df = analyzer.get_data_from_mongodb('107F').drop(columns=analyzer.COLONNES_EXCLUES, errors='ignore')
+    stockees = list(base_kpi[analyzer.NOM_COLLECTION_STATS_SUFFISANTES].find({'quantitative': True}))
+    assert len(stockees) > 10
+    for doc in stockees:
+        resultat = analyzer.analyze_quantitative_from_stats(doc['variable'], doc['stats'])
+        resultat.pop('statistiques_suffisantes')
+        assert_proches(resultat, analyzer.analyze_quantitative(df[doc['variable']].astype('float64')), rel=1e-6)
+    assert base_kpi[analyzer.NOM_COLLECTION_VERROUS_STATS].count_documents({}) == 0
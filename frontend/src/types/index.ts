@@ -191,6 +191,14 @@ export interface BoxPlotData {
 export interface ScatterDataPoint {
   x: number;
   y: number;
+  count?: number; // mode 'bins' : nombre de points dans la case
+}
+
+export interface ScatterReduction {
+  mode: 'uniform' | 'stratified' | 'bins' | 'none';
+  budget: number;
+  sample_size: number;
+  points: number;
 }
 
 export interface RegressionLine {
@@ -261,6 +269,7 @@ export interface RelationQuantitative {
     regression_lineaire?: RegressionLineaire;
     chart_data?: {
         scatter_data: ScatterDataPoint[];
+        scatter_reduction?: ScatterReduction;
         regression_line: RegressionLine;
         sample_size: number;
     };